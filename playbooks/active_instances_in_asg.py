@@ -17,32 +17,111 @@ Typical use
 
 ansible -i $(active_instances_in_asg.py --asg stage-edx-edxapp) -m shell -a 'management command'
 
+Jobs that run several commands against the same cluster can pass
+--cache-ttl to reuse the instance found for that many seconds; it is cached
+in the temp directory per profile, region and ASG name.
+
 """
 
 from __future__ import print_function
 import argparse
 import botocore.session
 import botocore.exceptions
+import json
+import os
 import sys
+import tempfile
+import time
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from os import environ
 from itertools import chain
 
+# describe_auto_scaling_groups takes at most this many names per call
+ASG_NAMES_PER_CALL = 50
+# and an EC2 filter at most this many values
+INSTANCE_IDS_PER_FILTER = 200
+
 class ActiveInventory():
 
     profile = None
 
-    def __init__(self, profile, region):
+    def __init__(self, profile, region, cache_ttl=0):
         self.profile = profile
         self.region  = region
+        self.cache_ttl = cache_ttl
+
+    def find_groups(self, asg, asg_name):
+        """
+        Returns the ASGs whose Name tag is asg_name. The tags are filtered
+        by the API, so only those groups are described rather than every
+        group in the region.
+        """
+        group_names = set()
+        tags = asg.get_paginator('describe_tags').paginate(Filters=[
+            {'Name': 'key', 'Values': ['Name']},
+            {'Name': 'value', 'Values': [asg_name]},
+        ])
+        for page in tags:
+            for tag in page['Tags']:
+                if tag['ResourceType'] == 'auto-scaling-group':
+                    group_names.add(tag['ResourceId'])
+
+        group_names = sorted(group_names)
+        groups = []
+        paginator = asg.get_paginator('describe_auto_scaling_groups')
+        for i in range(0, len(group_names), ASG_NAMES_PER_CALL):
+            for page in paginator.paginate(AutoScalingGroupNames=group_names[i:i + ASG_NAMES_PER_CALL]):
+                groups.extend(page['AutoScalingGroups'])
+        return groups
+
+    def get_cache_path(self, asg_name):
+        return os.path.join(tempfile.gettempdir(), "active_instances_in_asg-{}-{}-{}".format(
+            self.profile or "default", self.region, asg_name))
+
+    def read_cache(self, asg_name):
+        """
+        Returns the cached address for asg_name if it is younger than
+        cache_ttl seconds, None otherwise.
+        """
+        if self.cache_ttl <= 0:
+            return None
+        path = self.get_cache_path(asg_name)
+        try:
+            if time.time() - os.path.getmtime(path) >= self.cache_ttl:
+                return None
+            with open(path) as cache:
+                return json.load(cache)['address']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def write_cache(self, asg_name, address):
+        path = self.get_cache_path(asg_name)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+        with os.fdopen(fd, 'w') as cache:
+            json.dump({'address': address}, cache)
+        os.rename(tmp_path, path)
 
     def run(self,asg_name):
+        address = self.read_cache(asg_name)
+        if address is None:
+            address = self.find_address(asg_name)
+            if address is not None and self.cache_ttl > 0:
+                self.write_cache(asg_name, address)
+
+        if address is not None:
+            print("{},".format(address))
+
+    def find_address(self,asg_name):
+        """
+        Returns the private IP address of an instance of the active ASG
+        named asg_name, or None if there isn't exactly one active ASG.
+        """
         session = botocore.session.Session(profile=self.profile)
         asg = session.create_client('autoscaling',self.region)
         ec2 = session.create_client('ec2',self.region)
 
-        groups = asg.describe_auto_scaling_groups()
-        matching_groups = [g for g in groups['AutoScalingGroups'] for t in g['Tags'] if t['Key'] == 'Name' and t['Value'] == asg_name]
+        matching_groups = self.find_groups(asg, asg_name)
 
         groups_to_instances = {group['AutoScalingGroupName']: [instance['InstanceId'] for instance in group['Instances']] for group in matching_groups}
         instances_to_groups = {instance['InstanceId']: group['AutoScalingGroupName'] for group in matching_groups for instance in group['Instances'] }
@@ -52,12 +131,21 @@ class ActiveInventory():
         active_groups = defaultdict(dict)
         if len(matching_groups) > 1:
             elb = session.create_client('elb',self.region)
-            for group in matching_groups:
-                for load_balancer_name in group['LoadBalancerNames']:
-                    instances = elb.describe_instance_health(LoadBalancerName=load_balancer_name)
+            load_balancer_names = sorted({name for group in matching_groups for name in group['LoadBalancerNames']})
+            if load_balancer_names:
+                # botocore clients can be shared between threads
+                pool = ThreadPool(len(load_balancer_names))
+                try:
+                    health = pool.map(lambda name: elb.describe_instance_health(LoadBalancerName=name),
+                                      load_balancer_names)
+                finally:
+                    pool.terminate()
+                for instances in health:
                     active_instances = [instance['InstanceId'] for instance in instances['InstanceStates'] if instance['State'] == 'InService']
                     for instance_id in active_instances:
-                        active_groups[instances_to_groups[instance_id]] = 1 
+                        # Instances of other ASGs can be in the same ELB
+                        if instance_id in instances_to_groups:
+                            active_groups[instances_to_groups[instance_id]] = 1
 
             # If we found no active groups, because there are no ELBs (edxapp workers normally)
             elbs = list(chain.from_iterable([group['LoadBalancerNames'] for group in matching_groups]))
@@ -72,17 +160,32 @@ class ActiveInventory():
             if len(active_groups) > 1:
                 # When we have more than a single active ASG, we need to bail out as we don't know what ASG to pick an instance from
                 print("Multiple active ASGs - unable to choose an instance", file=sys.stderr)
-                return
+                return None
         else:
             active_groups = { g['AutoScalingGroupName']: 1 for g in matching_groups }
 
-
-        for group in active_groups.keys():
-            for group_instance in groups_to_instances[group]:
-                instance = ec2.describe_instances(InstanceIds=[group_instance])['Reservations'][0]['Instances'][0]
-                if 'PrivateIpAddress' in instance:
-                    print("{},".format(instance['PrivateIpAddress']))
-                    return # We only want a single IP
+        candidates = [instance_id for group in active_groups.keys() for instance_id in groups_to_instances[group]]
+        if not candidates:
+            return None
+
+        # Describe the candidates in one call, or one per 200 for the largest
+        # ASGs. A filter, unlike InstanceIds, doesn't fail if one of them was
+        # terminated since the ASG was read.
+        addresses = {}
+        paginator = ec2.get_paginator('describe_instances')
+        for i in range(0, len(candidates), INSTANCE_IDS_PER_FILTER):
+            pages = paginator.paginate(
+                Filters=[{'Name': 'instance-id', 'Values': candidates[i:i + INSTANCE_IDS_PER_FILTER]}])
+            for page in pages:
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        if 'PrivateIpAddress' in instance:
+                            addresses[instance['InstanceId']] = instance['PrivateIpAddress']
+
+        for instance_id in candidates:
+            if instance_id in addresses:
+                return addresses[instance_id] # We only want a single IP
+        return None
 
 
 if __name__=="__main__":
@@ -91,8 +194,10 @@ if __name__=="__main__":
     parser.add_argument('-p', '--profile', help='The aws profile to use when connecting.')
     parser.add_argument('-l', '--list', help='Ansible passes this, we ignore it.', action='store_true', default=True)
     parser.add_argument('--asg',help='Name of the ASG we want active instances from.', required=True)
+    parser.add_argument('--cache-ttl', type=int, default=0,
+                        help='Seconds to reuse the instance found for this ASG (default: 0, no cache).')
     args = parser.parse_args()
 
     region = environ.get('AWS_REGION','us-east-1')
 
-    ActiveInventory(args.profile,region).run(args.asg)
+    ActiveInventory(args.profile,region,args.cache_ttl).run(args.asg)
@@ -0,0 +1,257 @@
+import cProfile
+from datetime import datetime
+import json
+import logging
+import os
+from os.path import join
+import pstats
+import re
+import resource
+import sys
+import time
+
+try:
+    from ansible.plugins.callback import CallbackBase
+except ImportError:
+    # Support Ansible 1.9.x
+    CallbackBase = object
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+LOGGER = logging.getLogger(__name__)
+
+"""
+Profiles the CPU and memory used by the ansible controller during each task,
+to find out whether a slow run is spending its time on the remote hosts or in
+ansible itself: variable merging, inventory, filters such as config_encoders,
+processing results and the other callbacks.
+
+Only the controller's main process is profiled. The templating of a task's
+arguments for each host and the running of its module happen in the forked
+workers, and show up as time the main process spends waiting.
+
+Enabled by setting ANSIBLE_PROFILE_DIR to the directory to write the profiles
+to. Each run gets its own directory in it, run-<start time>-<pid>, holding:
+
+    tasks.jsonl      a JSON line per task: its wall clock and CPU seconds, the
+                     change in the resident memory of the controller, the top
+                     functions by their own time and, with python 3, the top
+                     lines by memory allocated
+    task-NNNN-<task>.prof
+                     the profile of each task, for pstats or snakeviz
+    run.prof         the profiles of all the tasks added together
+    run.txt          the top functions of the run, by cumulative and own time
+
+Other settings:
+
+    ANSIBLE_PROFILE_MODES   cpu, memory or cpu,memory (the default). memory
+                            uses tracemalloc, which python 2 doesn't have;
+                            the resident memory is recorded regardless.
+    ANSIBLE_PROFILE_SAMPLE  profile one task in this many (default 1, all).
+    ANSIBLE_PROFILE_TOP     functions and lines listed per task (default 20).
+"""
+
+ANSIBLE_PROFILE_DIR = os.environ.get('ANSIBLE_PROFILE_DIR')
+
+
+def current_rss_kb():
+    """
+    Return the resident memory of this process in KB: the current value on
+    Linux, the peak elsewhere.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, OSError, IndexError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, KB elsewhere
+        return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def cpu_seconds():
+    """
+    Return the user and system CPU time of this process so far.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def top_functions(stats, count):
+    """
+    Return the count functions of a pstats.Stats with the most time of their
+    own, with their calls and own and cumulative seconds.
+    """
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+    return [
+        {
+            'function': '{0}:{1}({2})'.format(*function),
+            'calls': calls,
+            'own_seconds': round(own_time, 6),
+            'cumulative_seconds': round(cumulative_time, 6),
+        }
+        for function, (_, calls, own_time, cumulative_time, _) in rows[:count]
+    ]
+
+
+class TaskProfile(object):
+    """
+    The profile of the controller while a task runs.
+    """
+    def __init__(self, name, play, index, cpu, memory):
+        self.name = name
+        self.play = play
+        self.index = index
+        self.started_at = datetime.utcnow()
+        self.wall_start = time.time()
+        self.cpu_start = cpu_seconds()
+        self.rss_start = current_rss_kb()
+        self.profiler = None
+        self.snapshot = None
+        if memory:
+            self.snapshot = tracemalloc.take_snapshot()
+        if cpu:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self, top):
+        """
+        Stop profiling, returning the record of the task.
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+
+        record = {
+            'task': self.name,
+            'play': self.play,
+            'index': self.index,
+            'started_at': self.started_at.isoformat(),
+            'wall_seconds': round(time.time() - self.wall_start, 6),
+            'cpu_seconds': round(cpu_seconds() - self.cpu_start, 6),
+            'rss_kb_before': self.rss_start,
+            'rss_kb_after': current_rss_kb(),
+        }
+        record['rss_kb_delta'] = record['rss_kb_after'] - record['rss_kb_before']
+
+        if self.profiler is not None:
+            record['top_functions'] = top_functions(pstats.Stats(self.profiler), top)
+
+        if self.snapshot is not None:
+            differences = tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')
+            record['allocated_kb'] = sum(difference.size_diff for difference in differences) // 1024
+            record['top_allocations'] = [
+                {
+                    'line': '{0}:{1}'.format(difference.traceback[0].filename, difference.traceback[0].lineno),
+                    'size_kb_delta': difference.size_diff // 1024,
+                    'count_delta': difference.count_diff,
+                }
+                for difference in differences[:top]
+            ]
+            self.snapshot = None
+
+        return record
+
+
+class CallbackModule(CallbackBase):
+    """
+    Ansible plugin profiling the CPU and memory the controller uses for each
+    task. See the top of the file for its settings.
+    """
+    def __init__(self):
+        self.enabled = ANSIBLE_PROFILE_DIR is not None
+        if not self.enabled:
+            return
+
+        modes = os.getenv('ANSIBLE_PROFILE_MODES', 'cpu,memory').split(',')
+        self.cpu = 'cpu' in modes
+        self.memory = 'memory' in modes and tracemalloc is not None
+        self.sample = max(1, int(os.getenv('ANSIBLE_PROFILE_SAMPLE', 1)))
+        self.top = int(os.getenv('ANSIBLE_PROFILE_TOP', 20))
+
+        self.run_dir = join(
+            ANSIBLE_PROFILE_DIR,
+            'run-{0}-{1}'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S'), os.getpid())
+        )
+        os.makedirs(self.run_dir)
+        self.tasks_log = open(join(self.run_dir, 'tasks.jsonl'), 'a')
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self.play = None
+        self.play_name = None
+        # Tasks started in the current play, by uuid
+        self.task_uuids = set()
+        self.tasks_seen = 0
+        self.current = None
+        self.run_stats = None
+
+    def v2_playbook_on_play_start(self, play):
+        if self.enabled:
+            self.play = play
+            self.play_name = play.get_name()
+            self.task_uuids = set()
+
+    def playbook_on_task_start(self, name, is_conditional):
+        if self.enabled:
+            self._start_task(name)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        if not self.enabled:
+            return
+        if task._uuid in self.task_uuids and getattr(self.play, 'strategy', None) == 'free':
+            # The free strategy reports the start of a task for each host
+            # that reaches it, which is still the same run of the task
+            return
+        self.task_uuids.add(task._uuid)
+        self._start_task(task.name or task.get_name())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        if self.enabled:
+            self._start_task(task.get_name())
+
+    def playbook_on_stats(self, stats):
+        if not self.enabled:
+            return
+
+        self._stop_task()
+        self.tasks_log.close()
+        if self.run_stats is None:
+            return
+
+        self.run_stats.dump_stats(join(self.run_dir, 'run.prof'))
+        with open(join(self.run_dir, 'run.txt'), 'w') as report:
+            self.run_stats.stream = report
+            self.run_stats.sort_stats('cumulative').print_stats(self.top * 2)
+            self.run_stats.sort_stats('time').print_stats(self.top * 2)
+        LOGGER.info("Controller profile of the run written to %s", self.run_dir)
+
+    def _start_task(self, name):
+        self._stop_task()
+        self.tasks_seen += 1
+        if (self.tasks_seen - 1) % self.sample == 0:
+            self.current = TaskProfile(name, self.play_name, self.tasks_seen, self.cpu, self.memory)
+
+    def _stop_task(self):
+        if self.current is None:
+            return
+
+        task, self.current = self.current, None
+        try:
+            record = task.stop(self.top)
+            self.tasks_log.write(json.dumps(record, sort_keys=True) + '\n')
+            self.tasks_log.flush()
+
+            if task.profiler is not None:
+                slug = re.sub(r'[^A-Za-z0-9]+', '-', task.name or '').strip('-')[:60]
+                task.profiler.dump_stats(join(self.run_dir, 'task-{0:04d}-{1}.prof'.format(task.index, slug)))
+                if self.run_stats is None:
+                    self.run_stats = pstats.Stats(task.profiler)
+                else:
+                    self.run_stats.add(task.profiler)
+        except Exception:
+            LOGGER.exception("Unable to write the controller profile of %s", task.name)
@@ -1,6 +1,10 @@
 import os
+import sys
 import time
-from ansible import utils
+import json
+import threading
+import urllib2
+import Queue
 try:
     import prettytable
 except ImportError:
@@ -12,11 +16,202 @@ except ImportError:
 from ansible.plugins.callback import CallbackBase
 
 
+def warning(msg):
+    print >> sys.stderr, 'hipchat callback: {}'.format(msg)
+
+
+class HipChatSink(object):
+    """Posts messages to a HipChat room."""
+
+    def __init__(self, conn, room, from_name):
+        self.conn = conn
+        self.room = room
+        self.from_name = from_name
+
+    def send(self, message, color='', message_format='text', notify=False):
+        self.conn.message_room(self.room, self.from_name, message,
+                               color=color, message_format=message_format, notify=notify)
+
+
+class WebhookSink(object):
+    """Posts messages as JSON to a generic webhook URL."""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, message, color='', message_format='text', notify=False):
+        body = json.dumps({
+            'text': message,
+            'color': color,
+            'format': message_format,
+            'notify': notify,
+        })
+        request = urllib2.Request(self.url, body, {'Content-Type': 'application/json'})
+        urllib2.urlopen(request, timeout=self.timeout).read()
+
+
+class Notifier(object):
+    """
+    Sends messages to a list of sinks from a worker thread, so a
+    slow chat API doesn't hold up the playbook.
+
+    At most rate_limit messages a minute are sent. Failures are
+    not sent as they happen: the failures of a task are collected
+    and sent as a single summary once window seconds have passed
+    since the first one, or sooner when the next task starts or
+    the notifier is flushed. Flushing stops the worker, and the
+    messages sent after that are dropped.
+    """
+
+    STOP = object()
+    # Hosts and distinct errors listed in a failure summary
+    MAX_HOSTS = 10
+    MAX_ERRORS = 5
+
+    def __init__(self, sinks, rate_limit=30, window=10, queue_size=100):
+        self.sinks = sinks
+        self.interval = 60.0 / rate_limit if rate_limit > 0 else 0
+        self.window = window
+        self.messages = Queue.Queue(queue_size)
+        self.failures = {}
+        self.failures_lock = threading.Lock()
+        self.last_sent = 0
+        self.dropped = 0
+        self.worker = None
+        self.closed = False
+
+    def send(self, message, color='', message_format='text', notify=False):
+        """
+        Queues a message; it is dropped if the queue is full or the
+        notifier was flushed.
+        """
+        if self.closed:
+            self.dropped += 1
+            return
+        self._start()
+        try:
+            self.messages.put_nowait(dict(
+                message=message, color=color, message_format=message_format, notify=notify))
+        except Queue.Full:
+            self.dropped += 1
+
+    def failure(self, task, host, error, prefix=''):
+        """Records the failure of task on host, to be summarized later."""
+        if self.closed:
+            self.dropped += 1
+            return
+        self._start()
+        with self.failures_lock:
+            if task not in self.failures:
+                self.failures[task] = {'first': time.time(), 'prefix': prefix, 'hosts': [], 'errors': {}}
+            failures = self.failures[task]
+            failures['hosts'].append(host)
+            failures['errors'].setdefault(error, []).append(host)
+
+    def summarize_failures(self, older_than=None):
+        """
+        Queues the summaries of the failures collected, or only of
+        those whose first failure is older_than seconds old.
+        """
+        now = time.time()
+        with self.failures_lock:
+            tasks = [task for task, failures in self.failures.items()
+                     if older_than is None or now - failures['first'] >= older_than]
+            summaries = [self.failures.pop(task) for task in tasks]
+        for failures in sorted(summaries, key=lambda failures: failures['first']):
+            self.send(self._failure_summary(failures), color='red', message_format='text')
+
+    def flush(self, timeout=60):
+        """
+        Queues the failure summaries and waits up to timeout seconds
+        for the worker to send everything queued, then stops it.
+        A worker still sending when the timeout is up is left to
+        finish in the background, without new messages.
+        """
+        self.summarize_failures()
+        self.closed = True
+        if self.worker is None:
+            return
+        try:
+            self.messages.put(self.STOP, timeout=timeout)
+        except Queue.Full:
+            pass
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            warning('gave up waiting for {} messages to be sent'.format(self.messages.qsize()))
+        if self.dropped:
+            warning('{} messages dropped, the queue was full or they came after the flush'.format(
+                self.dropped))
+            self.dropped = 0
+
+    def _start(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._run, name='hipchat-notifier')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _run(self):
+        while True:
+            try:
+                message = self.messages.get(timeout=min(self.window, 1))
+            except Queue.Empty:
+                message = None
+            if message is self.STOP:
+                return
+            if message is not None:
+                self._deliver(message)
+            self.summarize_failures(older_than=self.window)
+
+    def _deliver(self, message):
+        wait = self.last_sent + self.interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_sent = time.time()
+        for sink in self.sinks:
+            try:
+                sink.send(**message)
+            except Exception as e:
+                warning('could not submit message to {}: {}'.format(type(sink).__name__, e))
+
+    def _failure_summary(self, failures):
+        hosts = failures['hosts']
+        errors = sorted(failures['errors'].items(), key=lambda (error, hosts): -len(hosts))
+        if len(hosts) == 1:
+            return '/code {}: The ansible run returned the following error:\n\n {}'.format(
+                failures['prefix'], errors[0][0])
+
+        lines = ['/code {}: The ansible run returned errors on {} hosts:'.format(
+            failures['prefix'], len(hosts))]
+        for error, error_hosts in errors[:self.MAX_ERRORS]:
+            lines.append('')
+            lines.append(' {}'.format(error))
+            lines.append(' on {}{}'.format(
+                ', '.join(error_hosts[:self.MAX_HOSTS]),
+                ' and {} more'.format(len(error_hosts) - self.MAX_HOSTS) if len(error_hosts) > self.MAX_HOSTS else ''))
+        if len(errors) > self.MAX_ERRORS:
+            lines.append('')
+            lines.append(' and {} other errors'.format(len(errors) - self.MAX_ERRORS))
+        return '\n'.join(lines)
+
+
 class CallbackModule(CallbackBase):
     """Send status updates to a HipChat channel during playbook execution.
 
+    Messages are sent from a background thread, so a slow chat
+    API doesn't hold up the playbook, and the failures of a task
+    are sent as one summary rather than a message per host.
+
     This plugin makes use of the following environment variables:
         HIPCHAT_TOKEN (required): HipChat API token
+        HIPCHAT_URL (optional): HipChat API URL. Default: https://api.hipchat.com/v1/
+        HIPCHAT_WEBHOOK_URL (optional): Also post the messages as JSON to this URL.
+            Enables the plugin without HIPCHAT_TOKEN.
+        HIPCHAT_RATE_LIMIT (optional): Most messages sent a minute. Default: 30
+        HIPCHAT_FAILURE_WINDOW (optional): Seconds the failures of a task are collected
+            for before their summary is sent. Default: 10
+        HIPCHAT_FLUSH_TIMEOUT (optional): Seconds to wait for queued messages
+            to be sent at the end of the playbook. Default: 60
         HIPCHAT_ROOM  (optional): HipChat room to post in. Default: ansible
         HIPCHAT_FROM  (optional): Name to post as. Default: ansible
         HIPCHAT_NOTIFY (optional): Add notify flag to important messages ("true" or "false"). Default: true
@@ -30,12 +225,12 @@ class CallbackModule(CallbackBase):
     """
 
     def __init__(self):
-        self.enabled = "HIPCHAT_TOKEN" in os.environ
+        self.enabled = "HIPCHAT_TOKEN" in os.environ or "HIPCHAT_WEBHOOK_URL" in os.environ
         if not self.enabled:
             return
 
         # make sure we got our imports
-        if not hipchat:
+        if not hipchat and "HIPCHAT_TOKEN" in os.environ:
             raise ImportError(
                 "The hipchat plugin requires the hipchat Python module, "
                 "which is not installed or was not found."
@@ -56,27 +251,33 @@ class CallbackModule(CallbackBase):
         self.room = os.getenv('HIPCHAT_ROOM', 'ansible')
         self.from_name = os.getenv('HIPCHAT_FROM', 'ansible')
         self.allow_notify = (os.getenv('HIPCHAT_NOTIFY') != 'false')
-        try:
-            self.hipchat_conn = hipchat.HipChat(token=os.getenv('HIPCHAT_TOKEN'))
-        except Exception as e:
-            utils.warning("Unable to connect to hipchat: {}".format(e))
+        sinks = []
+        if "HIPCHAT_TOKEN" in os.environ:
+            try:
+                self.hipchat_conn = hipchat.HipChat(
+                    token=os.getenv('HIPCHAT_TOKEN'),
+                    url=os.getenv('HIPCHAT_URL', hipchat.API_URL_DEFAULT))
+                sinks.append(HipChatSink(self.hipchat_conn, self.room, self.from_name))
+            except Exception as e:
+                warning("Unable to connect to hipchat: {}".format(e))
+        if "HIPCHAT_WEBHOOK_URL" in os.environ:
+            sinks.append(WebhookSink(os.getenv('HIPCHAT_WEBHOOK_URL')))
+        self.notifier = Notifier(
+            sinks,
+            rate_limit=float(os.getenv('HIPCHAT_RATE_LIMIT', 30)),
+            window=float(os.getenv('HIPCHAT_FAILURE_WINDOW', 10)))
+        self.flush_timeout = float(os.getenv('HIPCHAT_FLUSH_TIMEOUT', 60))
         self.hipchat_msg_prefix = os.getenv('HIPCHAT_MSG_PREFIX', '')
         self.hipchat_msg_color = os.getenv('HIPCHAT_MSG_COLOR', '')
         self.printed_playbook = False
         self.playbook_name = None
+        self.current_task = None
 
-    def _send_hipchat(self, message, room=None, from_name=None, color=None, message_format='text'):
+    def _send_hipchat(self, message, color=None, message_format='text'):
 
-        if not room:
-            room = self.room
-        if not from_name:
-            from_name = self.from_name
         if not color:
             color = self.hipchat_msg_color
-        try:
-            self.hipchat_conn.message_room(room, from_name, message, color=color, message_format=message_format)
-        except Exception as e:
-            utils.warning("Could not submit message to hipchat: {}".format(e))
+        self.notifier.send(message, color=color, message_format=message_format)
 
     def _flush_last_task(self):
         if self.last_task:
@@ -91,7 +292,7 @@ class CallbackModule(CallbackBase):
         self.last_task = None
         self.last_task_delta = 0
 
-    def _process_message(self, msg, msg_type='STATUS'):
+    def _process_message(self, msg, msg_type='STATUS', host=None):
 
         if msg_type == 'OK' and self.last_task:
             if msg.get('changed', True):
@@ -105,13 +306,15 @@ class CallbackModule(CallbackBase):
             self._flush_last_task()
 
         if msg_type == 'TASK_START':
+            # the failures of the last task are all in
+            self.notifier.summarize_failures()
             self.last_task = msg
+            self.current_task = msg
             self.last_task_start = time.time()
         elif msg_type == 'FAILED':
             self.last_task_start = time.time()
             if 'msg' in msg:
-                self._send_hipchat('/code {}: The ansible run returned the following error:\n\n {}'.format(
-                    self.hipchat_msg_prefix, msg['msg']), color='red', message_format='text')
+                self.notifier.failure(self.current_task, host, msg['msg'], prefix=self.hipchat_msg_prefix)
         else:
             # move forward the last task start time
             self.last_task_start = time.time()
@@ -122,7 +325,7 @@ class CallbackModule(CallbackBase):
 
     def runner_on_failed(self, host, res, ignore_errors=False):
         if self.enabled:
-            self._process_message(res, 'FAILED')
+            self._process_message(res, 'FAILED', host)
 
     def runner_on_ok(self, host, res):
         if self.enabled:
@@ -206,6 +409,7 @@ class CallbackModule(CallbackBase):
     def playbook_on_stats(self, stats):
         if self.enabled:
             self._flush_last_task()
+            self.notifier.summarize_failures()
             delta = time.time() - self.start_time
             self.start_time = time.time()
             """Display info about playbook statistics"""
@@ -233,11 +437,11 @@ class CallbackModule(CallbackBase):
 
             summary_all_host_output = []
             for host in hosts:
-                stats = stats.summarize(host)
+                host_stats = stats.summarize(host)
                 summary_output = "<b>{}</b>: <i>{}</i> - ".format(self.hipchat_msg_prefix, host)
                 for summary_item in ['ok', 'changed', 'unreachable', 'failures']:
-                    if stats[summary_item] != 0:
-                        summary_output += "<b>{}</b> - {} ".format(summary_item, stats[summary_item])
+                    if host_stats[summary_item] != 0:
+                        summary_output += "<b>{}</b> - {} ".format(summary_item, host_stats[summary_item])
                 summary_all_host_output.append(summary_output)
             self._send_hipchat("<br />".join(summary_all_host_output), message_format='html')
             msg = "<b>{description}</b>: Finished Ansible run for <b><i>{play}</i> in {min:02} minutes, {sec:02} seconds</b><br /><br />".format(
@@ -246,3 +450,4 @@ class CallbackModule(CallbackBase):
                 min=int(delta / 60),
                 sec=int(delta % 60))
             self._send_hipchat(msg, message_format='html')
+            self.notifier.flush(self.flush_timeout)
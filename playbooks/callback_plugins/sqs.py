@@ -21,6 +21,10 @@ import sys
 import time
 import json
 import socket
+import threading
+import Queue
+import base64
+import zlib
 try:
     import boto
 except ImportError:
@@ -41,13 +45,49 @@ class CallbackModule(CallbackBase):
         SQS_REGION - AWS region to connect to
         SQS_MSG_PREFIX - Additional data that will be put
                          on the queue (optional)
+        SQS_QUEUE_SIZE - Events that can wait to be sent
+                         before new ones are dropped
+                         (optional, default 1000)
+        SQS_MAX_RETRIES - Attempts at sending an event
+                          before it is dropped (optional,
+                          default 5)
+        SQS_MESSAGE_BUDGET - Bytes an event should fit in
+                             once encoded; long strings and
+                             lists in the results are clipped
+                             to fit (optional, default 32768)
+        SQS_GZIP - Gzip and base64 encode events still over
+                   the budget after clipping (optional)
+        SQS_FLUSH_TIMEOUT - Seconds to wait for the queued
+                            events to be sent when the
+                            playbook ends (optional,
+                            default 60)
 
     The following events are put on the queue
         - FAILURE events
         - OK events
         - TASK events
         - START events
+
+    Events are sent by a background thread, so the playbook
+    doesn't wait for SQS. It sends them in batches of up to
+    10 messages and 256KB, retries failed messages with
+    exponential backoff, and is flushed when the playbook
+    ends. self.counters tracks how many events were queued,
+    sent, dropped because the queue was full, failed after
+    all their retries or were left unsent by the flush, and
+    how many SendMessageBatch calls succeeded.
     """
+
+    STOP = object()
+
+    # SendMessageBatch limits
+    BATCH_MESSAGES = 10
+    BATCH_BYTES = 256 * 1024
+    # Largest message SQS accepts
+    MAX_MESSAGE_BYTES = 256 * 1024
+    # Longest strings and lists results are clipped to, in
+    # turn, until an event fits in the budget
+    CLIP_LIMITS = [(1000, 20), (500, 10), (250, 5), (100, 5)]
     def __init__(self):
         self.enable_sqs = 'ANSIBLE_ENABLE_SQS' in os.environ
         if not self.enable_sqs:
@@ -86,6 +126,26 @@ class CallbackModule(CallbackBase):
 
         self.last_seen_ts = {}
 
+        self.max_retries = int(os.environ.get('SQS_MAX_RETRIES', 5))
+        self.message_budget = int(os.environ.get('SQS_MESSAGE_BUDGET', 32768))
+        self.gzip = 'SQS_GZIP' in os.environ
+        self.flush_timeout = float(os.environ.get('SQS_FLUSH_TIMEOUT', 60))
+        self.events = Queue.Queue(int(os.environ.get('SQS_QUEUE_SIZE', 1000)))
+        self.counters = {
+            'queued': 0,
+            'sent': 0,
+            'dropped': 0,
+            'failed': 0,
+            'unsent': 0,
+            'batches': 0,
+            'clipped': 0,
+            'compressed': 0,
+        }
+        self.counters_lock = threading.Lock()
+        self.sender = threading.Thread(target=self._send_events)
+        self.sender.daemon = True
+        self.sender.start()
+
     def runner_on_failed(self, host, res, ignore_errors=False):
         if self.enable_sqs:
             if not ignore_errors:
@@ -113,6 +173,34 @@ class CallbackModule(CallbackBase):
             for s in ['changed', 'failures', 'ok', 'processed', 'skipped']:
                 d[s] = getattr(stats, s)
             self._send_queue_message(d, 'STATS')
+            self.flush()
+
+    def flush(self):
+        """
+        Waits up to SQS_FLUSH_TIMEOUT seconds for the sender
+        thread to send or give up on every queued event, then
+        stops it. The events still unsent are abandoned.
+        """
+        deadline = time.time() + self.flush_timeout
+        try:
+            self.events.put(self.STOP, timeout=self.flush_timeout)
+        except Queue.Full:
+            pass
+        self.sender.join(max(0, deadline - time.time()))
+        with self.counters_lock:
+            self.counters['unsent'] = (self.counters['queued'] - self.counters['sent']
+                                       - self.counters['failed'])
+        if self.sender.is_alive():
+            print >> sys.stderr, 'sqs callback: gave up waiting after ' \
+                '{}s'.format(self.flush_timeout)
+        if self.counters['dropped'] or self.counters['failed'] or self.counters['unsent']:
+            print >> sys.stderr, 'sqs callback: {dropped} events dropped, ' \
+                '{failed} failed to send, {unsent} left unsent, ' \
+                '{sent} sent'.format(**self.counters)
+
+    def _count(self, counter, n=1):
+        with self.counters_lock:
+            self.counters[counter] += n
 
     def _send_queue_message(self, msg, msg_type):
         if self.enable_sqs:
@@ -130,6 +218,8 @@ class CallbackModule(CallbackBase):
                     from_task = \
                         self.last_seen_ts[msg_type] - self.last_seen_ts['TASK']
                     payload['delta'] = from_task
+                # Work on a copy, the result belongs to ansible
+                payload[msg_type] = dict(payload[msg_type])
                 for output in ['stderr', 'stdout']:
                     if output in payload[msg_type]:
                         # only keep the last 1000 characters
@@ -144,12 +234,142 @@ class CallbackModule(CallbackBase):
                     # only keep the last 20 or so lines to avoid payload size errors
                     if len(payload[msg_type]['stdout_lines']) > 20:
                         payload[msg_type]['stdout_lines'] = ['(clipping) ... '] + payload[msg_type]['stdout_lines'][-20:]
-            while True:
-                try:
-                    self.sqs.send_message(self.queue, json.dumps(payload))
-                    break
-                except socket.gaierror as e:
-                    print 'socket.gaierror will retry: ' + e
-                    time.sleep(1)
-                except Exception as e:
-                    raise e
+            try:
+                self.events.put_nowait(self._encode_payload(payload, msg_type))
+                self._count('queued')
+            except Queue.Full:
+                self._count('dropped')
+
+    def _encode_payload(self, payload, msg_type):
+        """
+        Encodes a payload, clipping the long strings and lists
+        of its message until it fits in the message budget. If
+        it still doesn't and SQS_GZIP is set, it is gzipped and
+        sent as {"GZIP": <base64>}. A message that can't be
+        brought under the SQS limit is replaced by a note.
+        """
+        body = json.dumps(payload)
+        if len(body) <= self.message_budget:
+            return body
+
+        self._count('clipped')
+        for max_chars, max_items in self.CLIP_LIMITS:
+            payload[msg_type] = self._clip(payload[msg_type], max_chars, max_items)
+            body = json.dumps(payload)
+            if len(body) <= self.message_budget:
+                return body
+
+        if self.gzip:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressed = json.dumps({'GZIP': base64.b64encode(
+                compressor.compress(body) + compressor.flush())})
+            if len(compressed) < len(body):
+                body = compressed
+                if len(body) <= self.MAX_MESSAGE_BYTES:
+                    self._count('compressed')
+
+        if len(body) > self.MAX_MESSAGE_BYTES:
+            note = '(clipping) ... message of {} bytes dropped'.format(len(body))
+            if isinstance(payload[msg_type], dict):
+                message = {'msg': note}
+                for key in ['changed', 'invocation']:
+                    if key in payload[msg_type]:
+                        message[key] = payload[msg_type][key]
+                payload[msg_type] = message
+            else:
+                payload[msg_type] = note
+            body = json.dumps(payload)
+        return body
+
+    def _clip(self, value, max_chars, max_items):
+        """
+        Returns a copy of value with the strings longer than
+        max_chars and the lists longer than max_items, at any
+        depth, cut down to their last max_chars or max_items.
+        """
+        if isinstance(value, basestring):
+            if len(value) > max_chars:
+                return "(clipping) ... " + value[-max_chars:]
+            return value
+        if isinstance(value, dict):
+            return dict((key, self._clip(item, max_chars, max_items))
+                        for key, item in value.iteritems())
+        if isinstance(value, (list, tuple)):
+            if len(value) > max_items:
+                value = ['(clipping) ... '] + list(value[-max_items:])
+            return [self._clip(item, max_chars, max_items) for item in value]
+        return value
+
+    def _next_batch(self, body=None):
+        """
+        Starts a batch with body, or waits for an event, then adds
+        the events already queued behind it, up to the
+        SendMessageBatch limits. Returns the batch and the event
+        that didn't fit in it, if any. The batch is empty once
+        the flush has queued STOP.
+        """
+        if body is None:
+            body = self.events.get()
+        if body is self.STOP:
+            return [], None
+        batch = [body]
+        size = len(body)
+        while len(batch) < self.BATCH_MESSAGES:
+            try:
+                body = self.events.get_nowait()
+            except Queue.Empty:
+                break
+            if body is self.STOP or size + len(body) > self.BATCH_BYTES:
+                return batch, body
+            batch.append(body)
+            size += len(body)
+        return batch, None
+
+    def _send_events(self):
+        """
+        Runs in the sender thread, sending batches of events
+        until the flush stops it.
+        """
+        left_over = None
+        while True:
+            batch, left_over = self._next_batch(left_over)
+            if not batch:
+                return
+            try:
+                self._send_batch(batch)
+            except Exception as e:
+                print >> sys.stderr, 'sqs callback: unable to send ' \
+                    '{} events: {}'.format(len(batch), e)
+                self._count('failed', len(batch))
+
+    def _send_batch(self, batch):
+        """
+        Sends a batch of message bodies, retrying the ones that
+        fail with exponential backoff.
+        """
+        entries = dict((str(i), body) for i, body in enumerate(batch))
+        for attempt in range(self.max_retries):
+            if attempt:
+                time.sleep(min(0.5 * 2 ** (attempt - 1), 30))
+            try:
+                result = self.sqs.send_message_batch(
+                    self.queue,
+                    [(id, body, 0) for id, body in sorted(entries.items())])
+            except (socket.error, boto.exception.BotoServerError) as e:
+                print >> sys.stderr, 'sqs callback: will retry: {}'.format(e)
+                continue
+            self._count('batches')
+            for entry in result.results:
+                del entries[entry['id']]
+            self._count('sent', len(result.results))
+            for entry in result.errors:
+                if entry.get('sender_fault') == 'true':
+                    # e.g. a message over the size limit, which
+                    # would fail again
+                    print >> sys.stderr, 'sqs callback: dropping ' \
+                        'event: {}'.format(entry.get('error_message'))
+                    del entries[entry['id']]
+                    self._count('failed')
+            if not entries:
+                return
+        self._count('failed', len(entries))
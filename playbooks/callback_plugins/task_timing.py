@@ -1,11 +1,17 @@
+import atexit
 import collections
 from datetime import datetime, timedelta
+import fcntl
 import json
 import logging
+import math
 import os
 from os.path import splitext, basename, exists, dirname
 import sys
+import tempfile
+import threading
 import time
+import Queue
 
 try:
     from ansible.plugins.callback import CallbackBase
@@ -14,6 +20,8 @@ except ImportError:
     CallbackBase = object
 
 import datadog
+from datadog.dogstatsd.base import DogStatsd
+from datadog.util.hostname import get_hostname
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logging.getLogger("requests").setLevel(logging.WARNING)
@@ -27,21 +35,78 @@ Originally written by 'Jharrod LaFon'
 """
 
 ANSIBLE_TIMER_LOG = os.environ.get('ANSIBLE_TIMER_LOG')
+ANSIBLE_TRACE_LOG = os.environ.get('ANSIBLE_TRACE_LOG')
+ANSIBLE_PROMETHEUS_FILE = os.environ.get('ANSIBLE_PROMETHEUS_FILE')
+
+
+def _monotonic_clock():
+    """
+    Return a function reading a monotonic clock in seconds.
+
+    That is time.monotonic where it exists, clock_gettime(CLOCK_MONOTONIC)
+    through ctypes on python 2, and time.time, which jumps with the
+    system clock, if neither can be used.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        clock_monotonic = 6 if sys.platform == 'darwin' else 1
+        for library in ('c', 'rt'):
+            clock_gettime = getattr(ctypes.CDLL(ctypes.util.find_library(library)), 'clock_gettime', None)
+            if clock_gettime:
+                break
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            now = timespec()
+            if clock_gettime(clock_monotonic, ctypes.byref(now)) != 0:
+                raise OSError("clock_gettime failed")
+            return now.tv_sec + now.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _monotonic_clock()
 
 
 class Timestamp(object):
     """
     A class for capturing start, end and duration for an action.
+
+    The start is the wall clock time, the duration is measured with a
+    monotonic clock, and the end is the start plus the duration.
     """
-    def __init__(self):
-        self.start = datetime.utcnow()
+    def __init__(self, since=None):
+        """
+        Arguments:
+            since (Timestamp): start at the start of this Timestamp
+                rather than now.
+        """
+        if since is None:
+            self.start = datetime.utcnow()
+            self.clock_start = monotonic()
+        else:
+            self.start = since.start
+            self.clock_start = since.clock_start
         self.end = None
+        self.clock_end = None
 
-    def stop(self):
+    def stop(self, clock_end=None):
         """
-        Record the end time of the timed period.
+        Record the end time of the timed period: now, or the given
+        reading of the monotonic clock.
         """
-        self.end = datetime.utcnow()
+        self.clock_end = monotonic() if clock_end is None else clock_end
+        self.end = self.start + timedelta(seconds=self.clock_end - self.clock_start)
 
     @property
     def duration(self):
@@ -51,6 +116,104 @@ class Timestamp(object):
         return self.end - self.start
 
 
+def percentile(values, fraction):
+    """
+    Return the nearest-rank percentile of a list of numbers, e.g. the
+    median for a fraction of 0.5, or None for an empty list.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+class TaskTimestamp(Timestamp):
+    """
+    A Timestamp for a task that also times the task on each host.
+
+    A host's time starts when ansible starts running the task on it, or
+    with the task on versions of ansible that don't report that, and ends
+    when its result comes back. The task ends when the last host's does,
+    so the time the controller spends between tasks isn't counted.
+    """
+    def __init__(self, play=None, handler=False):
+        super(TaskTimestamp, self).__init__()
+        self.play = play
+        self.handler = handler
+        # host name -> Timestamp
+        self.hosts = {}
+        # host name -> ok, changed, failed, skipped or unreachable
+        self.statuses = {}
+
+    def host_started(self, host):
+        """
+        Record the start of the task on a host.
+        """
+        self.hosts[host] = Timestamp()
+
+    def host_finished(self, host, status):
+        """
+        Record the result of the task on a host.
+        """
+        if host not in self.hosts or self.hosts[host].end is not None:
+            self.hosts[host] = Timestamp(since=self)
+        self.hosts[host].stop()
+        self.statuses[host] = status
+
+    def stop(self, clock_end=None):
+        finished = [timestamp.clock_end for timestamp in self.hosts.values() if timestamp.end is not None]
+        if clock_end is None and finished:
+            clock_end = max(finished)
+        super(TaskTimestamp, self).stop(clock_end)
+
+    @property
+    def host_durations(self):
+        """
+        Return a dict of the seconds the task took on each host that
+        finished it.
+        """
+        return dict(
+            (host, timestamp.duration.total_seconds())
+            for host, timestamp in self.hosts.items()
+            if timestamp.end is not None
+        )
+
+    @property
+    def p50(self):
+        """
+        Return the median seconds the task took on a host.
+        """
+        return percentile(self.host_durations.values(), 0.5)
+
+    @property
+    def max(self):
+        """
+        Return the most seconds the task took on a host.
+        """
+        durations = self.host_durations.values()
+        return max(durations) if durations else None
+
+    @property
+    def straggler(self):
+        """
+        Return the host the task took the longest on.
+        """
+        durations = self.host_durations
+        if not durations:
+            return None
+        return max(sorted(durations), key=durations.get)
+
+
+def logged_state(timestamp):
+    """
+    Return what loggers compare to tell whether a task changed after they
+    logged it: its end, and the number of hosts that finished it. Under the
+    free strategy, hosts can still be running a task when the next one
+    starts and the task is logged.
+    """
+    return (timestamp.clock_end, len(getattr(timestamp, 'statuses', ())))
+
+
 # This class only has a single method (which would ordinarily make it a
 # candidate to be turned into a function). However, the TimingLoggers are
 # instanciated once when ansible starts up, and then called for every play.
@@ -58,6 +221,32 @@ class TimingLogger(object):
     """
     Base-class for logging timing about ansible tasks and plays.
     """
+    def start_play(self, playbook_name, playbook_timestamp):
+        """
+        Record the start of an ansible play.
+
+        Arguments:
+            playbook_name: the name of the playbook being logged.
+            playbook_timestamp (Timestamp): the timestamp of the start of
+                the play.
+        """
+        pass
+
+    def log_task(self, playbook_name, name, timestamp):
+        """
+        Record the timing of a task as soon as it has finished, for loggers
+        that don't wait for the end of the play. Results that come back
+        after that are only in the Timestamp by log_play, compare
+        logged_state.
+
+        Arguments:
+            playbook_name: the name of the playbook being logged.
+            name: the name of the task.
+            timestamp (Timestamp): the timestamps measuring how long the
+                task took; a TaskTimestamp with ansible 2.
+        """
+        pass
+
     def log_play(self, playbook_name, playbook_timestamp, results):
         """
         Record the timing results of an ansible play.
@@ -67,7 +256,9 @@ class TimingLogger(object):
             playbook_timestamp (Timestamp): the timestamps measuring how
                 long the play took.
             results (dict(string -> Timestamp)): a dict mapping task names
-                to Timestamps that measure how long each task took.
+                to Timestamps that measure how long each task took. With
+                ansible 2, they are TaskTimestamps that also time the task
+                on each host.
         """
         pass
 
@@ -76,22 +267,61 @@ class DatadogTimingLogger(TimingLogger):
     """
     Record ansible task and play timing to Datadog.
 
-    Requires that the environment variable DATADOG_API_KEY be set in order
-    to log any data.
+    If the environment variable DATADOG_STATSD_HOST is set, the timings are
+    sent to DogStatsD at that host and DATADOG_STATSD_PORT (default 8125)
+    over UDP, as each task finishes.
+
+    Otherwise the environment variable DATADOG_API_KEY must be set in order
+    to log any data. The timings are posted to the Datadog API (DATADOG_HOST,
+    as for the datadog library) from a background thread, in payloads of at
+    most DATADOG_MAX_PAYLOAD bytes (default 256KiB), as they add up. The end
+    of the play waits at most DATADOG_FLUSH_TIMEOUT seconds (default 30) for
+    them to be sent.
+
+    A task that gets more results after it was sent, under the free
+    strategy, is sent again at the end of the play. Through the API, the
+    points keep the time they were first sent at, so the new values replace
+    the old ones; through DogStatsD, they are new points.
     """
+    STOP = object()
+    # Bytes of a payload around its metrics
+    ENVELOPE = len(json.dumps({'series': []}))
+
     def __init__(self):
         super(DatadogTimingLogger, self).__init__()
 
         self.datadog_api_key = os.getenv('DATADOG_API_KEY')
         self.datadog_api_initialized = False
+        self.statsd = None
+        self.host_name = None
 
-        if self.datadog_api_key:
+        if os.getenv('DATADOG_STATSD_HOST'):
+            self.statsd = DogStatsd(
+                host=os.getenv('DATADOG_STATSD_HOST'),
+                port=int(os.getenv('DATADOG_STATSD_PORT', 8125)),
+            )
+        elif self.datadog_api_key:
+            # The host name is set on each metric rather than left to the
+            # API client, so that the size of the payloads can be measured
+            self.host_name = get_hostname()
             datadog.initialize(
                 api_key=self.datadog_api_key,
-                app_key=None
+                app_key=None,
+                host_name=self.host_name,
             )
             self.datadog_api_initialized = True
 
+        self.max_payload = int(os.getenv('DATADOG_MAX_PAYLOAD', 256 * 1024))
+        self.flush_timeout = float(os.getenv('DATADOG_FLUSH_TIMEOUT', 30))
+        # Metrics waiting to fill a payload, and its size
+        self.pending = []
+        self.pending_size = 0
+        self.payloads = Queue.Queue()
+        self.sender = None
+        # Timestamps of the tasks already logged -> their logged_state, and
+        # the playbook name and task name and time they were sent with
+        self.logged = {}
+
     def clean_tag_value(self, value):
         """
         Remove any characters that aren't allowed in Datadog tags.
@@ -101,31 +331,135 @@ class DatadogTimingLogger(TimingLogger):
         """
         return value.replace(" | ", ".").replace(" ", "-").lower()
 
+    def metric(self, metric, timestamp, sent_at, value, tags):
+        """
+        Return a metric in the format of the Metric API, with a single point
+        at sent_at.
+        """
+        return {
+            'metric': metric,
+            'date_happened': time.mktime(timestamp.start.timetuple()),
+            'points': [(sent_at, value)],
+            'tags': tags,
+            'host': self.host_name,
+        }
+
+    def task_metrics(self, playbook_name, name, timestamp, sent_at):
+        """
+        Return the metrics of a task.
+        """
+        tags = [
+            'task:{0}'.format(self.clean_tag_value(name)),
+            'playbook:{0}'.format(self.clean_tag_value(playbook_name))
+        ]
+        metrics = [
+            self.metric('edx.ansible.task_duration', timestamp, sent_at, timestamp.duration.total_seconds(), tags),
+        ]
+        if getattr(timestamp, 'host_durations', None):
+            # How long the task took on a typical host and on the slowest
+            for metric, value in [('p50', timestamp.p50), ('max', timestamp.max)]:
+                metrics.append(self.metric(
+                    'edx.ansible.task_host_duration.{0}'.format(metric), timestamp, sent_at, value, tags))
+        return metrics
+
+    def log_task(self, playbook_name, name, timestamp):
+        if self.statsd is None and not self.datadog_api_initialized:
+            return
+
+        sent_at = time.time()
+        self.logged[timestamp] = (logged_state(timestamp), playbook_name, name, sent_at)
+        self.send(self.task_metrics(playbook_name, name, timestamp, sent_at))
+
     def log_play(self, playbook_name, playbook_timestamp, results):
-        if not self.datadog_api_initialized:
+        if self.statsd is None and not self.datadog_api_initialized:
             return
 
-        datadog_tasks_metrics = []
+        metrics = []
+        now = time.time()
         for name, timestamp in results.items():
-            datadog_tasks_metrics.append({
-                'metric': 'edx.ansible.task_duration',
-                'date_happened': time.mktime(timestamp.start.timetuple()),
-                'points': timestamp.duration.total_seconds(),
-                'tags': [
-                    'task:{0}'.format(self.clean_tag_value(name)),
-                    'playbook:{0}'.format(self.clean_tag_value(playbook_name))
-                ]
-            })
-        try:
-            datadog.api.Metric.send(datadog_tasks_metrics)
-            datadog.api.Metric.send(
-                metric="edx.ansible.playbook_duration",
-                date_happened=time.mktime(playbook_timestamp.start.timetuple()),
-                points=playbook_timestamp.duration.total_seconds(),
-                tags=["playbook:{0}".format(self.clean_tag_value(playbook_name))]
+            if timestamp not in self.logged:
+                metrics.extend(self.task_metrics(playbook_name, name, timestamp, now))
+                continue
+            (state, task_playbook_name, task_name, sent_at) = self.logged[timestamp]
+            if state != logged_state(timestamp):
+                metrics.extend(self.task_metrics(task_playbook_name, task_name, timestamp, sent_at))
+        metrics.append(self.metric(
+            'edx.ansible.playbook_duration', playbook_timestamp, now,
+            playbook_timestamp.duration.total_seconds(),
+            ["playbook:{0}".format(self.clean_tag_value(playbook_name))],
+        ))
+        self.send(metrics)
+        self.logged.clear()
+        self.flush()
+
+    def send(self, metrics):
+        """
+        Send metrics to DogStatsD, or add them to the payloads for the API.
+        """
+        if self.statsd is not None:
+            # Gauges, so the agent keeps the metric names; a histogram
+            # would be published as .avg, .max, .median and so on
+            for metric in metrics:
+                try:
+                    self.statsd.gauge(metric['metric'], metric['points'][0][1], tags=metric['tags'])
+                except Exception:
+                    LOGGER.exception("Failed to log timing data to datadog")
+            return
+
+        room = self.max_payload - self.ENVELOPE
+        for metric in metrics:
+            # As the API client serializes it, in a {"series": [...]} list
+            size = len(json.dumps(metric)) + len(', ')
+            if self.pending and self.pending_size + size > room:
+                self.queue_payload()
+            self.pending.append(metric)
+            self.pending_size += size
+        if self.pending_size >= room:
+            self.queue_payload()
+
+    def queue_payload(self):
+        """
+        Hand the pending metrics to the background thread to post.
+        """
+        if self.sender is None:
+            self.sender = threading.Thread(
+                target=self.post_payloads, args=(self.payloads,), name='datadog-timing')
+            self.sender.daemon = True
+            self.sender.start()
+        self.payloads.put(self.pending)
+        self.pending = []
+        self.pending_size = 0
+
+    def post_payloads(self, payloads):
+        while True:
+            payload = payloads.get()
+            if payload is self.STOP:
+                return
+            try:
+                datadog.api.Metric.send(payload)
+            except Exception:
+                LOGGER.exception("Failed to log timing data to datadog")
+
+    def flush(self):
+        """
+        Post the pending metrics and wait, at most flush_timeout seconds,
+        for the background thread to post everything.
+        """
+        if self.statsd is not None:
+            return
+        if self.pending:
+            self.queue_payload()
+        if self.sender is None:
+            return
+        self.payloads.put(self.STOP)
+        self.sender.join(self.flush_timeout)
+        if self.sender.is_alive():
+            LOGGER.warning(
+                "Gave up waiting for datadog after %s seconds, %d payloads not sent",
+                self.flush_timeout, self.payloads.qsize()
             )
-        except Exception:
-            LOGGER.exception("Failed to log timing data to datadog")
+        self.sender = None
+        self.payloads = Queue.Queue()
 
 
 class JsonTimingLogger(TimingLogger):
@@ -136,7 +470,70 @@ class JsonTimingLogger(TimingLogger):
     to log any data. This specifies the file that timing data should be logged
     to. That variable can include strftime interpolation variables,
     which will be replaced with the start time of the play.
+
+    A record is written for each task as it finishes, so a run that is killed
+    still leaves the timing of the tasks it got through, and one for the
+    playbook at the end. A task whose hosts were still running when it was
+    logged, as under the free strategy, is logged again at the end of the
+    play, the record also giving the duration it replaces under 'revises'.
+    Records are buffered and written together once
+    ANSIBLE_TIMER_LOG_BATCH (default 100) of them are waiting, or
+    ANSIBLE_TIMER_LOG_FLUSH_INTERVAL seconds (default 5) after the first one,
+    whichever comes first, and when ansible exits.
+
+    If ANSIBLE_TIMER_LOG_MAX_BYTES is set, a file that would grow past it is
+    first renamed with a .1 suffix, the older ones moving up to .2 and so on,
+    keeping ANSIBLE_TIMER_LOG_BACKUPS (default 5) of them.
     """
+    def __init__(self):
+        super(JsonTimingLogger, self).__init__()
+        self.batch = int(os.getenv('ANSIBLE_TIMER_LOG_BATCH', 100))
+        self.flush_interval = float(os.getenv('ANSIBLE_TIMER_LOG_FLUSH_INTERVAL', 5))
+        self.max_bytes = int(os.getenv('ANSIBLE_TIMER_LOG_MAX_BYTES', 0))
+        self.backups = int(os.getenv('ANSIBLE_TIMER_LOG_BACKUPS', 5))
+        self.log_path = None
+        # Lines waiting to be written, with the path to write them to
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.flush_timer = None
+        # Timestamp of each task already logged -> its logged_state, the
+        # playbook and task names and the duration it was logged with
+        self.logged = {}
+        if ANSIBLE_TIMER_LOG is not None:
+            atexit.register(self.flush)
+
+    def start_play(self, playbook_name, playbook_timestamp):
+        # The first play of the run picks the file
+        if ANSIBLE_TIMER_LOG is not None and self.log_path is None:
+            self.log_path = playbook_timestamp.start.strftime(ANSIBLE_TIMER_LOG)
+
+    def task_message(self, playbook_name, name, timestamp):
+        message = {
+            'task': name,
+            'playbook': playbook_name,
+            'started_at': timestamp.start.isoformat(),
+            'ended_at': timestamp.end.isoformat(),
+            'duration': timestamp.duration.total_seconds(),
+        }
+        if getattr(timestamp, 'host_durations', None):
+            message.update({
+                'hosts': timestamp.host_durations,
+                'p50': timestamp.p50,
+                'max': timestamp.max,
+                'straggler': timestamp.straggler,
+            })
+        return message
+
+    def log_task(self, playbook_name, name, timestamp):
+        if ANSIBLE_TIMER_LOG is None:
+            return
+
+        message = self.task_message(playbook_name, name, timestamp)
+        self.logged[timestamp] = (logged_state(timestamp), playbook_name, name, message['duration'])
+        if self.log_path is None:
+            self.log_path = timestamp.start.strftime(ANSIBLE_TIMER_LOG)
+        self.write([message])
+
     def log_play(self, playbook_name, playbook_timestamp, results):
         # N.B. This is intended to provide a consistent interface and message
         # format across all of Open edX tooling, so it deliberately eschews
@@ -146,39 +543,106 @@ class JsonTimingLogger(TimingLogger):
 
         messages = []
         for name, timestamp in results.items():
-            messages.append({
-                'task': name,
-                'playbook': playbook_name,
-                'started_at': timestamp.start.isoformat(),
-                'ended_at': timestamp.end.isoformat(),
-                'duration': timestamp.duration.total_seconds(),
-            })
+            if timestamp not in self.logged:
+                messages.append(self.task_message(playbook_name, name, timestamp))
+                continue
+            (state, task_playbook_name, task_name, duration) = self.logged[timestamp]
+            if state != logged_state(timestamp):
+                message = self.task_message(task_playbook_name, task_name, timestamp)
+                message['revises'] = duration
+                messages.append(message)
 
         messages.append({
             'playbook': playbook_name,
             'started_at': playbook_timestamp.start.isoformat(),
             'ended_at': playbook_timestamp.end.isoformat(),
             'duration': playbook_timestamp.duration.total_seconds(),
+            'tasks': len(results),
         })
 
-        log_path = playbook_timestamp.start.strftime(ANSIBLE_TIMER_LOG)
+        if self.log_path is None:
+            self.log_path = playbook_timestamp.start.strftime(ANSIBLE_TIMER_LOG)
+        self.write(messages)
+        self.flush()
+        self.logged.clear()
+        self.log_path = None
 
-        try:
-            log_dir = dirname(log_path)
-            if log_dir and not exists(log_dir):
-                os.makedirs(log_dir)
+    def write(self, messages):
+        """
+        Add messages to the buffer, writing it out if it is full. A timer
+        writes it out once flush_interval has passed otherwise.
+        """
+        lines = [
+            json.dumps(message, separators=(',', ':'), sort_keys=True) + '\n'
+            for message in messages
+        ]
+        with self.buffer_lock:
+            self.buffer.append((self.log_path, lines))
+            waiting = sum(len(lines) for _, lines in self.buffer)
+            if waiting < self.batch and self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+        if waiting >= self.batch:
+            self.flush()
 
-            with open(log_path, 'a') as outfile:
-                for log_message in messages:
-                    json.dump(
-                        log_message,
-                        outfile,
-                        separators=(',', ':'),
-                        sort_keys=True,
-                    )
-                    outfile.write('\n')
-        except Exception:
-            LOGGER.exception("Unable to write json timing log messages")
+    def flush(self):
+        """
+        Write out the buffered lines.
+        """
+        with self.buffer_lock:
+            buffered, self.buffer = self.buffer, []
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            by_path = collections.OrderedDict()
+            for log_path, lines in buffered:
+                by_path.setdefault(log_path, []).extend(lines)
+            for log_path, lines in by_path.items():
+                try:
+                    self.append(log_path, ''.join(lines))
+                except Exception:
+                    LOGGER.exception("Unable to write json timing log messages")
+
+    def append(self, log_path, data):
+        """
+        Append data to log_path in a single write, rotating the file first if
+        it would grow past max_bytes. The file is locked while doing so, as
+        several runs can share a log.
+        """
+        log_dir = dirname(log_path)
+        if log_dir and not exists(log_dir):
+            os.makedirs(log_dir)
+
+        while True:
+            outfile = open(log_path, 'a')
+            try:
+                fcntl.flock(outfile, fcntl.LOCK_EX)
+                size = os.fstat(outfile.fileno()).st_size
+                if not exists(log_path) or os.stat(log_path).st_ino != os.fstat(outfile.fileno()).st_ino:
+                    # Another run rotated the file while this one waited
+                    continue
+                if self.max_bytes and size and size + len(data) > self.max_bytes:
+                    self.rotate(log_path)
+                    continue
+                outfile.write(data)
+                return
+            finally:
+                outfile.close()
+
+    def rotate(self, log_path):
+        """
+        Rename log_path to log_path.1, after moving up the older files.
+        """
+        for backup in range(self.backups - 1, 0, -1):
+            older = '{0}.{1}'.format(log_path, backup)
+            if exists(older):
+                os.rename(older, '{0}.{1}'.format(log_path, backup + 1))
+        if self.backups > 0:
+            os.rename(log_path, log_path + '.1')
+        else:
+            os.remove(log_path)
 
 
 class LoggingTimingLogger(TimingLogger):
@@ -201,6 +665,15 @@ class LoggingTimingLogger(TimingLogger):
                     ' {0:.02f}s'.format(timestamp.duration.total_seconds()),
                 )
             )
+            if len(getattr(timestamp, 'host_durations', ())) > 1:
+                LOGGER.info(
+                    "    {0} hosts, p50 {1:.02f}s, max {2:.02f}s on {3}".format(
+                        len(timestamp.host_durations),
+                        timestamp.p50,
+                        timestamp.max,
+                        timestamp.straggler,
+                    )
+                )
 
         LOGGER.info(
             "\nPlaybook %s finished: %s, %d total tasks.  %s elapsed. \n",
@@ -211,6 +684,369 @@ class LoggingTimingLogger(TimingLogger):
         )
 
 
+class ChromeTraceTimingLogger(TimingLogger):
+    """
+    Record the timing of each task on each host to a file in the Chrome
+    Trace Event Format, to be opened in chrome://tracing or Perfetto.
+
+    Each play is a process with a lane per host, holding a span per task
+    and handler that ran on it. A "forks" process shows the same spans
+    packed onto as many lanes as ansible ran at once, so gaps in it are
+    forks sitting idle. Before ansible 2.8, which reports when a task
+    starts on each host, every host's span starts with the task, so time
+    spent waiting for a fork shows as running.
+
+    The file also holds a summary of the critical path, the chain of
+    spans, each ending before the next starts, that runs back from the
+    end of the playbook, and of the idle time of each fork.
+
+    Requires that the environment variable ANSIBLE_TRACE_LOG be set to the
+    file to write. It can include strftime interpolation variables, which
+    will be replaced with the start time of the play.
+    """
+    def log_play(self, playbook_name, playbook_timestamp, results):
+        if ANSIBLE_TRACE_LOG is None:
+            return
+
+        spans = self.spans(playbook_name, results)
+        origin = min([playbook_timestamp.clock_start] + [span['start'] for span in spans])
+        end = max([playbook_timestamp.clock_end] + [span['end'] for span in spans])
+        forks = self.assign_forks(spans)
+
+        trace = {
+            'traceEvents': self.trace_events(spans, origin),
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'playbook': playbook_name,
+                'started_at': playbook_timestamp.start.isoformat(),
+                'duration': end - origin,
+                'critical_path': self.critical_path(spans, origin, end),
+                'forks': [
+                    {'fork': fork, 'busy': busy, 'idle': (end - origin) - busy}
+                    for fork, busy in enumerate(forks)
+                ],
+            },
+        }
+
+        log_path = playbook_timestamp.start.strftime(ANSIBLE_TRACE_LOG)
+        try:
+            log_dir = dirname(log_path)
+            if log_dir and not exists(log_dir):
+                os.makedirs(log_dir)
+
+            with open(log_path, 'w') as outfile:
+                json.dump(trace, outfile, separators=(',', ':'), sort_keys=True)
+        except Exception:
+            LOGGER.exception("Unable to write the trace of the playbook")
+
+    def spans(self, playbook_name, results):
+        """
+        Return a span per task and host, or per task for Timestamps
+        without hosts, as dicts of the play, lane, name, category, status
+        and the monotonic clock start and end.
+        """
+        spans = []
+        for name, timestamp in results.items():
+            play = getattr(timestamp, 'play', None) or playbook_name
+            category = 'handler' if getattr(timestamp, 'handler', False) else 'task'
+            hosts = getattr(timestamp, 'hosts', {})
+            if not hosts:
+                spans.append({
+                    'play': play, 'lane': 'tasks', 'name': name, 'category': category, 'status': None,
+                    'start': timestamp.clock_start, 'end': timestamp.clock_end,
+                })
+            for host, host_timestamp in hosts.items():
+                if host_timestamp.end is None:
+                    continue
+                spans.append({
+                    'play': play, 'lane': host, 'name': name, 'category': category,
+                    'status': timestamp.statuses.get(host),
+                    'start': host_timestamp.clock_start, 'end': host_timestamp.clock_end,
+                })
+        spans.sort(key=lambda span: (span['start'], span['end']))
+        return spans
+
+    def assign_forks(self, spans):
+        """
+        Pack the spans onto the fewest lanes that fit them, the way
+        ansible's forks run them, setting each span's fork. Return the
+        busy seconds of each fork.
+        """
+        free_at = []
+        busy = []
+        for span in spans:
+            if span['lane'] == 'tasks':
+                continue
+            for fork, fork_free_at in enumerate(free_at):
+                if fork_free_at <= span['start']:
+                    break
+            else:
+                fork = len(free_at)
+                free_at.append(None)
+                busy.append(0)
+            span['fork'] = fork
+            free_at[fork] = span['end']
+            busy[fork] += span['end'] - span['start']
+        return busy
+
+    def critical_path(self, spans, origin, end):
+        """
+        Return the chain of spans that runs back from the end of the
+        playbook, each the last to end before the next one started, with
+        the wall clock time it covers and the gaps between its spans,
+        which is time spent in the controller.
+        """
+        path = []
+        remaining = sorted(spans, key=lambda span: span['end'])
+        cursor = end
+        while remaining:
+            while remaining and remaining[-1]['end'] > cursor:
+                remaining.pop()
+            if not remaining:
+                break
+            span = remaining.pop()
+            path.append(span)
+            cursor = span['start']
+        path.reverse()
+
+        busy = sum(span['end'] - span['start'] for span in path)
+        return {
+            'busy': busy,
+            'gaps': (end - origin) - busy,
+            'spans': [
+                {
+                    'task': span['name'],
+                    'host': span['lane'],
+                    'play': span['play'],
+                    'start': span['start'] - origin,
+                    'duration': span['end'] - span['start'],
+                }
+                for span in path
+            ],
+        }
+
+    def trace_events(self, spans, origin):
+        """
+        Return the trace events of the spans, with times in microseconds
+        since origin.
+        """
+        plays = []
+        lanes = {}
+        events = []
+
+        def lane(pid, name, sort_index):
+            if (pid, name) not in lanes:
+                lanes[(pid, name)] = len(lanes) + 1
+                events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': lanes[(pid, name)],
+                               'args': {'name': name}})
+                events.append({'ph': 'M', 'name': 'thread_sort_index', 'pid': pid, 'tid': lanes[(pid, name)],
+                               'args': {'sort_index': sort_index}})
+            return lanes[(pid, name)]
+
+        for span in spans:
+            if span['play'] not in plays:
+                plays.append(span['play'])
+                events.append({'ph': 'M', 'name': 'process_name', 'pid': len(plays),
+                               'args': {'name': 'play: {0}'.format(span['play'])}})
+            pid = plays.index(span['play']) + 1
+            event = {
+                'ph': 'X',
+                'name': span['name'],
+                'cat': span['category'],
+                'pid': pid,
+                'tid': lane(pid, span['lane'], 0),
+                'ts': int((span['start'] - origin) * 1e6),
+                'dur': int((span['end'] - span['start']) * 1e6),
+                'args': {'status': span['status']},
+            }
+            events.append(event)
+            if 'fork' in span:
+                events.append(dict(
+                    event,
+                    name='{0} @ {1}'.format(span['name'], span['lane']),
+                    pid=0,
+                    tid=lane(0, 'fork {0}'.format(span['fork']), span['fork']),
+                ))
+
+        if any('fork' in span for span in spans):
+            events.append({'ph': 'M', 'name': 'process_name', 'pid': 0, 'args': {'name': 'forks'}})
+        return events
+
+
+class PrometheusTimingLogger(TimingLogger):
+    """
+    Record task and play timing to a file in the Prometheus text format, for
+    node_exporter's textfile collector to serve.
+
+    Requires that the environment variable ANSIBLE_PROMETHEUS_FILE be set to
+    the file to write, which should end in .prom. It holds:
+
+        ansible_task_duration_seconds               a histogram per playbook
+                                                    and task
+        ansible_playbook_duration_seconds           the duration of the last
+                                                    run of each playbook
+        ansible_playbook_last_run_timestamp_seconds when it ended
+        ansible_play_host_results_total             the ok, changed, failed,
+                                                    skipped and unreachable
+                                                    results per play
+
+    The histograms and counters add up over all the runs that write to the
+    file, so their state is kept in a .json file next to it, which the
+    collector ignores. Both are locked while they are updated, and the .prom
+    file is replaced in one rename, so the collector never reads half of it.
+
+    ANSIBLE_PROMETHEUS_BUCKETS sets the histogram buckets, in seconds, as a
+    comma separated list. Changing them starts the histograms over.
+    """
+    DEFAULT_BUCKETS = '1,5,10,30,60,120,300,600,1800'
+
+    def __init__(self):
+        super(PrometheusTimingLogger, self).__init__()
+        self.buckets = sorted(
+            float(bucket) for bucket in os.getenv('ANSIBLE_PROMETHEUS_BUCKETS', self.DEFAULT_BUCKETS).split(',')
+        )
+        # Timestamp of each task of the play -> its playbook and task names.
+        # They are only counted at the end of the play, as hosts can still
+        # be running a task when it is logged.
+        self.tasks = {}
+        # (playbook, task) -> [durations], and (playbook, play, status) -> count
+        self.durations = collections.defaultdict(list)
+        self.results = collections.Counter()
+
+    def log_task(self, playbook_name, name, timestamp):
+        if ANSIBLE_PROMETHEUS_FILE is None:
+            return
+
+        self.tasks[timestamp] = (playbook_name, name)
+
+    def log_play(self, playbook_name, playbook_timestamp, results):
+        if ANSIBLE_PROMETHEUS_FILE is None:
+            return
+
+        for name, timestamp in results.items():
+            self.tasks.setdefault(timestamp, (playbook_name, name))
+        for timestamp, (task_playbook_name, name) in self.tasks.items():
+            self.durations[(task_playbook_name, name)].append(timestamp.duration.total_seconds())
+            play = getattr(timestamp, 'play', None) or task_playbook_name
+            for status in getattr(timestamp, 'statuses', {}).values():
+                self.results[(task_playbook_name, play, status)] += 1
+
+        try:
+            self.update(playbook_name, playbook_timestamp)
+        except Exception:
+            LOGGER.exception("Unable to write the prometheus timing metrics")
+        self.tasks.clear()
+        self.durations.clear()
+        self.results.clear()
+
+    def update(self, playbook_name, playbook_timestamp):
+        """
+        Add this run to the state file and rewrite the .prom file from it.
+        """
+        prom_dir = dirname(os.path.abspath(ANSIBLE_PROMETHEUS_FILE))
+        if not exists(prom_dir):
+            os.makedirs(prom_dir)
+
+        state_path = splitext(ANSIBLE_PROMETHEUS_FILE)[0] + '.json'
+        with open(state_path, 'a+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            try:
+                state = json.load(state_file)
+            except ValueError:
+                state = {}
+            if state.get('buckets') != self.buckets:
+                state = {'buckets': self.buckets}
+
+            histograms = state.setdefault('tasks', {})
+            for (playbook, task), durations in self.durations.items():
+                key = json.dumps([playbook, task])
+                histogram = histograms.setdefault(key, {'counts': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+                for duration in durations:
+                    for index, bucket in enumerate(self.buckets):
+                        if duration <= bucket:
+                            histogram['counts'][index] += 1
+                    histogram['sum'] += duration
+                    histogram['count'] += 1
+
+            counters = state.setdefault('results', {})
+            for key, count in self.results.items():
+                key = json.dumps(list(key))
+                counters[key] = counters.get(key, 0) + count
+
+            state.setdefault('playbooks', {})[playbook_name] = {
+                'duration': playbook_timestamp.duration.total_seconds(),
+                'ended_at': time.time(),
+            }
+
+            self.write_atomically(ANSIBLE_PROMETHEUS_FILE, self.format_state(state))
+            state_file.seek(0)
+            state_file.truncate()
+            json.dump(state, state_file, sort_keys=True)
+
+    def format_state(self, state):
+        """
+        Return the metrics of the state in the Prometheus text format, as
+        unicode, since task and playbook names can be non-ASCII.
+        """
+        def labels(**values):
+            return u','.join(
+                u'{0}="{1}"'.format(name, value.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n'))
+                for name, value in sorted(values.items())
+            )
+
+        lines = [
+            u'# HELP ansible_task_duration_seconds Time ansible tasks took, until the last host was done.',
+            u'# TYPE ansible_task_duration_seconds histogram',
+        ]
+        for key, histogram in sorted(state['tasks'].items()):
+            (playbook, task) = json.loads(key)
+            task_labels = labels(playbook=playbook, task=task)
+            for bucket, count in zip(state['buckets'], histogram['counts']):
+                lines.append(u'ansible_task_duration_seconds_bucket{{{0},le="{1:g}"}} {2}'.format(
+                    task_labels, bucket, count))
+            lines.append(u'ansible_task_duration_seconds_bucket{{{0},le="+Inf"}} {1}'.format(
+                task_labels, histogram['count']))
+            lines.append(u'ansible_task_duration_seconds_sum{{{0}}} {1:.6f}'.format(task_labels, histogram['sum']))
+            lines.append(u'ansible_task_duration_seconds_count{{{0}}} {1}'.format(task_labels, histogram['count']))
+
+        lines.append(u'# HELP ansible_playbook_duration_seconds Time the last run of the playbook took.')
+        lines.append(u'# TYPE ansible_playbook_duration_seconds gauge')
+        for playbook, run in sorted(state['playbooks'].items()):
+            lines.append(u'ansible_playbook_duration_seconds{{{0}}} {1:.6f}'.format(
+                labels(playbook=playbook), run['duration']))
+
+        lines.append(u'# HELP ansible_playbook_last_run_timestamp_seconds When the last run of the playbook ended.')
+        lines.append(u'# TYPE ansible_playbook_last_run_timestamp_seconds gauge')
+        for playbook, run in sorted(state['playbooks'].items()):
+            lines.append(u'ansible_playbook_last_run_timestamp_seconds{{{0}}} {1:.3f}'.format(
+                labels(playbook=playbook), run['ended_at']))
+
+        lines.append(u'# HELP ansible_play_host_results_total Results of tasks on hosts, per play and status.')
+        lines.append(u'# TYPE ansible_play_host_results_total counter')
+        for key, count in sorted(state['results'].items()):
+            (playbook, play, status) = json.loads(key)
+            lines.append(u'ansible_play_host_results_total{{{0}}} {1}'.format(
+                labels(playbook=playbook, play=play, status=status), count))
+
+        return u''.join(line + u'\n' for line in lines)
+
+    def write_atomically(self, path, text):
+        """
+        Replace path with text, encoded as UTF-8, through a temporary file in
+        the same directory.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(os.path.abspath(path)), prefix=basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                outfile.write(text.encode('utf-8'))
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
 class CallbackModule(CallbackBase):
 
     """
@@ -219,6 +1055,8 @@ class CallbackModule(CallbackBase):
     """
     def __init__(self):
         self.stats = collections.defaultdict(list)
+        # task uuid -> TaskTimestamp, for the v2 callbacks
+        self.task_timestamps = {}
         self.current_task = None
         self.playbook_name = None
         self.playbook_timestamp = None
@@ -228,6 +1066,8 @@ class CallbackModule(CallbackBase):
             DatadogTimingLogger(),
             LoggingTimingLogger(),
             JsonTimingLogger(),
+            ChromeTraceTimingLogger(),
+            PrometheusTimingLogger(),
         ]
 
     def v2_playbook_on_play_start(self, play):
@@ -238,23 +1078,77 @@ class CallbackModule(CallbackBase):
         """
         Record the start of a play.
         """
+        if self.current_task is not None:
+            # The last task of the previous play is logged under its name
+            self._stop_task()
+            self.current_task = None
+
         self.playbook_name, _ = splitext(
             basename(self.play.get_name())
         )
         self.playbook_timestamp = Timestamp()
+        for logger in self.loggers:
+            logger.start_play(self.playbook_name, self.playbook_timestamp)
 
     def playbook_on_task_start(self, name, is_conditional):
         """
         Logs the start of each task
         """
+        self._start_task(name, Timestamp())
 
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        if task._uuid in self.task_timestamps and getattr(self.play, 'strategy', None) == 'free':
+            # The free strategy reports the start of a task for each host
+            # that reaches it, which is still the same run of the task
+            return
+        self.task_timestamps[task._uuid] = TaskTimestamp(play=self.play.get_name())
+        self._start_task(task.name or task.get_name(), self.task_timestamps[task._uuid])
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.task_timestamps[task._uuid] = TaskTimestamp(play=self.play.get_name(), handler=True)
+        self._start_task(task.name or task.get_name(), self.task_timestamps[task._uuid])
+
+    def v2_runner_on_start(self, host, task):
+        """
+        Record the start of a task on a host. Only ansible 2.8 and later
+        call this.
+        """
+        if task._uuid in self.task_timestamps:
+            self.task_timestamps[task._uuid].host_started(host.get_name())
+
+    def v2_runner_on_ok(self, result):
+        self._finish_host(result, 'changed' if result._result.get('changed') else 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._finish_host(result, 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._finish_host(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._finish_host(result, 'unreachable')
+
+    def _start_task(self, name, timestamp):
         if self.current_task is not None:
             # Record the running time of the last executed task
-            self.stats[self.current_task][-1].stop()
+            self._stop_task()
 
         # Record the start time of the current task
         self.current_task = name
-        self.stats[self.current_task].append(Timestamp())
+        self.stats[self.current_task].append(timestamp)
+
+    def _stop_task(self):
+        timestamp = self.stats[self.current_task][-1]
+        timestamp.stop()
+        for logger in self.loggers:
+            logger.log_task(self.playbook_name, self.current_task, timestamp)
+
+    def _finish_host(self, result, status):
+        # Results are matched to their task rather than to the current
+        # one, which with the free strategy may have moved on.
+        timestamp = self.task_timestamps.get(result._task._uuid)
+        if timestamp is not None:
+            timestamp.host_finished(result._host.get_name(), status)
 
     def playbook_on_stats(self, stats):
         """
@@ -264,7 +1158,12 @@ class CallbackModule(CallbackBase):
         # Record the timing of the very last task, we use it here, because we
         # don't have stop task function by default
         if self.current_task is not None:
-            self.stats[self.current_task][-1].stop()
+            self._stop_task()
+
+        # Take in results that came back after the next task started
+        for timestamp in self.task_timestamps.values():
+            if timestamp.end is not None and timestamp.host_durations:
+                timestamp.stop()
 
         self.playbook_timestamp.stop()
 
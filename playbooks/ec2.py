@@ -87,6 +87,10 @@ variable named:
 
 Security groups are comma-separated in 'ec2_security_group_ids' and
 'ec2_security_group_names'.
+
+The same variables are returned for every host by --list, under
+'_meta': {'hostvars': {...}}, so Ansible does not need to run this script
+once per host with --host.
 '''
 
 # (c) 2012, Peter Sankauskas
@@ -108,15 +112,15 @@ Security groups are comma-separated in 'ec2_security_group_ids' and
 
 ######################################################################
 
+# Only what is needed to answer from a valid cache is imported here. boto
+# and the modules used to refresh the cache are imported when they are used,
+# see load_boto.
 import sys
 import os
-import argparse
+import fcntl
+import marshal
 import re
 from time import time
-import boto
-from boto import ec2
-from boto import rds
-from boto import route53
 import ConfigParser
 
 try:
@@ -124,57 +128,369 @@ try:
 except ImportError:
     import simplejson as json
 
+DEFAULT_INIFILE = os.environ.get(
+    "ANSIBLE_EC2_INI", os.path.dirname(os.path.realpath(__file__)) + '/ec2.ini')
+
+
+def load_boto():
+    ''' Imports boto into the module namespace. Importing it takes longer
+    than answering from the cache, so it is only done before API calls. '''
+
+    global boto, ec2, rds, route53, sts
+    import boto
+    from boto import ec2
+    from boto import rds
+    from boto import route53
+    from boto import sts
+
+
+class CachedInventory(object):
+    ''' Reads the inventory cache files. This is all that is needed to answer
+    --list and --host while the cache is valid; Ec2Inventory extends it with
+    the code that calls the AWS APIs. '''
+
+    def answer_from_cache(self, argv):
+        ''' Prints the answer to a --list or --host command line from a valid
+        cache. Returns False, without printing anything, if the command line
+        needs more than that or the cache has to be refreshed. '''
+
+        options = {'--inifile': DEFAULT_INIFILE, '--cache-path': None, '--host': None}
+        args = iter(argv)
+        for arg in args:
+            if arg == '--list':
+                continue
+            (name, sep, value) = arg.partition('=')
+            if name not in options:
+                return False
+            if not sep:
+                value = next(args, None)
+            if value is None:
+                return False
+            options[name] = value
+
+        config = ConfigParser.SafeConfigParser()
+        config.read(options['--inifile'])
+        self.read_cache_settings(config, options['--cache-path'])
+
+        daemon_socket = self.get_daemon_socket(config)
+        if daemon_socket:
+            if options['--host']:
+                request = 'host ' + options['--host']
+            else:
+                request = 'list'
+            answer = self.ask_daemon(daemon_socket, request, self.cache_path_cache)
+            if answer is not None:
+                print answer
+                return True
+
+        age = self.get_cache_age()
+        if age is None or age >= self.cache_max_age:
+            return False
+
+        if options['--host']:
+            inventory = self.read_cache(self.cache_path_cache)
+            hostvars = inventory.get("_meta", {}).get("hostvars", {})
+            if options['--host'] not in hostvars:
+                return False
+            print json.dumps(hostvars[options['--host']], sort_keys=True, indent=2)
+        elif self.cache_format == 'marshal':
+            print json.dumps(self.read_cache(self.cache_path_cache))
+        else:
+            cache = self.open_cache_file(self.cache_path_cache)
+            try:
+                for chunk in iter(lambda: cache.read(65536), ''):
+                    sys.stdout.write(chunk)
+            finally:
+                cache.close()
+            sys.stdout.write('\n')
+        return True
+
+
+    def get_daemon_socket(self, config):
+        ''' Returns the path of the inventory daemon's socket, or None if
+        there is no daemon_socket in the ec2.ini file. Like the cache files,
+        it is prefixed with AWS_PROFILE, so each profile has its own daemon. '''
+
+        if not config.has_option('ec2', 'daemon_socket'):
+            return None
+        path = config.get('ec2', 'daemon_socket')
+        if 'AWS_PROFILE' in os.environ:
+            (directory, name) = os.path.split(path)
+            path = os.path.join(directory, "{}-{}".format(os.environ['AWS_PROFILE'], name))
+        return path
+
+
+    def ask_daemon(self, path, request, cache_path=None):
+        ''' Sends a request to the inventory daemon listening on path. Returns
+        its answer, or None if it isn't running or can't answer. With
+        cache_path, the answer is also None if the daemon serves the
+        inventory of other cache files, i.e. other settings or credentials. '''
+
+        import socket
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.settimeout(10)
+            client.connect(path)
+            client.sendall(request + '\n')
+            chunks = []
+            for chunk in iter(lambda: client.recv(65536), ''):
+                chunks.append(chunk)
+        except socket.error:
+            return None
+        finally:
+            client.close()
+
+        (status, _, body) = ''.join(chunks).partition('\n')
+        (status, _, served) = status.partition(' ')
+        if status != 'OK':
+            return None
+        if cache_path and served != os.path.realpath(cache_path):
+            sys.stderr.write("The inventory daemon on %s serves %s rather than %s, not using it\n"
+                             % (path, served, os.path.realpath(cache_path)))
+            return None
+        return body
+
+
+    def read_cache_settings(self, config, cache_path=None):
+        ''' Reads the cache related settings from the ec2.ini file. cache_path
+        overrides the one in the file, and EC2_CACHE_PATH overrides both. '''
+
+        if 'EC2_CACHE_PATH' in os.environ:
+            cache_path = os.environ['EC2_CACHE_PATH']
+        elif not cache_path:
+            cache_path = config.get('ec2', 'cache_path')
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+
+        if 'AWS_PROFILE' in os.environ:
+            aws_profile = "{}-".format(os.environ.get('AWS_PROFILE'))
+        else:
+            aws_profile = ""
+        self.cache_dir = cache_path
+
+        # Encoding of the cache files; the file names change with it so
+        # that a cache written with another encoding is never misread
+        self.cache_format = 'json'
+        if config.has_option('ec2', 'cache_format'):
+            self.cache_format = config.get('ec2', 'cache_format')
+        if self.cache_format not in ('json', 'compact', 'marshal'):
+            print "cache_format must be one of json, compact or marshal, not %s" % self.cache_format
+            sys.exit(1)
+        self.cache_compress = False
+        if config.has_option('ec2', 'cache_compress'):
+            self.cache_compress = config.getboolean('ec2', 'cache_compress')
+
+        # The filters decide what is in the inventory, so a cache written
+        # with other filters is kept in other files and never served
+        filters = [(name, config.get('ec2', name))
+                   for name in ('instance_filters', 'rds_instance_filters')
+                   if config.has_option('ec2', name)]
+        self.cache_filters_key = ''
+        if filters:
+            import hashlib
+            self.cache_filters_key = '-' + hashlib.md5(repr(filters)).hexdigest()[:8]
+
+        self.set_cache_paths(aws_profile)
+        self.cache_max_age = config.getint('ec2', 'cache_max_age')
+        self.cache_max_stale = 0
+        if config.has_option('ec2', 'cache_max_stale'):
+            self.cache_max_stale = config.getint('ec2', 'cache_max_stale')
+
+
+    def set_cache_paths(self, prefix):
+        ''' Sets the paths of the cache files in cache_dir, starting with prefix
+        and keyed by the filters the inventory is built with '''
+
+        cache_suffix = ''
+        if self.cache_format == 'marshal':
+            cache_suffix += '.marshal'
+        if self.cache_compress:
+            cache_suffix += '.gz'
+
+        name = prefix + 'ansible-ec2' + self.cache_filters_key
+        self.cache_path_cache = self.cache_dir + "/{}.cache{}".format(name, cache_suffix)
+        self.cache_path_tags = self.cache_dir + "/{}.tags.cache{}".format(name, cache_suffix)
+        self.cache_path_index = self.cache_dir + "/{}.index{}".format(name, cache_suffix)
+        self.cache_path_lock = self.cache_dir + "/{}.lock".format(name)
+        self.cache_path_route53 = self.cache_dir + "/{}ansible-ec2.route53.cache".format(prefix)
+
+
+    def get_cache_age(self, tags_only=False):
+        ''' Returns the age of the cache files in seconds, or None if they
+        don't exist '''
+
+        if tags_only:
+            to_check = self.cache_path_tags
+        else:
+            to_check = self.cache_path_cache
+
+        if os.path.isfile(to_check) and os.path.isfile(self.cache_path_index):
+            return time() - os.path.getmtime(to_check)
+
+        return None
+
+
+    def read_cache(self, filename):
+        ''' Reads and decodes a cache file written by write_to_cache '''
+
+        data = self.read_cache_file(filename)
+        if self.cache_format == 'marshal':
+            return marshal.loads(data)
+        return json.loads(data)
+
+
+    def read_cache_file(self, filename):
+        ''' Returns the contents of a cache file, uncompressed '''
+
+        cache = self.open_cache_file(filename)
+        try:
+            return cache.read()
+        finally:
+            cache.close()
+
+
+    def open_cache_file(self, filename):
+        ''' Opens a cache file for reading, uncompressing it if needed '''
+
+        if self.cache_compress:
+            import gzip
+            return gzip.open(filename, 'rb')
+        return open(filename, 'rb')
+
+
+class Ec2Inventory(CachedInventory):
+    # DescribeDBInstances, in the API version boto's RDS connection speaks,
+    # has no server side filters, so these are matched against the instance
+    # attributes before the instances are kept.
+    RDS_FILTER_ATTRIBUTES = {
+        'db-instance-id': 'id',
+        'engine': 'engine',
+        'instance-class': 'instance_class',
+        'availability-zone': 'availability_zone',
+    }
 
-class Ec2Inventory(object):
     def __init__(self):
         ''' Main execution path '''
 
         # Inventory grouped by instance IDs, tags, security groups, regions,
         # and availability zones
-        self.inventory = {}
+        self.inventory = self._empty_inventory()
 
         # Index of hostname (address) to instance ID
         self.index = {}
 
+        # Groups being built by a refresh, written to self.inventory at its end
+        self.groups = GroupIndex(self.to_safe)
+
+        # Measurements of this run, see InventoryStats
+        self.stats = InventoryStats()
+
         # Read settings and parse CLI arguments
         self.parse_cli_args()
         self.read_settings()
 
+        if self.args.daemon:
+            InventoryDaemon(self).serve_forever()
+            return
+
         # Cache
+        self.stats.cache['age'] = self.get_cache_age(self.args.tags_only)
+        self.stats.cache['hit'] = self.is_cache_valid()
         if self.args.refresh_cache:
-            self.do_api_calls_update_cache()
+            self.stats.cache['refresh'] = 'forced'
+            self.refresh_cache(force=True)
         elif not self.is_cache_valid():
-            self.do_api_calls_update_cache()
+            if self.is_cache_servable_stale():
+                self.stats.cache['refresh'] = 'background'
+                self.refresh_cache_in_background()
+            else:
+                self.stats.cache['refresh'] = 'blocking'
+                self.refresh_cache()
 
         # Data to print
         if self.args.host:
             data_to_print = self.get_host_info()
 
         elif self.args.list:
-            # Display list of instances for inventory
-            if len(self.inventory) == 0:
-                data_to_print = self.get_inventory_from_cache()
-            else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+            # Display list of instances for inventory. A refresh has just
+            # written it to the cache, so that is read back too rather than
+            # encoding it again.
+            data_to_print = self.get_inventory_from_cache()
         print data_to_print
 
+        if self.args.stats:
+            sys.stdout.flush()
+            self.stats.report(sys.stderr)
+
+
+    def _empty_inventory(self):
+        return {"_meta": {"hostvars": {}}}
 
     def is_cache_valid(self):
         ''' Determines if the cache files have expired, or if it is still valid '''
 
-        if self.args.tags_only:
-            to_check = self.cache_path_tags
-        else:
-            to_check = self.cache_path_cache
+        age = self.get_cache_age(self.args.tags_only)
+        return age is not None and age < self.cache_max_age
+
+
+    def is_cache_servable_stale(self):
+        ''' Determines if an expired cache may still be served while it is
+        refreshed in the background '''
+
+        if self.cache_max_stale <= self.cache_max_age:
+            return False
+
+        age = self.get_cache_age(self.args.tags_only)
+        return age is not None and age < self.cache_max_stale
+
+
+    def refresh_cache(self, force=False):
+        ''' Refreshes the cache while holding the lock file, so that runs which
+        find an expired cache at the same time make the API calls only once.
+        The runs that had to wait use the cache written by the first one,
+        unless force is set. '''
+
+        lock_file = open(self.cache_path_lock, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if force or not self.is_cache_valid():
+                self.do_api_calls_update_cache()
+        finally:
+            lock_file.close()
+
+
+    def refresh_cache_in_background(self):
+        ''' Rebuilds the cache from a detached child process, so that the
+        expired cache can be served right away. Only the process that gets
+        the lock file starts a refresher; the others just serve the cache. '''
+
+        lock_file = open(self.cache_path_lock, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # A refresh is already running
+            lock_file.close()
+            return
+
+        if os.fork() == 0:
+            # The child inherits the lock and keeps it until it exits
+            status = 1
+            try:
+                # Detach from the terminal and from ansible, which would
+                # otherwise wait for the child to close stdout
+                os.setsid()
+                devnull = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
 
-        if os.path.isfile(to_check):
-            mod_time = os.path.getmtime(to_check)
-            current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
-                if os.path.isfile(self.cache_path_index):
-                    return True
+                self.stats.cache['refresh'] = 'background'
+                self.do_api_calls_update_cache()
+                status = 0
+            finally:
+                os._exit(status)
 
-        return False
+        lock_file.close()
 
 
     def read_settings(self):
@@ -191,19 +507,10 @@ class Ec2Inventory(object):
         if self.eucalyptus and config.has_option('ec2', 'eucalyptus_host'):
             self.eucalyptus_host = config.get('ec2', 'eucalyptus_host')
 
-        # Regions
-        self.regions = []
-        configRegions = config.get('ec2', 'regions')
-        configRegions_exclude = config.get('ec2', 'regions_exclude')
-        if (configRegions == 'all'):
-            if self.eucalyptus_host:
-                self.regions.append(boto.connect_euca(host=self.eucalyptus_host).region.name)
-            else:
-                for regionInfo in ec2.regions():
-                    if regionInfo.name not in configRegions_exclude:
-                        self.regions.append(regionInfo.name)
-        else:
-            self.regions = configRegions.split(",")
+        # Regions, resolved by get_regions before making API calls
+        self.regions = None
+        self.config_regions = config.get('ec2', 'regions')
+        self.config_regions_exclude = config.get('ec2', 'regions_exclude')
 
         # Destination addresses
         self.destination_variable = config.get('ec2', 'destination_variable')
@@ -215,30 +522,103 @@ class Ec2Inventory(object):
         if config.has_option('ec2', 'route53_excluded_zones'):
             self.route53_excluded_zones.extend(
                 config.get('ec2', 'route53_excluded_zones', '').split(','))
+        self.route53_cache_max_age = 0
+        if config.has_option('ec2', 'route53_cache_max_age'):
+            self.route53_cache_max_age = config.getint('ec2', 'route53_cache_max_age')
+        # Built from the Route53 zones when the first instance is added
+        self.route53_records = None
 
         # Cache related
-        if 'EC2_CACHE_PATH' in os.environ:
-            cache_path = os.environ['EC2_CACHE_PATH']
-        elif self.args.cache_path:
-            cache_path = self.args.cache_path
-        else:
-            cache_path = config.get('ec2', 'cache_path')
-        if not os.path.exists(cache_path):
-            os.makedirs(cache_path)
+        self.read_cache_settings(config, self.args.cache_path)
+
+        # Concurrency: number of threads used to fetch regions in parallel
+        self.max_workers = 1
+        if config.has_option('ec2', 'max_workers'):
+            self.max_workers = config.getint('ec2', 'max_workers')
+
+        # Instances per DescribeInstances page; 0 fetches each region in one
+        # call. Pages are added to the inventory as they arrive.
+        self.page_size = 0
+        if config.has_option('ec2', 'page_size'):
+            self.page_size = config.getint('ec2', 'page_size')
+        if self.page_size and not 5 <= self.page_size <= 1000:
+            print "page_size must be 0 or between 5 and 1000, not %d" % self.page_size
+            sys.exit(1)
 
-        if 'AWS_PROFILE' in os.environ:
-            aws_profile = "{}-".format(os.environ.get('AWS_PROFILE'))
-        else:
-            aws_profile = ""
+        # Filters, so that the instances that won't be in the inventory are
+        # not fetched in the first place
+        self.ec2_instance_filters = {}
+        if config.has_option('ec2', 'instance_filters'):
+            self.ec2_instance_filters = self.parse_filters(
+                config.get('ec2', 'instance_filters'))
+        self.rds_instance_filters = {}
+        if config.has_option('ec2', 'rds_instance_filters'):
+            self.rds_instance_filters = self.parse_filters(
+                config.get('ec2', 'rds_instance_filters'))
+            for name in self.rds_instance_filters:
+                if name not in self.RDS_FILTER_ATTRIBUTES:
+                    print "rds_instance_filters: unsupported filter %s, use one of %s" % (
+                        name, ', '.join(sorted(self.RDS_FILTER_ATTRIBUTES)))
+                    sys.exit(1)
+
+        # Accounts: AWS profiles or IAM role ARNs to inventory together
+        self.accounts = []
+        if config.has_option('ec2', 'accounts'):
+            self.accounts = [account.strip() for account in
+                             config.get('ec2', 'accounts').split(',') if account.strip()]
+        self.account_namespace = False
+        if config.has_option('ec2', 'account_namespace'):
+            self.account_namespace = config.getboolean('ec2', 'account_namespace')
+        # The account this inventory is for, and the arguments that connect
+        # to it; the defaults connect with the usual boto credentials
+        self.account = None
+        self.connection_kwargs = {}
+
+        # Inventory daemon
+        self.daemon_socket = self.get_daemon_socket(config)
+        self.daemon_refresh_interval = self.cache_max_age
+        if config.has_option('ec2', 'daemon_refresh_interval'):
+            self.daemon_refresh_interval = config.getint('ec2', 'daemon_refresh_interval')
+
+        # File the stats of every refresh are appended to, as JSON lines
+        self.stats_file = None
+        if config.has_option('ec2', 'stats_file'):
+            self.stats_file = config.get('ec2', 'stats_file')
+
+    def parse_filters(self, value):
+        ''' Parses filters written as name=value&name=value into a dict of
+        name to list of values. A name given more than once matches any of
+        its values. '''
+
+        filters = {}
+        for term in value.split('&'):
+            term = term.strip()
+            if not term:
+                continue
+            (name, sep, term_value) = term.partition('=')
+            if not sep:
+                print "Filters must be written as name=value, not %s" % term
+                sys.exit(1)
+            filters.setdefault(name.strip(), []).append(term_value.strip())
+        return filters
 
-        self.cache_path_cache = cache_path + "/{}ansible-ec2.cache".format(aws_profile)
-        self.cache_path_tags = cache_path + "/{}ansible-ec2.tags.cache".format(aws_profile)
-        self.cache_path_index = cache_path + "/{}ansible-ec2.index".format(aws_profile)
-        self.cache_max_age = config.getint('ec2', 'cache_max_age')
+    def get_regions(self):
+        ''' Returns the list of regions to make API calls to '''
+
+        if self.config_regions != 'all':
+            return self.config_regions.split(",")
+
+        if self.eucalyptus_host:
+            return [boto.connect_euca(host=self.eucalyptus_host).region.name]
+
+        return [regionInfo.name for regionInfo in self.api_call('ec2', 'all', ec2.regions)
+                if regionInfo.name not in self.config_regions_exclude]
 
     def parse_cli_args(self):
         ''' Command line argument processing '''
 
+        import argparse
+
         parser = argparse.ArgumentParser(description='Produce an Ansible Inventory file based on EC2')
         parser.add_argument('--tags-only', action='store_true', default=False,
                            help='only return tags (default: False)')
@@ -249,90 +629,378 @@ class Ec2Inventory(object):
         parser.add_argument('--refresh-cache', action='store_true', default=False,
                            help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
 
-        default_inifile = os.environ.get("ANSIBLE_EC2_INI", os.path.dirname(os.path.realpath(__file__))+'/ec2.ini')
-
-        parser.add_argument('--inifile', dest='inifile', help='Path to init script to use', default=default_inifile)
+        parser.add_argument('--inifile', dest='inifile', help='Path to init script to use', default=DEFAULT_INIFILE)
         parser.add_argument(
             '--cache-path',
             help='Override the cache path set in ini file',
             required=False)
+        parser.add_argument('--daemon', action='store_true', default=False,
+                           help='Keep the inventory in memory and serve it on daemon_socket (default: False)')
+        parser.add_argument('--stats', action='store_true', default=False,
+                           help='Print API call, cache and timing stats to stderr (default: False)')
         self.args = parser.parse_args()
 
 
     def do_api_calls_update_cache(self):
         ''' Do API calls to each region, and save data in cache files '''
 
-        if self.route53_enabled:
-            self.get_route53_records()
-
-        for region in self.regions:
-            self.get_instances_by_region(region)
-            self.get_rds_instances_by_region(region)
+        start = time()
+        load_boto()
+        if self.regions is None:
+            self.regions = self.get_regions()
+        self.route53_records = None
+        self.groups = GroupIndex(self.to_safe)
+
+        if self.accounts:
+            self.do_api_calls_for_accounts()
+        elif self.max_workers > 1:
+            self.do_api_calls_concurrently()
+        else:
+            for region in self.regions:
+                self.get_instances_by_region(region)
+                self.get_rds_instances_by_region(region)
+        self.groups.update_inventory(self.inventory)
+        if self.account is None:
+            self.stats.add_time('fetch', time() - start)
+            self.stats.record_memory('fetch_peak_kb')
+
+        # Write the index first: the cache file's mtime is what marks the
+        # pair as fresh
+        self.write_to_cache(self.index, self.cache_path_index)
 
         if self.args.tags_only:
             self.write_to_cache(self.inventory, self.cache_path_tags)
         else:
             self.write_to_cache(self.inventory, self.cache_path_cache)
 
-        self.write_to_cache(self.index, self.cache_path_index)
+        if self.account is None:
+            self.stats.add_time('refresh', time() - start)
+            self.stats.count_inventory(self.inventory)
+            self.stats.record_memory('peak_kb')
+            if self.stats_file:
+                self.stats.append_to(self.stats_file)
+
+    def api_call(self, service, region, call, count=len):
+        ''' Returns call(), recording it in the stats as an API call to
+        service in region that returned count(result) items '''
+
+        name = service + '/' + region
+        if self.account:
+            name = self.account + '/' + name
+        return self.stats.time_api_call(name, call, count)
+
+    def do_api_calls_for_accounts(self):
+        ''' Builds the inventory of every account in parallel, each with its
+        own cache files, and merges them. Accounts whose cache is still valid
+        are read from it, and an account whose refresh fails is served from
+        its last cache, so one slow or broken account doesn't hold up or
+        invalidate the others. '''
+
+        from multiprocessing.pool import ThreadPool
+
+        inventories = [self.get_account_inventory(account) for account in self.accounts]
+        pool = ThreadPool(len(inventories))
+        try:
+            results = [pool.apply_async(self.run_guarded, (inventory.load_or_refresh,))
+                       for inventory in inventories]
+
+            for inventory, result in zip(inventories, results):
+                (ok, source) = result.get()
+                if not ok:
+                    if inventory.get_cache_age() is None:
+                        self.unguard((ok, source))
+                    sys.stderr.write("Could not refresh the inventory of %s, using its last cache\n"
+                                     % inventory.account)
+                    inventory.load_from_cache()
+                    source = 'stale cache'
+                self.stats.count_account(inventory.account, source, inventory.inventory)
+                self.merge_account_inventory(inventory)
+        finally:
+            pool.terminate()
+
+    def get_account_inventory(self, account):
+        ''' Returns a copy of this inventory for one of the accounts, with its
+        own cache files '''
+
+        import copy
+
+        inventory = copy.copy(self)
+        inventory.account = account
+        inventory.accounts = []
+        inventory.inventory = self._empty_inventory()
+        inventory.index = {}
+        inventory.route53_records = None
+        # Accounts always cache everything; --tags-only applies to the merge
+        inventory.args = copy.copy(self.args)
+        inventory.args.tags_only = False
+        inventory.set_cache_paths(self.to_safe(account) + '-')
+        return inventory
+
+    def load_or_refresh(self):
+        ''' Reads an account's inventory from its cache, refreshing it first
+        if needed. Returns where the inventory came from, 'api' or 'cache'. '''
+
+        if self.args.refresh_cache or not self.is_cache_valid():
+            self.connection_kwargs = self.get_account_credentials(self.account)
+            self.refresh_cache(force=self.args.refresh_cache)
+
+        if self.inventory == self._empty_inventory():
+            # Refreshed by another process, or the cache was valid
+            self.load_from_cache()
+            return 'cache'
+        return 'api'
+
+    def load_from_cache(self):
+        self.inventory = self.read_cache(self.cache_path_cache)
+        self.index = self.read_cache(self.cache_path_index)
+
+    def get_account_credentials(self, account):
+        ''' Returns the connection arguments for an account, given as the
+        name of an AWS profile or the ARN of an IAM role to assume '''
+
+        load_boto()
+        if not account.startswith('arn:'):
+            return {'profile_name': account}
+
+        role = sts.STSConnection().assume_role(account, 'ansible-ec2-inventory')
+        return {
+            'aws_access_key_id': role.credentials.access_key,
+            'aws_secret_access_key': role.credentials.secret_key,
+            'security_token': role.credentials.session_token,
+        }
+
+    def merge_account_inventory(self, inventory):
+        ''' Adds the groups, index and hostvars of an account's inventory to
+        this one. With account_namespace, the groups are prefixed with the
+        account name; otherwise groups of the same name are merged. '''
+
+        account = self.to_safe(inventory.account)
+        if self.account_namespace:
+            prefix = account + '__'
+        else:
+            prefix = ''
+
+        for group, hosts in inventory.inventory.iteritems():
+            if group == '_meta':
+                continue
+            group = prefix + group
+            if group not in self.inventory:
+                self.inventory[group] = list(hosts)
+            elif not group.startswith('first_in_'):
+                members = set(self.inventory[group])
+                self.inventory[group].extend(host for host in hosts if host not in members)
+
+        # Inventory: Group by account
+        self.inventory['account_' + account] = sorted(inventory.index)
+
+        hostvars = self.inventory["_meta"]["hostvars"]
+        for host, host_vars in inventory.inventory["_meta"]["hostvars"].iteritems():
+            if host in hostvars:
+                sys.stderr.write("Host %s is in accounts %s and %s, keeping the latter\n"
+                                 % (host, hostvars[host]['ec2_account'], inventory.account))
+            hostvars[host] = dict(host_vars, ec2_account=inventory.account)
+
+        for host, (region, instance_id) in inventory.index.iteritems():
+            self.index[host] = [region, instance_id, inventory.account]
+
+    def do_api_calls_concurrently(self):
+        ''' Fetch EC2, RDS and Route53 data for all regions from a bounded
+        pool of threads. Each thread adds the instances it fetches to an
+        inventory of its own as the pages arrive, and those are merged in
+        region order once every fetch has finished, so the inventory matches
+        what a serial refresh builds. '''
+
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(min(self.max_workers, 2 * len(self.regions) + 1))
+        try:
+            route53_records = None
+            if self.route53_enabled:
+                route53_records = pool.apply_async(
+                    self.run_guarded, (self.fetch_route53_records,))
+
+            fetches = []
+            for region in self.regions:
+                fetches.append(pool.apply_async(
+                    self.run_guarded, (self.fetch_region_inventory, region, route53_records)))
+                fetches.append(pool.apply_async(
+                    self.run_guarded, (self.fetch_region_rds_inventory, region)))
+
+            if route53_records is not None:
+                self.route53_records = self.unguard(route53_records.get())
+
+            for fetch in fetches:
+                self.merge_region_inventory(self.unguard(fetch.get()))
+        finally:
+            pool.terminate()
+
+    def get_region_inventory(self):
+        ''' Returns a copy of this inventory that a fetch thread can add
+        instances to, for merge_region_inventory '''
+
+        import copy
+
+        inventory = copy.copy(self)
+        inventory.inventory = self._empty_inventory()
+        inventory.index = {}
+        inventory.groups = GroupIndex(self.to_safe)
+        return inventory
+
+    def fetch_region_inventory(self, region, route53_records):
+        ''' Returns an inventory of the EC2 instances of a region.
+        route53_records is the pending result of fetch_route53_records, or
+        None if Route53 is disabled; it is only waited for once the first
+        page has been fetched. '''
+
+        inventory = self.get_region_inventory()
+        for page in inventory.fetch_instance_pages_by_region(region):
+            if route53_records is not None and inventory.route53_records is None:
+                inventory.route53_records = self.unguard(route53_records.get())
+            inventory.add_reservations(page, region)
+        return inventory
+
+    def fetch_region_rds_inventory(self, region):
+        ''' Returns an inventory of the RDS instances of a region '''
+
+        inventory = self.get_region_inventory()
+        inventory.get_rds_instances_by_region(region)
+        return inventory
+
+    def merge_region_inventory(self, inventory):
+        ''' Adds the groups, index and hostvars of an inventory returned by
+        fetch_region_inventory or fetch_region_rds_inventory to this one '''
+
+        self.index.update(inventory.index)
+        self.inventory["_meta"]["hostvars"].update(inventory.inventory["_meta"]["hostvars"])
+        self.groups.merge(inventory.groups)
+
+    def run_guarded(self, func, *args):
+        ''' Calls func in a worker thread. ThreadPool loses anything that is
+        not an Exception (e.g. the sys.exit calls on API errors), so capture
+        everything and let unguard re-raise it in the main thread. '''
+
+        try:
+            return (True, func(*args))
+        except BaseException:
+            return (False, sys.exc_info())
+
+    def unguard(self, result):
+        ''' Returns the value of a run_guarded call, or re-raises the error
+        it captured '''
+
+        (ok, value) = result
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
 
     def get_instances_by_region(self, region):
         ''' Makes an AWS EC2 API call to the list of instances in a particular
         region '''
 
+        for page in self.fetch_instance_pages_by_region(region):
+            self.add_reservations(page, region)
+
+    def fetch_instance_pages_by_region(self, region):
+        ''' Yields the reservations of a particular region one DescribeInstances
+        page of up to page_size instances at a time, or all in one page if
+        page_size is 0. Adding each page before fetching the next keeps no
+        more than a page of boto objects in memory. '''
+
         try:
             if self.eucalyptus:
                 conn = boto.connect_euca(host=self.eucalyptus_host)
                 conn.APIVersion = '2010-08-31'
             else:
-                conn = ec2.connect_to_region(region)
+                conn = ec2.connect_to_region(region, **self.connection_kwargs)
 
             # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
             if conn is None:
-                print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
+                print >> sys.stderr, "region name: %s likely not supported, or AWS is down.  connection to region failed." % region
                 sys.exit(1)
 
-            reservations = conn.get_all_instances()
-            for reservation in reservations:
-                instances = sorted(reservation.instances)
-                for instance in instances:
-                    self.add_instance(instance, region)
+            # Eucalyptus' API version predates MaxResults
+            page_size = None
+            if self.page_size and not self.eucalyptus:
+                page_size = self.page_size
+
+            next_token = None
+            while True:
+                page = self.api_call(
+                    'ec2', region,
+                    lambda: conn.get_all_reservations(
+                        filters=self.ec2_instance_filters or None,
+                        max_results=page_size, next_token=next_token),
+                    count=lambda reservations: sum(len(r.instances) for r in reservations))
+                yield page
+
+                next_token = getattr(page, 'next_token', None)
+                if page_size is None or not next_token:
+                    break
 
         except boto.exception.BotoServerError as e:
             if  not self.eucalyptus:
-                print "Looks like AWS is down again:"
-            print e
+                print >> sys.stderr, "Looks like AWS is down again:"
+            print >> sys.stderr, e
             sys.exit(1)
 
+    def add_reservations(self, reservations, region):
+        ''' Adds the instances of a list of reservations to the inventory '''
+
+        for reservation in reservations:
+            instances = sorted(reservation.instances, key=lambda instance: instance.id)
+            for instance in instances:
+                self.add_instance(instance, region)
+
     def get_rds_instances_by_region(self, region):
-	''' Makes an AWS API call to the list of RDS instances in a particular
+        ''' Makes an AWS API call to the list of RDS instances in a particular
         region '''
 
+        self.add_rds_instances(self.fetch_rds_instances_by_region(region), region)
+
+    def fetch_rds_instances_by_region(self, region):
+        ''' Returns the RDS instances of a particular region without adding
+        them to the inventory '''
+
         try:
-            conn = rds.connect_to_region(region)
+            conn = rds.connect_to_region(region, **self.connection_kwargs)
             if conn:
-                instances = conn.get_all_dbinstances()
-                for instance in instances:
-                    self.add_rds_instance(instance, region)
+                return [instance for instance in self.api_call('rds', region, conn.get_all_dbinstances)
+                        if self.match_rds_instance_filters(instance)]
+            return []
         except boto.exception.BotoServerError as e:
-            print "Looks like AWS RDS is down: "
-            print e
+            print >> sys.stderr, "Looks like AWS RDS is down: "
+            print >> sys.stderr, e
             sys.exit(1)
 
+    def match_rds_instance_filters(self, instance):
+        ''' Checks an RDS instance against rds_instance_filters '''
+
+        for name, values in self.rds_instance_filters.iteritems():
+            if getattr(instance, self.RDS_FILTER_ATTRIBUTES[name]) not in values:
+                return False
+        return True
+
+    def add_rds_instances(self, instances, region):
+        ''' Adds a list of RDS instances to the inventory '''
+
+        for instance in instances:
+            self.add_rds_instance(instance, region)
+
     def get_instance(self, region, instance_id):
         ''' Gets details about a specific instance '''
+        load_boto()
         if self.eucalyptus:
             conn = boto.connect_euca(self.eucalyptus_host)
             conn.APIVersion = '2010-08-31'
         else:
-            conn = ec2.connect_to_region(region)
+            conn = ec2.connect_to_region(region, **self.connection_kwargs)
 
         # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
         if conn is None:
             print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
             sys.exit(1)
 
-        reservations = conn.get_all_instances([instance_id])
+        reservations = self.api_call('ec2', region, lambda: conn.get_all_instances([instance_id]))
         for reservation in reservations:
             for instance in reservation.instances:
                 return instance
@@ -359,27 +1027,31 @@ class Ec2Inventory(object):
         # Add to index
         self.index[dest] = [region, instance.id]
 
+        groups = self.groups
+
         # Inventory: Group by instance ID (always a group of 1)
-        self.inventory[instance.id] = [dest]
+        groups.add(instance.id, dest)
+
+        # Inventory: Host variables, so --list answers for every --host
+        self.inventory["_meta"]["hostvars"][dest] = self.get_host_info_dict_from_instance(instance)
 
         # Inventory: Group by region
-        self.push(self.inventory, region, dest)
+        groups.add(region, dest)
 
         # Inventory: Group by availability zone
-        self.push(self.inventory, instance.placement, dest)
+        groups.add(instance.placement, dest)
 
         # Inventory: Group by instance type
-        self.push(self.inventory, self.to_safe('type_' + instance.instance_type), dest)
+        groups.add_safe('type_' + instance.instance_type, dest)
 
         # Inventory: Group by key pair
         if instance.key_name:
-            self.push(self.inventory, self.to_safe('key_' + instance.key_name), dest)
+            groups.add_safe('key_' + instance.key_name, dest)
 
         # Inventory: Group by security group
         try:
             for group in instance.groups:
-                key = self.to_safe("security_group_" + group.name)
-                self.push(self.inventory, key, dest)
+                groups.add_safe("security_group_" + group.name, dest)
         except AttributeError:
             print 'Package boto seems a bit older.'
             print 'Please upgrade boto >= 2.3.0.'
@@ -387,15 +1059,15 @@ class Ec2Inventory(object):
 
         # Inventory: Group by tag keys
         for k, v in instance.tags.iteritems():
-            key = self.to_safe("tag_" + k + "=" + v)
-            self.push(self.inventory, key, dest)
-            self.keep_first(self.inventory, 'first_in_' + key, dest)
+            key = groups.safe("tag_" + k + "=" + v)
+            groups.add(key, dest)
+            groups.add_first('first_in_' + key, dest)
 
         # Inventory: Group by Route53 domain names if enabled
         if self.route53_enabled:
             route53_names = self.get_instance_route53_names(instance)
             for name in route53_names:
-                self.push(self.inventory, name, dest)
+                groups.add(name, dest)
 
 
     def add_rds_instance(self, instance, region):
@@ -420,59 +1092,118 @@ class Ec2Inventory(object):
         # Add to index
         self.index[dest] = [region, instance.id]
 
+        groups = self.groups
+
         # Inventory: Group by instance ID (always a group of 1)
-        self.inventory[instance.id] = [dest]
+        groups.add(instance.id, dest)
+
+        # Inventory: Host variables, so --list answers for every --host
+        self.inventory["_meta"]["hostvars"][dest] = self.get_host_info_dict_from_instance(instance)
 
         # Inventory: Group by region
-        self.push(self.inventory, region, dest)
+        groups.add(region, dest)
 
         # Inventory: Group by availability zone
-        self.push(self.inventory, instance.availability_zone, dest)
+        groups.add(instance.availability_zone, dest)
 
         # Inventory: Group by instance type
-        self.push(self.inventory, self.to_safe('type_' + instance.instance_class), dest)
+        groups.add_safe('type_' + instance.instance_class, dest)
 
         # Inventory: Group by security group
         try:
             if instance.security_group:
-                key = self.to_safe("security_group_" + instance.security_group.name)
-                self.push(self.inventory, key, dest)
+                groups.add_safe("security_group_" + instance.security_group.name, dest)
         except AttributeError:
             print 'Package boto seems a bit older.'
             print 'Please upgrade boto >= 2.3.0.'
             sys.exit(1)
 
         # Inventory: Group by engine
-        self.push(self.inventory, self.to_safe("rds_" + instance.engine), dest)
+        groups.add_safe("rds_" + instance.engine, dest)
 
         # Inventory: Group by parameter group
-        self.push(self.inventory, self.to_safe("rds_parameter_group_" + instance.parameter_group.name), dest)
+        groups.add_safe("rds_parameter_group_" + instance.parameter_group.name, dest)
 
 
     def get_route53_records(self):
         ''' Get and store the map of resource records to domain names that
         point to them. '''
 
-        r53_conn = route53.Route53Connection()
-        all_zones = r53_conn.get_zones()
+        self.route53_records = self.fetch_route53_records()
+
+    def fetch_route53_records(self):
+        ''' Returns the map of resource records to domain names that point
+        to them.
+
+        The records of each zone are kept in their own cache file. A zone's
+        records are only listed again when its record count changed or they
+        are older than route53_cache_max_age seconds; --refresh-cache lists
+        every zone again. '''
+
+        r53_conn = route53.Route53Connection(**self.connection_kwargs)
+        all_zones = self.api_call('route53', 'global', r53_conn.get_zones)
 
         route53_zones = [ zone for zone in all_zones if zone.name[:-1]
                           not in self.route53_excluded_zones ]
 
-        self.route53_records = {}
+        cached_zones = {}
+        if not self.args.refresh_cache:
+            cached_zones = self.load_route53_zones_from_cache()
 
+        zones = {}
         for zone in route53_zones:
-            rrsets = r53_conn.get_all_rrsets(zone.id)
+            record_count = int(getattr(zone, 'resourcerecordsetcount', -1))
+            cached = cached_zones.get(zone.id)
+            if (cached and record_count >= 0
+                    and cached['record_count'] == record_count
+                    and time() - cached['fetched_at'] < self.route53_cache_max_age):
+                zones[zone.id] = cached
+                continue
 
-            for record_set in rrsets:
+            # The record sets are paged in as they are iterated over
+            record_sets = self.api_call('route53', 'global',
+                                        lambda: list(r53_conn.get_all_rrsets(zone.id)))
+            records = {}
+            for record_set in record_sets:
                 record_name = record_set.name
 
                 if record_name.endswith('.'):
                     record_name = record_name[:-1]
 
                 for resource in record_set.resource_records:
-                    self.route53_records.setdefault(resource, set())
-                    self.route53_records[resource].add(record_name)
+                    records.setdefault(resource, []).append(record_name)
+
+            zones[zone.id] = {
+                'name': zone.name,
+                'record_count': record_count,
+                'fetched_at': time(),
+                'records': records,
+            }
+
+        self.write_cache_file(json.dumps(zones), self.cache_path_route53)
+
+        route53_records = {}
+        for zone in zones.itervalues():
+            for resource, names in zone['records'].iteritems():
+                route53_records.setdefault(resource, set()).update(names)
+
+        return route53_records
+
+
+    def load_route53_zones_from_cache(self):
+        ''' Reads the per zone Route53 records written by
+        fetch_route53_records, or returns {} if there are none '''
+
+        try:
+            cache = open(self.cache_path_route53, 'rb')
+        except IOError:
+            return {}
+        try:
+            return json.load(cache)
+        except ValueError:
+            return {}
+        finally:
+            cache.close()
 
 
     def get_instance_route53_names(self, instance):
@@ -480,6 +1211,9 @@ class Ec2Inventory(object):
         Route53. If it is, return the list of domain names pointing to said
         instance. If nothing points to it, return an empty list. '''
 
+        if self.route53_records is None:
+            self.get_route53_records()
+
         instance_attributes = [ 'public_dns_name', 'private_dns_name',
                                 'ip_address', 'private_ip_address' ]
 
@@ -497,27 +1231,15 @@ class Ec2Inventory(object):
         return list(name_list)
 
 
-    def get_host_info(self):
-        ''' Get variables about a specific host '''
+    def get_host_info_dict_from_instance(self, instance):
+        ''' Flattens the attributes of a boto instance object into a dict of
+        ec2_* variables '''
 
-        if len(self.index) == 0:
-            # Need to load index from cache
-            self.load_index_from_cache()
-
-        if not self.args.host in self.index:
-            # try updating the cache
-            self.do_api_calls_update_cache()
-            if not self.args.host in self.index:
-                # host migh not exist anymore
-                return self.json_format_dict({}, True)
-
-        (region, instance_id) = self.index[self.args.host]
-
-        instance = self.get_instance(region, instance_id)
+        safe = self.groups.safe
         instance_vars = {}
         for key in vars(instance):
             value = getattr(instance, key)
-            key = self.to_safe('ec2_' + key)
+            key = safe('ec2_' + key)
 
             # Handle complex types
             if type(value) in [int, bool]:
@@ -530,8 +1252,7 @@ class Ec2Inventory(object):
                 instance_vars[key] = value.name
             elif key == 'ec2_tags':
                 for k, v in value.iteritems():
-                    key = self.to_safe('ec2_tag_' + k)
-                    instance_vars[key] = v
+                    instance_vars[safe('ec2_tag_' + k)] = v
             elif key == 'ec2_groups':
                 group_ids = []
                 group_names = []
@@ -547,50 +1268,150 @@ class Ec2Inventory(object):
                 #print type(value)
                 #print value
 
-        return self.json_format_dict(instance_vars, True)
+        return instance_vars
+
+
+    def get_host_info(self):
+        ''' Get variables about a specific host '''
 
+        hostvars = self.get_hostvars()
+        if self.args.host in hostvars:
+            return self.json_format_dict(hostvars[self.args.host], True)
 
-    def push(self, my_dict, key, element):
-        ''' Pushed an element onto an array that may not have been defined in
-        the dict '''
+        if len(self.index) == 0:
+            # Need to load index from cache
+            self.load_index_from_cache()
 
-        if key in my_dict:
-            my_dict[key].append(element);
+        if not self.args.host in self.index:
+            # try updating the cache
+            self.do_api_calls_update_cache()
+            if not self.args.host in self.index:
+                # host migh not exist anymore
+                return self.json_format_dict({}, True)
+
+        (region, instance_id) = self.index[self.args.host][:2]
+
+        if len(self.index[self.args.host]) > 2:
+            # Merged from one of several accounts
+            account_inventory = self.get_account_inventory(self.index[self.args.host][2])
+            account_inventory.connection_kwargs = self.get_account_credentials(account_inventory.account)
+            instance = account_inventory.get_instance(region, instance_id)
         else:
-            my_dict[key] = [element]
+            instance = self.get_instance(region, instance_id)
+        return self.json_format_dict(self.get_host_info_dict_from_instance(instance), True)
+
+
+    def get_hostvars(self):
+        ''' Returns the host variables of the inventory, reading them from the
+        cache if no API calls were made. Caches written before hostvars were
+        added to --list have none, in which case an empty dict is returned. '''
+
+        if self.inventory != self._empty_inventory():
+            return self.inventory["_meta"]["hostvars"]
+
+        if self.args.tags_only or not os.path.isfile(self.cache_path_cache):
+            return {}
+
+        inventory = json.loads(self.get_inventory_from_cache())
+        return inventory.get("_meta", {}).get("hostvars", {})
 
-    def keep_first(self, my_dict, key, element):
-        if key not in my_dict:
-            my_dict[key] = [element]
 
     def get_inventory_from_cache(self):
         ''' Reads the inventory from the cache file and returns it as a JSON
         object '''
         if self.args.tags_only:
-            cache = open(self.cache_path_tags, 'r')
+            filename = self.cache_path_tags
         else:
-            cache = open(self.cache_path_cache, 'r')
-        json_inventory = cache.read()
-        return json_inventory
+            filename = self.cache_path_cache
+
+        start = time()
+        try:
+            if self.cache_format == 'marshal':
+                return json.dumps(self.read_cache(filename))
+
+            # JSON caches are already in the output format, skip decoding them
+            return self.read_cache_file(filename)
+        finally:
+            self.stats.add_time('cache_read', time() - start)
 
 
     def load_index_from_cache(self):
         ''' Reads the index from the cache file sets self.index '''
 
-        cache = open(self.cache_path_index, 'r')
-        json_index = cache.read()
-        self.index = json.loads(json_index)
+        self.index = self.read_cache(self.cache_path_index)
 
 
     def write_to_cache(self, data, filename):
         '''
-            Writes data in JSON format to a file
+            Writes data to a file in the configured cache format. The data is
+            written to a temporary file that is then renamed over filename,
+            so readers never see a partially written cache.
             '''
 
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        start = time()
+        if self.cache_format == 'marshal':
+            cache_data = marshal.dumps(self.filter_tags_only(data))
+        elif self.cache_format == 'json':
+            # Indented JSON is encoded by pure python code, one small string
+            # at a time; joining them all would take several times the
+            # size of the inventory, so they are written as they come and
+            # the encoding time counts as cache_write
+            cache_data = json.JSONEncoder(sort_keys=True, indent=2).iterencode(
+                self.filter_tags_only(data))
+        else:
+            cache_data = self.json_format_dict(data)
+        self.stats.add_time('cache_encode', time() - start)
+
+        start = time()
+        self.write_cache_file(cache_data, filename, self.cache_compress)
+        self.stats.add_time('cache_write', time() - start)
+
+
+    def write_cache_file(self, cache_data, filename, compress=False):
+        ''' Atomically replaces filename with cache_data, a string or an
+        iterable of strings '''
+
+        import tempfile
+
+        if isinstance(cache_data, basestring):
+            cache_data = [cache_data]
+        else:
+            cache_data = self.join_chunks(cache_data)
+
+        (fd, tmp_filename) = tempfile.mkstemp(
+            dir=os.path.dirname(filename), prefix=os.path.basename(filename) + '.')
+        try:
+            cache = os.fdopen(fd, 'wb')
+            if compress:
+                import gzip
+                compressed = gzip.GzipFile(filename='', mode='wb', fileobj=cache)
+                compressed.writelines(cache_data)
+                compressed.close()
+            else:
+                cache.writelines(cache_data)
+            cache.close()
+            os.chmod(tmp_filename, 0644)
+            os.rename(tmp_filename, filename)
+        except:
+            os.unlink(tmp_filename)
+            raise
+
+
+    def join_chunks(self, chunks, size=65536):
+        ''' Joins an iterable of small strings into strings of about size
+        bytes, which are much cheaper to write and compress one by one '''
+
+        joined = []
+        length = 0
+        for chunk in chunks:
+            joined.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                yield ''.join(joined)
+                joined = []
+                length = 0
+        if joined:
+            yield ''.join(joined)
 
 
     def to_safe(self, word):
@@ -603,14 +1424,413 @@ class Ec2Inventory(object):
     def json_format_dict(self, data, pretty=False):
         ''' Converts a dict to a JSON object and dumps it as a formatted
         string '''
-        if self.args.tags_only:
-            data = [key for key in data.keys() if 'tag_' in key]
+        data = self.filter_tags_only(data)
         if pretty:
             return json.dumps(data, sort_keys=True, indent=2)
         else:
             return json.dumps(data)
 
 
+    def filter_tags_only(self, data):
+        ''' With --tags-only, reduces a dict to the list of its tag keys '''
+
+        if self.args.tags_only:
+            return [key for key in data.keys() if 'tag_' in key]
+        return data
+
+
+class GroupIndex(object):
+    ''' The groups of an inventory being built. Every distinct name is only
+    passed to to_safe once, and the members of a group are kept in the order
+    they were added, without duplicates. update_inventory writes the groups
+    out as lists once all the instances are added. '''
+
+    def __init__(self, to_safe):
+        self.to_safe = to_safe
+        self.safe_names = {}
+        # Group name to its list of members, and to the same members as a
+        # set for the duplicate checks
+        self.members = {}
+        self.member_sets = {}
+        # Groups that only take their first member, see add_first
+        self.first_only = set()
+
+
+    def safe(self, name):
+        ''' Returns to_safe(name), memoized '''
+
+        try:
+            return self.safe_names[name]
+        except KeyError:
+            safe_name = self.safe_names[name] = self.to_safe(name)
+            return safe_name
+
+
+    def add(self, group, host):
+        ''' Adds host to group, unless it is already in it '''
+
+        member_set = self.member_sets.get(group)
+        if member_set is None:
+            self.member_sets[group] = set([host])
+            self.members[group] = [host]
+        elif host not in member_set:
+            member_set.add(host)
+            self.members[group].append(host)
+
+
+    def add_safe(self, group, host):
+        self.add(self.safe(group), host)
+
+
+    def add_first(self, group, host):
+        ''' Adds host to group only if the group is empty '''
+
+        self.first_only.add(group)
+        if group not in self.members:
+            self.add(group, host)
+
+
+    def merge(self, other):
+        ''' Adds the groups of another GroupIndex, as if its hosts had been
+        added to this one after the hosts already in it '''
+
+        for group, hosts in other.members.iteritems():
+            if group in other.first_only:
+                self.add_first(group, hosts[0])
+            else:
+                for host in hosts:
+                    self.add(group, host)
+
+
+    def update_inventory(self, inventory):
+        ''' Adds the groups to an inventory dict '''
+
+        inventory.update(self.members)
+
+
+class InventoryStats(object):
+    ''' Measurements of a run or refresh: API calls and their latency per
+    service and region, how the cache was used, the size of the inventory
+    and the time spent on each phase. ec2.py --stats prints them to stderr,
+    and every refresh appends them to stats_file as a JSON line. '''
+
+    def __init__(self):
+        import threading
+
+        self.lock = threading.Lock()
+        self.started_at = time()
+        self.api_calls = {}
+        self.cache = {'hit': None, 'age': None, 'refresh': None}
+        self.counts = {}
+        self.accounts = {}
+        self.timings = {}
+        self.memory = {'start_kb': self.max_rss_kb(), 'fetch_peak_kb': None, 'peak_kb': None}
+
+
+    def time_api_call(self, name, call, count=len):
+        ''' Returns call(), recording how long it took and the count(result)
+        items it returned under name. Safe to call from the fetch threads. '''
+
+        start = time()
+        failed = True
+        try:
+            result = call()
+            failed = False
+            return result
+        finally:
+            elapsed = time() - start
+            with self.lock:
+                calls = self.api_calls.setdefault(
+                    name, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0, 'items': 0})
+                calls['calls'] += 1
+                calls['seconds'] += elapsed
+                calls['max'] = max(calls['max'], elapsed)
+                if failed:
+                    calls['errors'] += 1
+                else:
+                    calls['items'] += count(result)
+
+
+    def max_rss_kb(self):
+        ''' Returns the largest resident set size of the process so far, in
+        kilobytes '''
+
+        import resource
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            # Reported in bytes there
+            max_rss //= 1024
+        return max_rss
+
+
+    def record_memory(self, name):
+        ''' Records the memory high-water mark under name. It covers the life
+        of the process, so it only tells about this refresh if it grew past
+        start_kb during it. '''
+
+        self.memory[name] = self.max_rss_kb()
+
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+    def count_inventory(self, inventory):
+        ''' Counts the hosts and groups of an inventory dict '''
+
+        self.counts['hosts'] = len(inventory["_meta"]["hostvars"])
+        self.counts['groups'] = len(inventory) - 1
+        for service in ('ec2', 'rds'):
+            self.counts[service + '_instances'] = sum(
+                calls['items'] for name, calls in self.api_calls.iteritems()
+                if name.split('/')[-2] == service and not name.endswith('/all'))
+
+
+    def count_account(self, account, source, inventory):
+        ''' Counts the hosts and groups of an account's inventory, and records
+        whether it came from the API, its cache or, after a failed refresh,
+        its stale cache. The api_calls and the instance counts only cover
+        the accounts that were refreshed. '''
+
+        self.accounts[account] = {
+            'source': source,
+            'hosts': len(inventory["_meta"]["hostvars"]),
+            'groups': len(inventory) - 1,
+        }
+
+
+    def as_dict(self):
+        return {
+            'time': self.started_at,
+            'elapsed': time() - self.started_at,
+            'accounts': self.accounts,
+            'api_calls': self.api_calls,
+            'cache': self.cache,
+            'counts': self.counts,
+            'memory': self.memory,
+            'timings': self.timings,
+        }
+
+
+    def append_to(self, filename):
+        ''' Appends the stats to filename as one JSON line '''
+
+        stats_file = open(filename, 'a')
+        try:
+            stats_file.write(json.dumps(self.as_dict(), sort_keys=True) + '\n')
+        finally:
+            stats_file.close()
+
+
+    def report(self, out):
+        ''' Writes the stats to out in a readable form '''
+
+        age = self.cache['age']
+        out.write("cache: %s, age %s, refresh: %s\n" % (
+            'hit' if self.cache['hit'] else 'miss',
+            '-' if age is None else '%.0fs' % age,
+            self.cache['refresh'] or 'none'))
+        for name in sorted(self.api_calls):
+            calls = self.api_calls[name]
+            out.write("api %-30s %4d calls %4d errors %8.3fs total %8.3fs max %7d items\n" % (
+                name, calls['calls'], calls['errors'], calls['seconds'], calls['max'], calls['items']))
+        for name in sorted(self.counts):
+            out.write("count %-20s %d\n" % (name, self.counts[name]))
+        for name in sorted(self.accounts):
+            account = self.accounts[name]
+            out.write("account %-28s from %-11s %7d hosts %7d groups\n" % (
+                name, account['source'], account['hosts'], account['groups']))
+        if self.memory['peak_kb'] is not None:
+            out.write("memory peak %d KB, %d KB after fetching, %d KB at start\n" % (
+                self.memory['peak_kb'], self.memory['fetch_peak_kb'], self.memory['start_kb']))
+        for name in sorted(self.timings):
+            out.write("time %-21s %.3fs\n" % (name, self.timings[name]))
+        out.write("time %-21s %.3fs\n" % ('elapsed', time() - self.started_at))
+
+
+class InventoryDaemon(object):
+    ''' Keeps the inventory of an Ec2Inventory in memory and serves it to
+    ec2.py over a Unix socket, refreshing it every daemon_refresh_interval
+    seconds or when asked to.
+
+    Each connection carries one request line and gets one response: a status
+    line, OK or MISS and the path of the cache file the daemon keeps, so that
+    ec2.py only uses answers built with its own settings, followed by the
+    body. The requests are:
+        list          the --list output
+        host <name>   the --host output, MISS if the host is unknown
+        refresh       schedule a refresh now
+        stats         refresh timings and request latencies, and the
+                      InventoryStats of the last refresh, as JSON
+    '''
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+        self.cache_path = os.path.realpath(inventory.cache_path_cache)
+        self.list_json = None
+        self.hostvars = {}
+
+        self.stats = {
+            'started_at': time(),
+            'refreshes': {'count': 0, 'failures': 0, 'last': None, 'total': 0.0, 'max': 0.0},
+            'last_refresh': None,
+            'requests': {},
+        }
+
+        import threading
+        self.stats_lock = threading.Lock()
+        self.refresh_requested = threading.Event()
+        self.stopping = threading.Event()
+        self.server = None
+
+
+    def load(self, inventory):
+        ''' Swaps in a new inventory. Requests being answered keep using the
+        old one, so no locking is needed around the reads. '''
+
+        hostvars = inventory["_meta"]["hostvars"]
+        self.list_json = json.dumps(inventory)
+        self.hostvars = hostvars
+
+
+    def refresh(self):
+        ''' Rebuilds the inventory from the API and the cache files '''
+
+        inventory = self.inventory
+        inventory.inventory = inventory._empty_inventory()
+        inventory.index = {}
+        inventory.stats = InventoryStats()
+        inventory.stats.cache['refresh'] = 'daemon'
+
+        start = time()
+        try:
+            inventory.refresh_cache(force=True)
+        except BaseException as e:
+            # API errors end with sys.exit; keep serving the last inventory
+            with self.stats_lock:
+                self.stats['refreshes']['failures'] += 1
+            sys.stderr.write("ec2.py daemon: refresh failed: %r\n" % e)
+            return
+        elapsed = time() - start
+
+        self.load(inventory.inventory)
+        with self.stats_lock:
+            refreshes = self.stats['refreshes']
+            refreshes['count'] += 1
+            refreshes['last'] = elapsed
+            refreshes['total'] += elapsed
+            refreshes['max'] = max(refreshes['max'], elapsed)
+            self.stats['last_refresh'] = inventory.stats.as_dict()
+        sys.stderr.write("ec2.py daemon: refreshed %d hosts in %.2fs\n" % (
+            len(self.hostvars), elapsed))
+
+
+    def refresh_forever(self):
+        while not self.stopping.is_set():
+            self.refresh_requested.wait(self.inventory.daemon_refresh_interval)
+            self.refresh_requested.clear()
+            if not self.stopping.is_set():
+                self.refresh()
+
+
+    def shutdown(self):
+        ''' Makes serve_forever return '''
+
+        self.stopping.set()
+        self.refresh_requested.set()
+        if self.server:
+            self.server.shutdown()
+
+
+    def answer(self, request):
+        ''' Returns the (status, body) answer to a request line '''
+
+        (command, _, argument) = request.strip().partition(' ')
+        if command == 'list' and self.list_json is not None:
+            return ('OK', self.list_json)
+        elif command == 'host' and argument in self.hostvars:
+            return ('OK', json.dumps(self.hostvars[argument], sort_keys=True, indent=2))
+        elif command == 'refresh':
+            self.refresh_requested.set()
+            return ('OK', '{}')
+        elif command == 'stats':
+            with self.stats_lock:
+                return ('OK', json.dumps(self.stats, sort_keys=True, indent=2))
+        return ('MISS', '')
+
+
+    def record_request(self, command, elapsed):
+        with self.stats_lock:
+            requests = self.stats['requests'].setdefault(
+                command, {'count': 0, 'total': 0.0, 'max': 0.0})
+            requests['count'] += 1
+            requests['total'] += elapsed
+            requests['max'] = max(requests['max'], elapsed)
+
+
+    def serve_forever(self):
+        ''' Loads the inventory and answers requests until interrupted '''
+
+        import socket
+        import threading
+        import SocketServer
+
+        path = self.inventory.daemon_socket
+        if not path:
+            print "--daemon needs daemon_socket to be set in %s" % self.inventory.args.inifile
+            sys.exit(1)
+
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # Left behind by a daemon that is gone
+                os.unlink(path)
+            else:
+                print "An inventory daemon is already listening on %s" % path
+                sys.exit(1)
+            finally:
+                probe.close()
+
+        # Start from the cache if it is fresh enough, the API otherwise
+        if self.inventory.is_cache_valid():
+            self.load(self.inventory.read_cache(self.inventory.cache_path_cache))
+        else:
+            self.refresh()
+
+        refresher = threading.Thread(target=self.refresh_forever)
+        refresher.daemon = True
+        refresher.start()
+
+        daemon = self
+
+        class RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                start = time()
+                request = self.rfile.readline()
+                (status, body) = daemon.answer(request)
+                self.wfile.write(status + ' ' + daemon.cache_path + '\n' + body)
+                daemon.record_request(request.split(' ', 1)[0].strip(), time() - start)
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        self.server = Server(path, RequestHandler)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopping.set()
+            self.refresh_requested.set()
+            self.server.server_close()
+            os.unlink(path)
+            refresher.join()
+
+
 # Run the script
-Ec2Inventory()
+if __name__ == '__main__':
+    if not CachedInventory().answer_from_cache(sys.argv[1:]):
+        Ec2Inventory()
 
@@ -27,21 +27,36 @@ group and state.
   ]
 
 }
+
+Only the instances in autoscaling groups are described, in batches of
+INSTANCE_BATCH_SIZE IDs fetched concurrently. Set --cache-ttl (or
+LIFECYCLE_INVENTORY_CACHE_TTL) to a number of seconds to reuse the inventory
+for that long, e.g. across the plays of one deploy. Lifecycle states change
+quickly, so keep it short; it is off by default.
 """
 import argparse
 import boto
 import boto.ec2.autoscale
 import json
+import os
+import tempfile
+import time
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from os import environ
 
+# Instance IDs per DescribeInstances call, and calls made at once
+INSTANCE_BATCH_SIZE = 100
+MAX_WORKERS = 8
+
 class LifecycleInventory():
 
     profile = None
 
-    def __init__(self, profile):
+    def __init__(self, profile, cache_ttl=0):
         parser = argparse.ArgumentParser()
         self.profile = profile
+        self.cache_ttl = cache_ttl
 
     def get_e_d_from_tags(self, group):
 
@@ -55,28 +70,100 @@ class LifecycleInventory():
                 deployment = r.value
         return environment,deployment
 
-    def get_instance_dict(self):
+    def get_groups(self):
+        """
+        Returns every autoscaling group, following the pages of the listing.
+        """
+        asg = boto.ec2.autoscale.connect_to_region(region,profile_name=self.profile)
+
+        groups = []
+        next_token = None
+        while True:
+            page = asg.get_all_groups(next_token=next_token)
+            groups.extend(page)
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                return groups
+
+    def get_instances(self, instance_ids):
+        """
+        Describes a batch of instances. Each batch gets its own connection,
+        since the batches are fetched from several threads. The IDs are
+        passed as a filter, which unlike instance_ids doesn't fail the whole
+        batch when one of them was terminated meanwhile.
+        """
         ec2 = boto.ec2.connect_to_region(region,profile_name=self.profile)
-        reservations = ec2.get_all_instances()
+        reservations = ec2.get_all_instances(filters={'instance-id': instance_ids})
+        return [i for r in reservations for i in r.instances]
+
+    def get_instance_dict(self, instance_ids):
+        instance_ids = sorted(set(instance_ids))
+        batches = [instance_ids[i:i + INSTANCE_BATCH_SIZE]
+                   for i in range(0, len(instance_ids), INSTANCE_BATCH_SIZE)]
 
         dict = {}
+        if not batches:
+            return dict
 
-        for instance in [i for r in reservations for i in r.instances]:
-            dict[instance.id] = instance
+        pool = ThreadPool(min(MAX_WORKERS, len(batches)))
+        try:
+            for instances in pool.map(self.get_instances, batches):
+                for instance in instances:
+                    dict[instance.id] = instance
+        finally:
+            pool.terminate()
 
         return dict
 
+    def get_cache_path(self):
+        return os.path.join(tempfile.gettempdir(), "lifecycle_inventory-{}-{}.json".format(
+            self.profile or "default", region))
+
+    def read_cache(self):
+        """
+        Returns the cached inventory if it is younger than cache_ttl seconds.
+        """
+        if self.cache_ttl <= 0:
+            return None
+        path = self.get_cache_path()
+        try:
+            if time.time() - os.path.getmtime(path) >= self.cache_ttl:
+                return None
+            with open(path) as cache:
+                return json.load(cache)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_cache(self, inventory):
+        path = self.get_cache_path()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+        with os.fdopen(fd, 'w') as cache:
+            json.dump(inventory, cache)
+        os.rename(tmp_path, path)
+
     def run(self):
-        asg = boto.ec2.autoscale.connect_to_region(region,profile_name=self.profile)
-        groups = asg.get_all_groups()
+        inventory = self.read_cache()
+        if inventory is None:
+            inventory = self.build_inventory()
+            if self.cache_ttl > 0:
+                self.write_cache(inventory)
+
+        print json.dumps(inventory, sort_keys=True, indent=2)
 
-        instances = self.get_instance_dict()
+    def build_inventory(self):
+        groups = self.get_groups()
+
+        instances = self.get_instance_dict(
+            [instance.instance_id for group in groups for instance in group.instances])
         inventory = defaultdict(list)
 
         for group in groups:
 
             for instance in group.instances:
 
+                if instance.instance_id not in instances:
+                    # Terminated since the groups were listed
+                    continue
                 private_ip_address = instances[instance.instance_id].private_ip_address
                 if private_ip_address:
                     environment,deployment = self.get_e_d_from_tags(group)
@@ -85,15 +172,17 @@ class LifecycleInventory():
                     inventory[group.name + "_" + instance.lifecycle_state.replace(":","_")].append(private_ip_address)
                     inventory[instance.lifecycle_state.replace(":","_")].append(private_ip_address)
 
-        print json.dumps(inventory, sort_keys=True, indent=2)
+        return inventory
 
 if __name__=="__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--profile', help='The aws profile to use when connecting.')
     parser.add_argument('-l', '--list', help='Ansible passes this, we ignore it.', action='store_true', default=True)
+    parser.add_argument('--cache-ttl', type=int, default=int(environ.get('LIFECYCLE_INVENTORY_CACHE_TTL', 0)),
+                        help='Seconds to reuse the inventory for (default: 0, no cache).')
     args = parser.parse_args()
 
     region = environ.get('AWS_REGION','us-east-1')
 
-    LifecycleInventory(args.profile).run()
+    LifecycleInventory(args.profile, args.cache_ttl).run()
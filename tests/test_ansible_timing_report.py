@@ -0,0 +1,129 @@
+# Tests for util/ansible_timing_report.py
+#
+# The timing logs are written to a temporary directory, in the format the
+# task_timing callback plugin writes them.
+#
+# How to run these tests:
+# 1. python tests/test_ansible_timing_report.py
+
+import gzip
+import imp
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'util', 'ansible_timing_report.py')
+ansible_timing_report = imp.load_source('ansible_timing_report', REPORT)
+
+
+def task_record(task, started_at, duration, playbook='edxapp', **fields):
+  record = {'playbook': playbook, 'task': task, 'started_at': started_at, 'duration': duration}
+  record.update(fields)
+  return record
+
+
+class ReportTestCase(unittest.TestCase):
+  def setUp(self):
+    self.log_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.log_dir)
+
+  def write_log(self, name, records, opener=open):
+    path = os.path.join(self.log_dir, name)
+    with opener(path, 'wb') as log:
+      for record in records:
+        log.write(json.dumps(record) + '\n')
+    return path
+
+  def aggregate(self, paths):
+    errors = {'skipped': 0}
+    (playbooks, tasks) = ansible_timing_report.aggregate(
+      ansible_timing_report.read_records(paths, errors), ansible_timing_report.SAMPLE_SIZE, 10)
+    return playbooks, tasks, errors
+
+
+class TestSeries(unittest.TestCase):
+  def series(self, durations):
+    series = ansible_timing_report.Series(1000, 11, random.Random(0))
+    for index, duration in enumerate(durations):
+      series.add('2017-01-{0:02d}T00:00:00'.format(index + 1), duration)
+    return series
+
+  def test_percentiles(self):
+    series = self.series(range(1, 101))
+    self.assertEqual(50, series.percentile(0.5))
+    self.assertEqual(95, series.percentile(0.95))
+    self.assertEqual({'count': 100, 'total': 5050.0, 'p50': 50, 'p95': 95, 'max': 100}, series.summary())
+
+  def test_sample_bounded(self):
+    series = ansible_timing_report.Series(10, 11, random.Random(0))
+    for duration in range(1000):
+      series.add('', duration)
+    self.assertEqual(10, len(series.sample))
+    self.assertEqual(1000, series.count)
+    self.assertEqual(999, series.max)
+
+  def test_regression(self):
+    regression = self.series([10, 11, 9, 10, 30]).regression(0.5, 5)
+    self.assertEqual({'started_at': '2017-01-05T00:00:00', 'newest': 30, 'baseline': 10, 'runs': 4},
+                     regression)
+
+  def test_no_regression_under_min_seconds(self):
+    self.assertIsNone(self.series([1, 1, 1, 3]).regression(0.5, 5))
+    self.assertIsNone(self.series([10, 10, 10, 12]).regression(0.5, 1))
+
+
+class TestReport(ReportTestCase):
+  def test_revised_task_counted_once(self):
+    path = self.write_log('timing.log', [
+      task_record('slow task', '2017-01-01T00:00:00', 1.0),
+      task_record('slow task', '2017-01-02T00:00:00', 2.0),
+      task_record('slow task', '2017-01-02T00:00:00', 40.0, revises=2.0),
+    ])
+    (_, tasks, _) = self.aggregate([path])
+    series = tasks[('edxapp', 'slow task')]
+    self.assertEqual(2, series.count)
+    self.assertEqual(41.0, series.total)
+    self.assertEqual(40.0, series.max)
+    self.assertEqual([1.0, 40.0], sorted(series.sample))
+    self.assertEqual(40.0, series.regression(0.5, 5)['newest'])
+
+  def test_revision_without_original(self):
+    # The record it revises was in a log that wasn't read
+    path = self.write_log('timing.log', [task_record('slow task', '2017-01-02T00:00:00', 40.0, revises=2.0)])
+    (_, tasks, _) = self.aggregate([path])
+    self.assertEqual(1, tasks[('edxapp', 'slow task')].count)
+
+  def test_gzip_and_directories(self):
+    self.write_log('timing.log.1.gz', [task_record('install', '2017-01-01T00:00:00', 1.0)], opener=gzip.open)
+    self.write_log('timing.log', [
+      task_record('install', '2017-01-02T00:00:00', 3.0),
+      {'playbook': 'edxapp', 'started_at': '2017-01-02T00:00:00', 'duration': 60.0, 'tasks': 1},
+    ])
+    with open(os.path.join(self.log_dir, 'timing.log'), 'a') as log:
+      log.write('not json\n')
+
+    (playbooks, tasks, errors) = self.aggregate([self.log_dir])
+    self.assertEqual(4.0, tasks[('edxapp', 'install')].total)
+    self.assertEqual(1, playbooks['edxapp'].count)
+    self.assertEqual(1, errors['skipped'])
+
+  def test_non_ascii_names_in_text(self):
+    self.write_log('timing.log', [
+      task_record(u'Cr\xe9er le r\xe9pertoire', '2017-01-01T00:00:00', 1.0, playbook=u'd\xe9ployer'),
+    ])
+    environ = dict(os.environ, LC_ALL='C', LANG='C')
+    environ.pop('PYTHONIOENCODING', None)
+    output = subprocess.check_output([sys.executable, REPORT, self.log_dir], env=environ)
+    self.assertIn(u'd\xe9ployer | Cr\xe9er le r\xe9pertoire', output.decode('utf-8'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,83 @@
+# Tests for the controller_profile callback plugin
+#
+# The callbacks are called with stand-ins for ansible's play and task
+# objects, and the profiles are written to a temporary directory.
+#
+# How to run these tests:
+# 1. pip install ansible
+# 2. python tests/test_controller_profile.py
+
+import glob
+import imp
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'playbooks', 'callback_plugins', 'controller_profile.py')
+controller_profile = imp.load_source('controller_profile', PLUGIN)
+
+
+class Play(object):
+  def __init__(self, name, strategy='linear'):
+    self.name = name
+    self.strategy = strategy
+
+  def get_name(self):
+    return self.name
+
+
+class Task(object):
+  def __init__(self, uuid, name):
+    self._uuid = uuid
+    self.name = name
+
+  def get_name(self):
+    return self.name
+
+
+class TestCallbackModule(unittest.TestCase):
+  def setUp(self):
+    self.profile_dir = tempfile.mkdtemp()
+    controller_profile.ANSIBLE_PROFILE_DIR = self.profile_dir
+    self.environ = dict(os.environ)
+    os.environ['ANSIBLE_PROFILE_MODES'] = 'cpu'
+
+  def tearDown(self):
+    controller_profile.ANSIBLE_PROFILE_DIR = None
+    shutil.rmtree(self.profile_dir)
+    os.environ.clear()
+    os.environ.update(self.environ)
+
+  def run_play(self, strategy):
+    plugin = controller_profile.CallbackModule()
+    plugin.v2_playbook_on_play_start(Play('deploy', strategy))
+    sleep_more = Task('uuid-1', 'sleep more')
+    # Under the free strategy, once per host reaching the task
+    plugin.v2_playbook_on_task_start(sleep_more, False)
+    plugin.v2_playbook_on_task_start(sleep_more, False)
+    plugin.v2_playbook_on_task_start(Task('uuid-2', 'skip me'), False)
+    plugin.playbook_on_stats(None)
+
+    (run_dir,) = glob.glob(os.path.join(self.profile_dir, 'run-*'))
+    with open(os.path.join(run_dir, 'tasks.jsonl')) as tasks_log:
+      records = [json.loads(line) for line in tasks_log]
+    profiles = sorted(os.path.basename(path) for path in glob.glob(os.path.join(run_dir, 'task-*.prof')))
+    return records, profiles
+
+  def test_free_strategy_task_profiled_once(self):
+    (records, profiles) = self.run_play('free')
+    self.assertEqual(['sleep more', 'skip me'], [record['task'] for record in records])
+    self.assertEqual(['task-0001-sleep-more.prof', 'task-0002-skip-me.prof'], profiles)
+
+  def test_linear_strategy_repeated_task(self):
+    # Only the free strategy's repeated starts are left out
+    (records, profiles) = self.run_play('linear')
+    self.assertEqual(['sleep more', 'sleep more', 'skip me'], [record['task'] for record in records])
+    self.assertEqual(3, len(profiles))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,167 @@
+# Tests for the hipchat callback plugin's notifier
+#
+# The messages are sent to a local HTTP server standing in for HipChat
+# and for a webhook, so no HipChat account or network access is needed.
+#
+# How to run these tests:
+# 1. pip install ansible hipchat prettytable mock
+# 2. python tests/test_hipchat_plugin.py
+
+import imp
+import json
+import os
+import threading
+import time
+import unittest
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'playbooks', 'callback_plugins', 'hipchat_plugin.py')
+hipchat_plugin = imp.load_source('hipchat_plugin', PLUGIN)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_POST(self):
+    length = int(self.headers.getheader('content-length', 0))
+    body = self.rfile.read(length)
+    time.sleep(self.server.latency)
+    if self.headers.getheader('content-type') == 'application/json':
+      params = json.loads(body)
+    else:
+      params = dict((key, values[0]) for key, values in urlparse.parse_qs(body).items())
+    with self.server.lock:
+      self.server.posts.append((urlparse.urlparse(self.path).path, params))
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.end_headers()
+    self.wfile.write('{"status": "sent"}')
+
+  def log_message(self, *args):
+    pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class NotifierTestCase(unittest.TestCase):
+  latency = 0
+
+  def setUp(self):
+    self.server = StubServer(('127.0.0.1', 0), StubHandler)
+    self.server.latency = self.latency
+    self.server.lock = threading.Lock()
+    self.server.posts = []
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+class TestCallbackModule(NotifierTestCase):
+  latency = 0.5
+
+  def setUp(self):
+    super(TestCallbackModule, self).setUp()
+    self.environ = dict(os.environ)
+    os.environ.update({
+      'HIPCHAT_TOKEN': 'token',
+      'HIPCHAT_URL': self.url + 'v1/',
+      'HIPCHAT_RATE_LIMIT': '0',
+    })
+
+  def tearDown(self):
+    os.environ.clear()
+    os.environ.update(self.environ)
+    super(TestCallbackModule, self).tearDown()
+
+  def test_failures_coalesced_without_blocking(self):
+    plugin = hipchat_plugin.CallbackModule()
+
+    start = time.time()
+    plugin.playbook_on_task_start('install packages', False)
+    for host in range(200):
+      plugin.runner_on_failed('host{}'.format(host), {'msg': 'No package matching foo'})
+    plugin.playbook_on_task_start('next task', False)
+    self.assertLess(time.time() - start, self.latency)
+
+    plugin.notifier.flush()
+    self.assertEqual(1, len(self.server.posts))
+    (path, params) = self.server.posts[0]
+    self.assertEqual('/v1/rooms/message', path)
+    self.assertIn('errors on 200 hosts', params['message'])
+    self.assertIn('No package matching foo', params['message'])
+    self.assertIn('and 190 more', params['message'])
+
+  def test_single_failure(self):
+    plugin = hipchat_plugin.CallbackModule()
+    plugin.playbook_on_task_start('install packages', False)
+    plugin.runner_on_failed('host0', {'msg': 'No package matching foo'})
+    plugin.notifier.flush()
+    self.assertEqual(1, len(self.server.posts))
+    self.assertIn('returned the following error:\n\n No package matching foo',
+                  self.server.posts[0][1]['message'])
+
+
+class TestNotifier(NotifierTestCase):
+  def test_webhook_sink(self):
+    notifier = hipchat_plugin.Notifier([hipchat_plugin.WebhookSink(self.url + 'hook')])
+    notifier.send('deployed', color='green')
+    notifier.flush()
+    self.assertEqual([('/hook', {'text': 'deployed', 'color': 'green', 'format': 'text', 'notify': False})],
+                     self.server.posts)
+
+  def test_rate_limit(self):
+    notifier = hipchat_plugin.Notifier([hipchat_plugin.WebhookSink(self.url)], rate_limit=240)
+    start = time.time()
+    for i in range(3):
+      notifier.send('message {}'.format(i))
+    notifier.flush()
+    self.assertGreaterEqual(time.time() - start, 0.5)
+    self.assertEqual(['message 0', 'message 1', 'message 2'],
+                     [params['text'] for (path, params) in self.server.posts])
+
+  def test_failure_window(self):
+    notifier = hipchat_plugin.Notifier([hipchat_plugin.WebhookSink(self.url)], window=0.2)
+    notifier.failure('task', 'host0', 'error')
+    notifier.failure('task', 'host1', 'error')
+    time.sleep(1.5)
+    self.assertEqual(1, len(self.server.posts))
+    self.assertIn('errors on 2 hosts', self.server.posts[0][1]['text'])
+    notifier.flush()
+    self.assertEqual(1, len(self.server.posts))
+
+  def test_failing_sink(self):
+    notifier = hipchat_plugin.Notifier([hipchat_plugin.WebhookSink('http://127.0.0.1:1/'),
+                                        hipchat_plugin.WebhookSink(self.url)])
+    notifier.send('message')
+    notifier.flush()
+    self.assertEqual(1, len(self.server.posts))
+
+
+class TestSlowNotifier(NotifierTestCase):
+  latency = 0.5
+
+  def test_flush_timeout(self):
+    notifier = hipchat_plugin.Notifier([hipchat_plugin.WebhookSink(self.url)], rate_limit=0)
+    notifier.send('message 0')
+    notifier.send('message 1')
+    notifier.flush(timeout=0.1)
+    self.assertTrue(notifier.worker.is_alive())
+
+    # Neither a second worker nor a message after the flush
+    notifier.send('message 2')
+    notifier.worker.join(5)
+    self.assertEqual(['message 0', 'message 1'],
+                     [params['text'] for (path, params) in self.server.posts])
+    self.assertEqual(1, notifier.dropped)
+
+
+if __name__ == '__main__':
+  unittest.main()
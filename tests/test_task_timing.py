@@ -0,0 +1,312 @@
+# Tests for the task_timing callback plugin's Datadog, JSON and Prometheus
+# loggers
+#
+# The timings are sent to a local UDP socket standing in for DogStatsD and
+# to a local HTTP server standing in for the Datadog API, so no Datadog
+# account or network access is needed. The JSON logs and Prometheus files
+# are written to a temporary directory.
+#
+# How to run these tests:
+# 1. pip install ansible datadog mock
+# 2. python tests/test_task_timing.py
+
+import imp
+import json
+import os
+import Queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+import BaseHTTPServer
+import SocketServer
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'playbooks', 'callback_plugins', 'task_timing.py')
+task_timing = imp.load_source('task_timing', PLUGIN)
+
+
+def finished_timestamp(seconds):
+  timestamp = task_timing.Timestamp()
+  timestamp.stop(timestamp.clock_start + seconds)
+  return timestamp
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_POST(self):
+    length = int(self.headers.getheader('content-length', 0))
+    body = self.rfile.read(length)
+    if self.headers.getheader('content-encoding') == 'deflate':
+      body = zlib.decompress(body)
+    time.sleep(self.server.latency)
+    with self.server.lock:
+      self.server.payloads.append((length, json.loads(body)))
+    self.send_response(202)
+    self.send_header('Content-Type', 'application/json')
+    self.end_headers()
+    self.wfile.write('{"status": "ok"}')
+
+  def log_message(self, *args):
+    pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class DatadogTestCase(unittest.TestCase):
+  def setUp(self):
+    self.environ = dict(os.environ)
+    for name in ['DATADOG_API_KEY', 'DATADOG_STATSD_HOST', 'DATADOG_STATSD_PORT',
+                 'DATADOG_MAX_PAYLOAD', 'DATADOG_FLUSH_TIMEOUT']:
+      os.environ.pop(name, None)
+
+  def tearDown(self):
+    os.environ.clear()
+    os.environ.update(self.environ)
+
+
+class TestStatsd(DatadogTestCase):
+  def setUp(self):
+    super(TestStatsd, self).setUp()
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.settimeout(5)
+    os.environ['DATADOG_STATSD_HOST'] = '127.0.0.1'
+    os.environ['DATADOG_STATSD_PORT'] = str(self.listener.getsockname()[1])
+
+  def tearDown(self):
+    self.listener.close()
+    super(TestStatsd, self).tearDown()
+
+  def test_task_sent_when_it_finishes(self):
+    logger = task_timing.DatadogTimingLogger()
+    timestamp = finished_timestamp(1.5)
+    logger.log_task('edxapp', 'Install packages', timestamp)
+    self.assertEqual('edx.ansible.task_duration:1.5|g|#task:install-packages,playbook:edxapp',
+                     self.listener.recv(4096))
+
+    logger.log_play('edxapp', finished_timestamp(10), {'Install packages': timestamp})
+    self.assertEqual('edx.ansible.playbook_duration:10.0|g|#playbook:edxapp', self.listener.recv(4096))
+
+
+class TestApi(DatadogTestCase):
+  def setUp(self):
+    super(TestApi, self).setUp()
+    self.server = StubServer(('127.0.0.1', 0), StubHandler)
+    self.server.latency = 0
+    self.server.lock = threading.Lock()
+    self.server.payloads = []
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    os.environ['DATADOG_API_KEY'] = 'key'
+    os.environ['DATADOG_HOST'] = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    super(TestApi, self).tearDown()
+
+  def log_tasks(self, logger, count):
+    results = {}
+    for task in range(count):
+      name = 'task {}'.format(task)
+      results[name] = finished_timestamp(0.5)
+      logger.log_task('edxapp', name, results[name])
+    return results
+
+  def test_payloads_chunked(self):
+    os.environ['DATADOG_MAX_PAYLOAD'] = '10000'
+    logger = task_timing.DatadogTimingLogger()
+    results = self.log_tasks(logger, 1000)
+    logger.log_play('edxapp', finished_timestamp(600), results)
+
+    series = [metric for (_, payload) in self.server.payloads for metric in payload['series']]
+    self.assertEqual(1001, len(series))
+    self.assertEqual(1000, len([metric for metric in series if metric['metric'] == 'edx.ansible.task_duration']))
+    self.assertEqual('edx.ansible.playbook_duration', series[-1]['metric'])
+    self.assertGreater(len(self.server.payloads), 10)
+    for (length, _) in self.server.payloads:
+      self.assertLessEqual(length, 10000)
+
+  def test_late_results_replace_points(self):
+    logger = task_timing.DatadogTimingLogger()
+    timestamp = task_timing.TaskTimestamp()
+    timestamp.host_finished('fast', 'ok')
+    timestamp.stop()
+    logger.log_task('edxapp', 'slow task', timestamp)
+
+    # Under the free strategy, the slow host comes back after the task
+    # was logged
+    time.sleep(0.2)
+    timestamp.host_finished('slow', 'ok')
+    timestamp.stop()
+    logger.log_play('edxapp', finished_timestamp(600), {'slow task': timestamp})
+
+    series = [metric for (_, payload) in self.server.payloads for metric in payload['series']
+              if metric['metric'] == 'edx.ansible.task_host_duration.max']
+    self.assertEqual(2, len(series))
+    self.assertEqual(series[0]['points'][0][0], series[1]['points'][0][0])
+    self.assertLess(series[0]['points'][0][1], 0.2)
+    self.assertGreaterEqual(series[1]['points'][0][1], 0.2)
+
+  def test_flush_timeout(self):
+    os.environ['DATADOG_MAX_PAYLOAD'] = '1000'
+    os.environ['DATADOG_FLUSH_TIMEOUT'] = '0.5'
+    self.server.latency = 2
+    logger = task_timing.DatadogTimingLogger()
+
+    start = time.time()
+    results = self.log_tasks(logger, 100)
+    self.assertLess(time.time() - start, 1)
+    (sender, payloads) = (logger.sender, logger.payloads)
+    logger.log_play('edxapp', finished_timestamp(600), results)
+    self.assertLess(time.time() - start, 1.5)
+
+    # Stop the sender the flush gave up on before the server goes away
+    try:
+      while True:
+        payloads.get_nowait()
+    except Queue.Empty:
+      pass
+    payloads.put(logger.STOP)
+    sender.join(5)
+    self.assertFalse(sender.is_alive())
+
+
+class TestJsonLog(unittest.TestCase):
+  def setUp(self):
+    self.environ = dict(os.environ)
+    self.log_dir = tempfile.mkdtemp()
+    self.log_path = os.path.join(self.log_dir, 'timing.log')
+    task_timing.ANSIBLE_TIMER_LOG = self.log_path
+
+  def tearDown(self):
+    task_timing.ANSIBLE_TIMER_LOG = None
+    shutil.rmtree(self.log_dir)
+    os.environ.clear()
+    os.environ.update(self.environ)
+
+  def logger(self, **settings):
+    for name, value in settings.items():
+      os.environ['ANSIBLE_TIMER_LOG_' + name.upper()] = str(value)
+    return task_timing.JsonTimingLogger()
+
+  def read(self, path=None):
+    with open(path or self.log_path) as log:
+      return [json.loads(line) for line in log]
+
+  def test_batched_until_full(self):
+    logger = self.logger(batch=3, flush_interval=60)
+    logger.log_task('edxapp', 'task 0', finished_timestamp(1))
+    logger.log_task('edxapp', 'task 1', finished_timestamp(1))
+    self.assertFalse(os.path.exists(self.log_path))
+
+    logger.log_task('edxapp', 'task 2', finished_timestamp(1))
+    self.assertEqual(['task 0', 'task 1', 'task 2'], [record['task'] for record in self.read()])
+
+  def test_flush_interval(self):
+    logger = self.logger(batch=100, flush_interval=0.2)
+    logger.log_task('edxapp', 'task 0', finished_timestamp(1))
+    self.assertFalse(os.path.exists(self.log_path))
+
+    time.sleep(1)
+    self.assertEqual(['task 0'], [record['task'] for record in self.read()])
+
+  def test_rotation(self):
+    logger = self.logger(batch=1, max_bytes=200, backups=2)
+    for task in range(5):
+      logger.log_task('edxapp', 'task {}'.format(task), finished_timestamp(1))
+
+    # Each record fills most of a file, so each one starts a new file
+    self.assertEqual(['task 4'], [record['task'] for record in self.read()])
+    self.assertEqual(['task 3'], [record['task'] for record in self.read(self.log_path + '.1')])
+    self.assertEqual(['task 2'], [record['task'] for record in self.read(self.log_path + '.2')])
+    self.assertFalse(os.path.exists(self.log_path + '.3'))
+
+  def test_shared_log(self):
+    def write(writer):
+      logger = self.logger(batch=1, max_bytes=5000, backups=100)
+      for task in range(200):
+        logger.log_task(writer, 'task {}'.format(task), finished_timestamp(1))
+
+    writers = [threading.Thread(target=write, args=('writer {}'.format(writer),)) for writer in range(2)]
+    for writer in writers:
+      writer.start()
+    for writer in writers:
+      writer.join()
+
+    backups = sorted(
+      (int(name.rsplit('.', 1)[1]) for name in os.listdir(self.log_dir) if name != 'timing.log'),
+      reverse=True
+    )
+    records = []
+    for backup in backups:
+      path = '{}.{}'.format(self.log_path, backup)
+      self.assertLessEqual(os.path.getsize(path), 5000)
+      records.extend(self.read(path))
+    records.extend(self.read())
+
+    # Oldest first, no record lost or torn, and each writer's in order
+    for writer in ['writer 0', 'writer 1']:
+      self.assertEqual(['task {}'.format(task) for task in range(200)],
+                       [record['task'] for record in records if record['playbook'] == writer])
+
+  def test_late_results_revised(self):
+    logger = self.logger(batch=100, flush_interval=60)
+    timestamp = task_timing.TaskTimestamp()
+    timestamp.host_finished('fast', 'ok')
+    timestamp.stop()
+    logger.log_task('edxapp', 'slow task', timestamp)
+
+    time.sleep(0.2)
+    timestamp.host_finished('slow', 'ok')
+    timestamp.stop()
+    logger.log_play('edxapp', finished_timestamp(600), {'slow task': timestamp})
+
+    (logged, revised, playbook) = self.read()
+    self.assertEqual(['fast'], sorted(logged['hosts']))
+    self.assertEqual(['fast', 'slow'], sorted(revised['hosts']))
+    self.assertEqual(logged['duration'], revised['revises'])
+    self.assertGreaterEqual(revised['duration'], 0.2)
+    self.assertEqual(logged['started_at'], revised['started_at'])
+    self.assertEqual(1, playbook['tasks'])
+
+
+class TestPrometheus(unittest.TestCase):
+  def setUp(self):
+    self.prom_dir = tempfile.mkdtemp()
+    self.prom_path = os.path.join(self.prom_dir, 'ansible.prom')
+    task_timing.ANSIBLE_PROMETHEUS_FILE = self.prom_path
+
+  def tearDown(self):
+    task_timing.ANSIBLE_PROMETHEUS_FILE = None
+    shutil.rmtree(self.prom_dir)
+
+  def test_late_results_and_non_ascii_names(self):
+    logger = task_timing.PrometheusTimingLogger()
+    name = u'Cr\xe9er le r\xe9pertoire'
+    timestamp = task_timing.TaskTimestamp(play=u'D\xe9ployer')
+    timestamp.host_finished('fast', 'ok')
+    timestamp.stop()
+    logger.log_task('edxapp', name, timestamp)
+
+    timestamp.host_finished('slow', 'changed')
+    timestamp.stop()
+    logger.log_play('edxapp', finished_timestamp(600), {name: timestamp})
+
+    with open(self.prom_path) as prom:
+      lines = prom.read().decode('utf-8').splitlines()
+    self.assertIn(u'ansible_task_duration_seconds_count{playbook="edxapp",task="Cr\xe9er le r\xe9pertoire"} 1',
+                  lines)
+    self.assertIn(u'ansible_play_host_results_total{play="D\xe9ployer",playbook="edxapp",status="ok"} 1', lines)
+    self.assertIn(u'ansible_play_host_results_total{play="D\xe9ployer",playbook="edxapp",status="changed"} 1',
+                  lines)
+
+
+if __name__ == '__main__':
+  unittest.main()
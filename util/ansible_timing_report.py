@@ -0,0 +1,294 @@
+"""
+Reports on the timing logs that the task_timing callback plugin writes to
+ANSIBLE_TIMER_LOG, across any number of runs.
+
+Each file holds JSON lines: one per task, with its playbook, task, started_at
+and duration, and one per playbook, without a task. A task logged again with
+the results of hosts that finished after it was first logged has the duration
+it replaces under 'revises'. The files are read one line at a time and each
+playbook and task keeps a bounded sample of its durations, so memory use
+doesn't grow with the number of runs read.
+
+The report gives, per playbook and task, the count, p50, p95 and max
+durations; the tasks that took the most time over all the runs, which is
+where speeding up a role pays off the most; and the playbooks and tasks whose
+newest run took much longer than the median of the runs before it.
+
+Usage:
+
+    python util/ansible_timing_report.py /var/log/ansible/timing-*.log
+    python util/ansible_timing_report.py --format json logs/ > report.json
+
+Files ending in .gz are uncompressed, directories are read file by file and
+- reads standard input.
+"""
+
+from __future__ import print_function
+import argparse
+import gzip
+import heapq
+import io
+import json
+import math
+import os
+import random
+import sys
+
+# Durations kept per playbook and task to compute percentiles from
+SAMPLE_SIZE = 1000
+
+
+class Series(object):
+    """
+    Streaming statistics of the durations of a playbook or task: their count,
+    total and max, a uniform sample of them to compute percentiles from, and
+    the latest ones by start time.
+    """
+    def __init__(self, sample_size, keep_latest, rng):
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.sample = []
+        self.sample_size = sample_size
+        self.latest = []
+        self.keep_latest = keep_latest
+        self.rng = rng
+
+    def add(self, started_at, duration):
+        self.count += 1
+        self.total += duration
+        self.max = duration if self.max is None else max(self.max, duration)
+
+        # Reservoir sampling: each duration ends up in the sample with the
+        # same probability
+        if len(self.sample) < self.sample_size:
+            self.sample.append(duration)
+        else:
+            index = self.rng.randint(0, self.count - 1)
+            if index < self.sample_size:
+                self.sample[index] = duration
+
+        heapq.heappush(self.latest, (started_at, duration))
+        if len(self.latest) > self.keep_latest:
+            heapq.heappop(self.latest)
+
+    def revise(self, started_at, old, duration):
+        """
+        Replaces a duration added before, started at started_at, with a
+        corrected one.
+        """
+        self.total += duration - old
+        self.max = duration if self.max is None else max(self.max, duration)
+        if old in self.sample:
+            self.sample[self.sample.index(old)] = duration
+        if (started_at, old) in self.latest:
+            self.latest[self.latest.index((started_at, old))] = (started_at, duration)
+            heapq.heapify(self.latest)
+
+    def percentile(self, fraction):
+        """
+        The nearest-rank percentile of the sampled durations.
+        """
+        values = sorted(self.sample)
+        return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+    def regression(self, threshold, min_seconds):
+        """
+        Compares the newest duration with the median of the ones before it.
+        Returns None unless it is both threshold times and min_seconds more.
+        """
+        latest = sorted(self.latest)
+        if len(latest) < 2:
+            return None
+        previous = sorted(duration for _, duration in latest[:-1])
+        baseline = previous[(len(previous) - 1) // 2]
+        (started_at, newest) = latest[-1]
+        if newest - baseline < min_seconds or newest < baseline * (1 + threshold):
+            return None
+        return {
+            'started_at': started_at,
+            'newest': newest,
+            'baseline': baseline,
+            'runs': len(previous),
+        }
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': self.max,
+        }
+
+
+def input_files(paths):
+    """
+    Yields the files to read for the command line paths, walking directories.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def read_records(paths, errors):
+    """
+    Yields the records of the timing logs, one line at a time. Lines that
+    aren't JSON objects with a playbook and a duration are counted in
+    errors['skipped'] and left out.
+    """
+    for path in input_files(paths):
+        if path == '-':
+            lines = sys.stdin
+        elif path.endswith('.gz'):
+            lines = gzip.open(path, 'rt')
+        else:
+            lines = open(path)
+        try:
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                    record['playbook'], float(record['duration'])
+                except (ValueError, KeyError, TypeError):
+                    errors['skipped'] += 1
+                    continue
+                yield record
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+
+
+def aggregate(records, sample_size, baseline_runs):
+    """
+    Returns the Series of each playbook, keyed by playbook name, and of each
+    task, keyed by (playbook, task).
+    """
+    rng = random.Random(0)
+    playbooks = {}
+    tasks = {}
+    for record in records:
+        if 'task' in record:
+            key = (record['playbook'], record['task'])
+            series = tasks
+        else:
+            key = record['playbook']
+            series = playbooks
+        if 'revises' in record and key in series:
+            series[key].revise(record.get('started_at', ''), float(record['revises']), float(record['duration']))
+        else:
+            if key not in series:
+                series[key] = Series(sample_size, baseline_runs + 1, rng)
+            series[key].add(record.get('started_at', ''), float(record['duration']))
+    return playbooks, tasks
+
+
+def build_report(playbooks, tasks, top, threshold, min_seconds):
+    """
+    Returns the report as a dict of lists of rows.
+    """
+    grand_total = sum(series.total for series in tasks.values()) or 1
+
+    def rows(series_by_key, names):
+        for key, series in sorted(series_by_key.items()):
+            row = dict(zip(names, key if isinstance(key, tuple) else (key,)))
+            row.update(series.summary())
+            yield row
+
+    def regressions(series_by_key, names):
+        for key, series in sorted(series_by_key.items()):
+            regression = series.regression(threshold, min_seconds)
+            if regression:
+                row = dict(zip(names, key if isinstance(key, tuple) else (key,)))
+                row.update(regression)
+                yield row
+
+    task_rows = list(rows(tasks, ('playbook', 'task')))
+    top_tasks = sorted(task_rows, key=lambda row: row['total'], reverse=True)[:top]
+    for row in top_tasks:
+        row['share'] = row['total'] / grand_total
+
+    return {
+        'playbooks': list(rows(playbooks, ('playbook',))),
+        'tasks': task_rows,
+        'top_tasks': top_tasks,
+        'regressions': (
+            list(regressions(playbooks, ('playbook',))) +
+            list(regressions(tasks, ('playbook', 'task')))
+        ),
+    }
+
+
+def format_text(report):
+    lines = []
+
+    def name(row):
+        if 'task' in row:
+            return u'{0} | {1}'.format(row['playbook'], row['task'])
+        return row['playbook']
+
+    def section(title, columns, rows):
+        """
+        A table of rows under title, columns being (heading, format) pairs.
+        """
+        lines.append(title)
+        lines.append(u'  {0:<70}'.format(u'playbook | task') + u''.join(
+            u'{0:>12}'.format(heading) for heading, _ in columns))
+        for row in rows:
+            lines.append(u'  {0:<70}'.format(name(row)[:70]) + u''.join(
+                u'{0:>12}'.format(value_format.format(**row)) for _, value_format in columns))
+        if not rows:
+            lines.append('  (none)')
+        lines.append('')
+
+    stats = [('count', '{count}'), ('p50', '{p50:.2f}s'), ('p95', '{p95:.2f}s'), ('max', '{max:.2f}s')]
+    section('Playbooks', stats, report['playbooks'])
+    section('Tasks with the most time across all runs',
+            [('total', '{total:.1f}s'), ('share', '{share:.1%}')] + stats,
+            report['top_tasks'])
+    section('Regressions of the newest run against the median of the runs before it',
+            [('newest', '{newest:.2f}s'), ('baseline', '{baseline:.2f}s'), ('runs', '{runs}'),
+             ('started_at', ' {started_at:.19}')],
+            report['regressions'])
+    section('Tasks', stats, report['tasks'])
+    return u'\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('paths', nargs='+', help='Timing logs, directories of them, or - for standard input.')
+    parser.add_argument('--format', choices=['text', 'json'], default='text', help='Report format.')
+    parser.add_argument('--top', type=int, default=20, help='Tasks to list by time across all runs.')
+    parser.add_argument('--baseline-runs', type=int, default=10,
+                        help='Runs before the newest one whose median is the baseline.')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='Fraction over the baseline that the newest run must take to be a regression.')
+    parser.add_argument('--min-seconds', type=float, default=5,
+                        help='Seconds over the baseline that the newest run must take to be a regression.')
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE,
+                        help='Durations sampled per playbook and task for the percentiles.')
+    args = parser.parse_args()
+
+    errors = {'skipped': 0}
+    (playbooks, tasks) = aggregate(read_records(args.paths, errors), args.sample_size, args.baseline_runs)
+    report = build_report(playbooks, tasks, args.top, args.threshold, args.min_seconds)
+
+    if args.format == 'json':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        # Task and playbook names can be non-ASCII, whatever the locale
+        sys.stdout.flush()
+        with io.open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False) as stdout:
+            stdout.write(format_text(report))
+    if errors['skipped']:
+        print('{0} lines skipped, not timing records'.format(errors['skipped']), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
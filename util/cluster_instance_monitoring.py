@@ -1,70 +1,93 @@
 import boto3
 import argparse
+import json
+import os
 import sys
+import tempfile
+import time
 import yaml
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 
+TRIPLE_TAGS = ('environment', 'deployment', 'cluster')
+
+def index_asgs(asg):
+    """
+    Reads every ASG in a region, following the pages of the listing, and indexes them by their
+    (environment, deployment, cluster) tags. Groups missing one of those tags are left out.
+    """
+    index = {}
+    for page in asg.get_paginator('describe_auto_scaling_groups').paginate():
+        for g in page['AutoScalingGroups']:
+            tags = {tag['Key']: tag['Value'] for tag in g['Tags'] if tag['Key'] in TRIPLE_TAGS}
+            if len(tags) == len(TRIPLE_TAGS):
+                index.setdefault(tuple(tags[key] for key in TRIPLE_TAGS), []).append(g)
+    return index
+
+def check_region(cluster_map, region):
+    """
+    Checks every triple of cluster_map against the ASGs of a region.
+
+    Returns a dict with the region, the time the ASG scan took in seconds, and a result per triple
+    giving the number of matching ASGs and of their InService instances.
+    """
+    start = time.time()
+    # Sessions aren't thread safe, so each region gets its own
+    asg = boto3.session.Session().client('autoscaling', region)
+    index = index_asgs(asg)
+    scan_seconds = time.time() - start
+
+    results = []
+    for triple in cluster_map:
+        cluster_asgs = index.get((triple['env'], triple['deployment'], triple['cluster']), [])
+        in_service = sum(1 for g in cluster_asgs for instance in g['Instances']
+                         if instance['LifecycleState'] == 'InService')
+        results.append({
+            'environment': triple['env'],
+            'deployment': triple['deployment'],
+            'cluster': triple['cluster'],
+            'asgs': len(cluster_asgs),
+            'in_service': in_service,
+        })
+    return {'region': region, 'time': start, 'scan_seconds': scan_seconds, 'results': results}
+
+def check_regions(cluster_map, regions):
+    """
+    Runs check_region for each region concurrently. A region that fails is reported with its error
+    rather than failing the others.
+    """
+    def check(region):
+        try:
+            return check_region(cluster_map, region)
+        except Exception as e:
+            return {'region': region, 'time': time.time(), 'error': str(e), 'results': []}
+
+    pool = ThreadPool(len(regions))
+    try:
+        return pool.map(check, regions)
+    finally:
+        pool.terminate()
+
 def find_active_instances(cluster_file, region):
     """
     Determines if a given cluster has at least one ASG and at least one active instance.
 
-    Input: 
+    Input:
     cluster_file: a yaml file containing a dictionary of triples that specify the particular cluster to monitor.
     The keys of each entry in the dictionary are 'env', 'deployment', and 'cluster', specifying the environment, deployment,
-        and cluster to find ASG's and active instances for. 
+        and cluster to find ASG's and active instances for.
 
     """
     with open(cluster_file, 'r') as f:
         cluster_map = yaml.safe_load(f)
 
-    asg = boto3.client('autoscaling', region)
-    all_groups = asg.describe_auto_scaling_groups()
-
-    # dictionary that contains the environment/deployment/cluster triple as the key and the value is a list of the asgs that match the triple
-    all_matching_asgs = {}
+    results = check_region(cluster_map, region)['results']
 
-    # all the triples for which an autoscaling group does not exist 
-    not_matching_triples = []
-
-    # check if there exists at least one ASG for each triple
-    for triple in cluster_map:
-        #the asgs that match this particular triple
-        cluster_asgs = []
-        
-        for g in all_groups['AutoScalingGroups']:
-            match_env = False
-            match_deployment = False
-            match_cluster = False
-            for tag in g['Tags']:
-                if tag['Key'] == 'environment' and tag['Value'] == triple['env']:
-                    match_env = True
-                if tag['Key'] == 'deployment' and tag['Value'] == triple['deployment']:
-                    match_deployment = True
-                if tag['Key'] == 'cluster' and tag['Value'] == triple['cluster']:
-                    match_cluster = True
-            if match_env and match_cluster and match_deployment:
-                cluster_asgs += [g]
-        
-        if not cluster_asgs:
-            not_matching_triples += [triple]
-        else:
-            triple_str = triple['env'] + '-' + triple['deployment'] + '-' + triple['cluster']
-            all_matching_asgs[triple_str] = cluster_asgs
+    # all the triples for which an autoscaling group does not exist
+    not_matching_triples = [triple for triple, result in zip(cluster_map, results) if not result['asgs']]
 
     #The triples that have no active instances
-    no_active_instances_triples = []
-
-    #check that each triple has at least one active instance in at least one of its ASG's
-    for triple in all_matching_asgs:
-        asgs = all_matching_asgs[triple]
-        triple_has_active_instances = False
-        for asg in asgs:
-            for instance in asg['Instances']:
-                if instance['LifecycleState'] == 'InService':
-                    triple_has_active_instances = True
-        if not triple_has_active_instances:
-            no_active_instances_triples += [triple]
-
+    no_active_instances_triples = [result for result in results if result['asgs'] and not result['in_service']]
 
     if no_active_instances_triples or not_matching_triples:
         if not_matching_triples:
@@ -72,22 +95,137 @@ def find_active_instances(cluster_file, region):
             pprint(not_matching_triples)
         if no_active_instances_triples:
             print("Fail. There are no active instances for the following cluster(s)")
-            for triple in no_active_instances_triples:
-                print('environment: ' + triple.split('-')[0])
-                print('deployment: ' + triple.split('-')[1])
-                print('cluster: ' + triple.split('-')[2])
+            for result in no_active_instances_triples:
+                print('environment: ' + result['environment'])
+                print('deployment: ' + result['deployment'])
+                print('cluster: ' + result['cluster'])
                 print('----')
         sys.exit(1)
-    
+
     print("Success. ASG's with active instances found for all of the cluster triples.")
     sys.exit(0)
 
-    
+def format_json_lines(checks):
+    """
+    One JSON line per triple and region, and one per region with its scan latency or error.
+    """
+    lines = []
+    for check in checks:
+        summary = {'region': check['region'], 'time': check['time']}
+        if 'error' in check:
+            summary['error'] = check['error']
+        else:
+            summary['scan_seconds'] = check['scan_seconds']
+        lines.append(json.dumps(summary, sort_keys=True))
+        for result in check['results']:
+            lines.append(json.dumps(dict(result, region=check['region'], time=check['time']), sort_keys=True))
+    return ''.join(line + '\n' for line in lines)
+
+def format_labels(*pairs):
+    """
+    Formats (name, value) pairs as Prometheus labels, escaping backslashes, double quotes and
+    newlines in the values. The labels are unicode, as tag values can be non-ASCII.
+    """
+    return u','.join(
+        u'{}="{}"'.format(name, u'{}'.format(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n'))
+        for name, value in pairs
+    )
+
+def format_prometheus(checks):
+    """
+    The results in the Prometheus text exposition format, for node_exporter's textfile collector.
+    """
+    metrics = [
+        ('cluster_monitoring_asgs', 'Number of ASGs tagged with the cluster triple.', 'asgs'),
+        ('cluster_monitoring_in_service_instances', 'InService instances in the ASGs of the cluster triple.', 'in_service'),
+    ]
+
+    lines = []
+    for name, help_text, key in metrics:
+        lines.append(u'# HELP {} {}'.format(name, help_text))
+        lines.append(u'# TYPE {} gauge'.format(name))
+        for check in checks:
+            for result in check['results']:
+                lines.append(u'{}{{{}}} {}'.format(name, format_labels(
+                    ('region', check['region']), ('environment', result['environment']),
+                    ('deployment', result['deployment']), ('cluster', result['cluster'])), result[key]))
+
+    lines.append(u'# HELP cluster_monitoring_scan_seconds Time taken to read the ASGs of the region.')
+    lines.append(u'# TYPE cluster_monitoring_scan_seconds gauge')
+    for check in checks:
+        if 'error' not in check:
+            lines.append(u'cluster_monitoring_scan_seconds{{{}}} {:.6f}'.format(
+                format_labels(('region', check['region'])), check['scan_seconds']))
+
+    lines.append(u'# HELP cluster_monitoring_scan_success Whether the ASGs of the region could be read.')
+    lines.append(u'# TYPE cluster_monitoring_scan_success gauge')
+    for check in checks:
+        lines.append(u'cluster_monitoring_scan_success{{{}}} {}'.format(
+            format_labels(('region', check['region'])), 0 if 'error' in check else 1))
+
+    return u''.join(line + u'\n' for line in lines)
+
+def write_output(output, text, output_format):
+    """
+    Writes a round of results: to stdout without output, appended to it for JSON lines, and
+    atomically replacing it for Prometheus, so the collector never reads half a file. The text
+    is written as UTF-8.
+    """
+    data = text.encode('utf-8')
+    if not output:
+        sys.stdout.flush()
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        stdout.write(data)
+        stdout.flush()
+    elif output_format == 'json':
+        with open(output, 'ab') as f:
+            f.write(data)
+    else:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)),
+                                        prefix=os.path.basename(output) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, output)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+def monitor(cluster_file, regions, interval, output_format, output=None):
+    """
+    Checks the cluster triples in every region each interval seconds, forever, writing each round
+    of results as JSON lines or a Prometheus textfile. A round whose results can't be written is
+    reported on stderr and the next round goes ahead.
+    """
+    with open(cluster_file, 'r') as f:
+        cluster_map = yaml.safe_load(f)
+
+    formatter = format_json_lines if output_format == 'json' else format_prometheus
+    while True:
+        start = time.time()
+        try:
+            write_output(output, formatter(check_regions(cluster_map, regions)), output_format)
+        except (IOError, OSError) as e:
+            if interval <= 0:
+                raise
+            sys.stderr.write('Could not write the results to {}: {}\n'.format(output or 'stdout', e))
+        if interval <= 0:
+            return
+        time.sleep(max(0, interval - (time.time() - start)))
+
+
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', help='Yaml file of env/deployment/cluster triples that we want to find active instances for', required=True)
-    parser.add_argument('-r', '--region', help="Region that we want to find ASG's and active instances in", default='us-east-1', required=True)
+    parser.add_argument('-r', '--region', help="Region that we want to find ASG's and active instances in. In --monitor mode, a comma separated list of regions", default='us-east-1', required=True)
+    parser.add_argument('--monitor', help='Report the results of every triple in every region instead of failing on the first problem', action='store_true')
+    parser.add_argument('--interval', help='With --monitor, seconds between checks; 0 checks once', type=int, default=0)
+    parser.add_argument('--format', help='With --monitor, json for JSON lines or prometheus for a node_exporter textfile', choices=['json', 'prometheus'], default='json')
+    parser.add_argument('--output', help='With --monitor, file to append the JSON lines to or to replace with the textfile, instead of stdout')
     args = parser.parse_args()
 
-    find_active_instances(args.file, args.region)
-
+    if args.monitor:
+        monitor(args.file, [region.strip() for region in args.region.split(',')], args.interval, args.format, args.output)
+    else:
+        find_active_instances(args.file, args.region)
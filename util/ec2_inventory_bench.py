@@ -0,0 +1,667 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the EC2 dynamic inventory script (playbooks/ec2.py).
+
+The benchmarks run the real inventory code and the real boto client against
+local stub endpoints, so no AWS credentials or network access are needed.
+
+Usage:
+
+    python util/ec2_inventory_bench.py refresh --regions 4 --latency 0.5
+
+refresh
+    Starts one stub EC2/RDS endpoint per region, each answering after a fixed
+    latency, and times a full cache refresh serially and with max_workers set.
+    The concurrent refresh should take about as long as the slowest region
+    rather than the sum of all regions.
+
+cache-load
+    Builds a synthetic inventory (20,000 instances by default) and, for each
+    cache_format/cache_compress combination, reports the cache size, the time
+    to write it, to decode it and to answer --list from it.
+
+startup
+    Runs ec2.py --list and --host as separate processes against a warm cache
+    and reports their wall time over a bare interpreter start. Exits non-zero
+    if a cache hit imported boto or argparse, or took longer than --max-ms,
+    so it can be used as a regression check.
+
+groups
+    Adds a synthetic set of instances (20,000 with 30 tags each by default)
+    to an inventory the way a refresh does, and reports the time spent
+    building the groups and host variables, the number of to_safe calls and
+    the size of the result. --script runs the same against another copy of
+    ec2.py, e.g. one extracted with git show, for a before/after comparison.
+
+pages
+    Refreshes a large stub region (20,000 instances by default) without
+    paging and with page_size set, each in a fresh child process, and reports
+    the refresh time and the memory high-water marks the inventory recorded,
+    once the instances are fetched and once the cache is written. With
+    paging, the growth while fetching should follow the page size rather
+    than the region size.
+
+daemon
+    Starts the inventory daemon (ec2.py --daemon) on stub regions and reports
+    the latency of --list and --host requests over its socket, the wall time
+    of ec2.py answering through it, and the daemon's own refresh timings.
+"""
+
+from __future__ import print_function
+import argparse
+import imp
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+import urlparse
+
+import boto.ec2
+import boto.rds
+from boto.ec2.connection import EC2Connection
+from boto.rds import RDSConnection
+from boto.regioninfo import RegionInfo
+
+EC2_SCRIPT = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', 'playbooks', 'ec2.py')
+
+INSTANCE_XML = """
+      <item>
+        <instanceId>i-{region_index:04x}{index:08x}</instanceId>
+        <imageId>ami-12345678</imageId>
+        <instanceState><code>16</code><name>running</name></instanceState>
+        <privateDnsName>ip-10-{region_index}-{high}-{low}.ec2.internal</privateDnsName>
+        <dnsName></dnsName>
+        <keyName>deployment</keyName>
+        <amiLaunchIndex>0</amiLaunchIndex>
+        <instanceType>m3.medium</instanceType>
+        <launchTime>2017-01-01T00:00:00.000Z</launchTime>
+        <placement><availabilityZone>{region}a</availabilityZone><tenancy>default</tenancy></placement>
+        <subnetId>subnet-12345678</subnetId>
+        <vpcId>vpc-12345678</vpcId>
+        <privateIpAddress>10.{region_index}.{high}.{low}</privateIpAddress>
+        <groupSet><item><groupId>sg-12345678</groupId><groupName>edxapp</groupName></item></groupSet>
+        <tagSet>{tags}</tagSet>
+      </item>"""
+
+TAG_XML = "<item><key>{key}</key><value>{value}</value></item>"
+
+DESCRIBE_INSTANCES_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2014-05-01/">
+  <requestId>stub</requestId>
+  <reservationSet>
+    <item>
+      <reservationId>r-stub</reservationId>
+      <ownerId>123456789012</ownerId>
+      <groupSet/>
+      <instancesSet>{instances}
+      </instancesSet>
+    </item>
+  </reservationSet>{next_token}
+</DescribeInstancesResponse>"""
+
+DESCRIBE_DB_INSTANCES_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<DescribeDBInstancesResponse xmlns="http://rds.amazonaws.com/doc/2013-05-15/">
+  <DescribeDBInstancesResult><DBInstances/></DescribeDBInstancesResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</DescribeDBInstancesResponse>"""
+
+
+def instances_xml(region, region_index, start, stop, count, tags=3):
+    """
+    Render the DescribeInstances page with instances start to stop of the
+    count running VPC instances of a stub region.
+    """
+    items = []
+    for index in range(start, min(stop, count)):
+        tag_xml = ''.join(
+            TAG_XML.format(key='tag{0}'.format(tag), value='value{0}'.format(index % 7))
+            for tag in range(tags))
+        items.append(INSTANCE_XML.format(
+            region=region, region_index=region_index, index=index,
+            high=index // 256, low=index % 256, tags=tag_xml))
+    next_token = ''
+    if stop < count:
+        next_token = '\n  <nextToken>{0}</nextToken>'.format(stop)
+    return DESCRIBE_INSTANCES_XML.format(instances=''.join(items), next_token=next_token)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers DescribeInstances and DescribeDBInstances after server.latency
+    seconds, the way a distant AWS region would. DescribeInstances honours
+    MaxResults and NextToken.
+    """
+    def do_GET(self):
+        self.respond(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        self.respond(self.rfile.read(length))
+
+    def respond(self, query):
+        params = urlparse.parse_qs(query)
+        action = params.get('Action', [''])[0]
+        time.sleep(self.server.latency)
+        if action == 'DescribeInstances':
+            server = self.server
+            start = int(params.get('NextToken', ['0'])[0])
+            stop = server.instances
+            if 'MaxResults' in params:
+                stop = start + int(params['MaxResults'][0])
+            body = instances_xml(server.region, server.region_index, start, stop, server.instances)
+        elif action == 'DescribeDBInstances':
+            body = DESCRIBE_DB_INSTANCES_XML
+        else:
+            self.send_error(400, 'Unsupported action {0}'.format(action))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class SyntheticGroup(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class SyntheticRegion(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class SyntheticInstance(object):
+    """
+    Stands in for a boto.ec2.instance.Instance, with the attributes that
+    Ec2Inventory.add_instance and the hostvars read.
+    """
+    def __init__(self, index, region, tags):
+        self.id = 'i-{0:08x}'.format(index)
+        self.state = 'running'
+        self.state_code = 16
+        self.region = SyntheticRegion(region)
+        self.placement = '{0}{1}'.format(region, 'abcd'[index % 4])
+        self.subnet_id = 'subnet-{0:08x}'.format(index % 16)
+        self.vpc_id = 'vpc-12345678'
+        self.private_ip_address = '10.{0}.{1}.{2}'.format(
+            index // 65536, index // 256 % 256, index % 256)
+        self.private_dns_name = 'ip-{0}.ec2.internal'.format(
+            self.private_ip_address.replace('.', '-'))
+        self.ip_address = None
+        self.public_dns_name = ''
+        self.instance_type = ('m3.medium', 'm4.large', 'c4.xlarge')[index % 3]
+        self.key_name = 'deployment'
+        self.image_id = 'ami-12345678'
+        self.launch_time = '2017-01-01T00:00:00.000Z'
+        self.architecture = 'x86_64'
+        self.hypervisor = 'xen'
+        self.virtualization_type = 'hvm'
+        self.root_device_type = 'ebs'
+        self.root_device_name = '/dev/sda1'
+        self.ebs_optimized = False
+        self.monitored = False
+        self.groups = [SyntheticGroup('sg-{0:08x}'.format(index % 50),
+                                      'cluster-{0}'.format(index % 50))]
+        self.tags = dict(
+            ('tag-{0}'.format(tag), 'value {0}'.format(index % (tag + 2)))
+            for tag in range(tags))
+
+
+def synthetic_instances(count, tags, region='us-east-1'):
+    """
+    Generate count SyntheticInstances carrying tags tags each.
+    """
+    for index in range(count):
+        yield SyntheticInstance(index, region, tags)
+
+
+# Runs the inventory script the way ansible does, then reports which of the
+# modules that a cache hit must not import were loaded.
+STARTUP_PROBE = """
+import json, runpy, sys
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+runpy.run_path(script, run_name='__main__')
+sys.stderr.write(json.dumps(sorted(
+    name for name in ('boto', 'argparse', 'multiprocessing', 'tempfile')
+    if name in sys.modules)))
+"""
+
+
+def start_stub_regions(regions, latency, instances):
+    """
+    Start one stub endpoint per region and point boto's connect_to_region
+    helpers at them. Returns the list of servers.
+    """
+    servers = {}
+    for region_index, region in enumerate(regions):
+        server = StubServer(('127.0.0.1', 0), StubHandler)
+        server.latency = latency
+        server.region = region
+        server.region_index = region_index
+        server.instances = instances
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers[region] = server
+
+    def connect(connection_class):
+        def connect_to_region(region_name, **kwargs):
+            server = servers[region_name]
+            return connection_class(
+                aws_access_key_id='stub',
+                aws_secret_access_key='stub',
+                region=RegionInfo(name=region_name, endpoint='127.0.0.1'),
+                port=server.server_address[1],
+                is_secure=False,
+            )
+        return connect_to_region
+
+    boto.ec2.connect_to_region = connect(EC2Connection)
+    boto.rds.connect_to_region = connect(RDSConnection)
+    return servers.values()
+
+
+def load_ec2_inventory(script=EC2_SCRIPT):
+    """
+    Import playbooks/ec2.py, or another copy of it, as a module.
+    """
+    return imp.load_source('ec2_inventory', script)
+
+
+def write_ini(path, regions, cache_path, **options):
+    settings = {
+        'regions': ','.join(regions),
+        'regions_exclude': '',
+        'destination_variable': 'private_dns_name',
+        'vpc_destination_variable': 'private_ip_address',
+        'route53': 'False',
+        'cache_path': cache_path,
+        'cache_max_age': '300',
+    }
+    settings.update(options)
+    with open(path, 'w') as ini:
+        ini.write('[ec2]\n')
+        for key, value in sorted(settings.items()):
+            ini.write('{0} = {1}\n'.format(key, value))
+
+
+def make_inventory(ec2_inventory, argv):
+    """
+    Build an Ec2Inventory configured from argv without running the script.
+    """
+    saved_argv = sys.argv
+    sys.argv = [EC2_SCRIPT] + argv
+    try:
+        inventory = ec2_inventory.Ec2Inventory.__new__(ec2_inventory.Ec2Inventory)
+        inventory.inventory = inventory._empty_inventory()
+        inventory.index = {}
+        inventory.stats = ec2_inventory.InventoryStats()
+        if hasattr(ec2_inventory, 'GroupIndex'):
+            inventory.groups = ec2_inventory.GroupIndex(inventory.to_safe)
+        inventory.parse_cli_args()
+        inventory.read_settings()
+        return inventory
+    finally:
+        sys.argv = saved_argv
+
+
+def add_synthetic_instances(inventory, count, tags):
+    """
+    Add count synthetic instances to inventory and write out its groups, as
+    a refresh does.
+    """
+    for instance in synthetic_instances(count, tags):
+        inventory.add_instance(instance, 'us-east-1')
+    if hasattr(inventory, 'groups'):
+        inventory.groups.update_inventory(inventory.inventory)
+
+
+def best_of(repeat, func, *args):
+    """
+    Return the fastest of repeat calls to func, in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func(*args)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def run_inventory(ec2_inventory, argv):
+    """
+    Run the inventory script in-process with argv, discarding its output.
+    """
+    saved_argv, saved_stdout = sys.argv, sys.stdout
+    sys.argv = [EC2_SCRIPT] + argv
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        inventory = ec2_inventory.Ec2Inventory()
+        return time.time() - start, inventory
+    finally:
+        sys.stdout.close()
+        sys.argv, sys.stdout = saved_argv, saved_stdout
+
+
+def bench_refresh(args):
+    regions = ['stub-region-{0}'.format(i) for i in range(args.regions)]
+    servers = start_stub_regions(regions, args.latency, args.instances)
+    ec2_inventory = load_ec2_inventory()
+    workdir = tempfile.mkdtemp()
+    try:
+        ini_path = os.path.join(workdir, 'ec2.ini')
+        results = []
+        for workers in (1, args.max_workers):
+            write_ini(ini_path, regions, workdir, max_workers=workers)
+            elapsed, inventory = run_inventory(
+                ec2_inventory, ['--refresh-cache', '--inifile', ini_path])
+            results.append((workers, elapsed, inventory))
+
+        print("{0} regions, {1} instances each, {2:.2f}s latency per call".format(
+            args.regions, args.instances, args.latency))
+        for workers, elapsed, inventory in results:
+            print("  max_workers={0:<3} {1:6.2f}s  {2} hosts".format(
+                workers, elapsed, len(inventory.index)))
+        print("  identical inventories: {0}".format(
+            results[0][2].inventory == results[1][2].inventory))
+    finally:
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(workdir)
+
+
+def bench_cache_load(args):
+    ec2_inventory = load_ec2_inventory()
+    workdir = tempfile.mkdtemp()
+    try:
+        ini_path = os.path.join(workdir, 'ec2.ini')
+        print("{0} instances, {1} tags each".format(args.instances, args.tags))
+        print("  {0:<18}{1:>10}{2:>10}{3:>10}{4:>10}".format(
+            'encoding', 'size', 'write', 'decode', '--list'))
+        for cache_format in ('json', 'compact', 'marshal'):
+            for cache_compress in (False, True):
+                write_ini(ini_path, ['us-east-1'], workdir,
+                          cache_format=cache_format, cache_compress=cache_compress)
+                inventory = make_inventory(ec2_inventory, ['--inifile', ini_path])
+                add_synthetic_instances(inventory, args.instances, args.tags)
+
+                start = time.time()
+                inventory.write_to_cache(inventory.index, inventory.cache_path_index)
+                inventory.write_to_cache(inventory.inventory, inventory.cache_path_cache)
+                write_time = time.time() - start
+
+                decode_time = best_of(
+                    args.repeat, inventory.read_cache, inventory.cache_path_cache)
+                list_time = best_of(
+                    args.repeat, run_inventory, ec2_inventory, ['--list', '--inifile', ini_path])
+
+                print("  {0:<18}{1:>9.1f}M{2:>9.2f}s{3:>9.2f}s{4:>9.2f}s".format(
+                    cache_format + (' + gzip' if cache_compress else ''),
+                    os.path.getsize(inventory.cache_path_cache) / 1048576.0,
+                    write_time, decode_time, list_time))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_groups(args):
+    ec2_inventory = load_ec2_inventory(args.script)
+    workdir = tempfile.mkdtemp()
+    try:
+        ini_path = os.path.join(workdir, 'ec2.ini')
+        write_ini(ini_path, ['us-east-1'], workdir)
+
+        def build():
+            inventory = make_inventory(ec2_inventory, ['--inifile', ini_path])
+            to_safe = inventory.to_safe
+            calls = [0]
+
+            def counting_to_safe(word):
+                calls[0] += 1
+                return to_safe(word)
+            inventory.to_safe = counting_to_safe
+            if hasattr(inventory, 'groups'):
+                inventory.groups = ec2_inventory.GroupIndex(counting_to_safe)
+
+            start = time.time()
+            add_synthetic_instances(inventory, args.instances, args.tags)
+            return time.time() - start, calls[0], inventory
+
+        timings = []
+        for _ in range(args.repeat):
+            (elapsed, to_safe_calls, inventory) = build()
+            timings.append(elapsed)
+
+        groups = dict((name, hosts) for name, hosts in inventory.inventory.items()
+                      if name != '_meta')
+        start = time.time()
+        inventory.json_format_dict(inventory.inventory)
+        encode_time = time.time() - start
+
+        print("{0} instances, {1} tags each, {2}".format(
+            args.instances, args.tags, os.path.relpath(args.script)))
+        print("  build groups and hostvars  {0:8.2f}s (best of {1})".format(min(timings), args.repeat))
+        print("  to_safe calls              {0:8d}".format(to_safe_calls))
+        print("  groups                     {0:8d}".format(len(groups)))
+        print("  group memberships          {0:8d}".format(sum(len(hosts) for hosts in groups.values())))
+        print("  duplicate memberships      {0:8d}".format(
+            sum(len(hosts) - len(set(hosts)) for hosts in groups.values())))
+        print("  encode --list output       {0:8.2f}s".format(encode_time))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_pages(args):
+    servers = start_stub_regions(['us-east-1'], 0, args.instances)
+    ec2_inventory = load_ec2_inventory()
+    workdir = tempfile.mkdtemp()
+    try:
+        ini_path = os.path.join(workdir, 'ec2.ini')
+        print("{0} instances in one region".format(args.instances))
+        print("  {0:<14}{1:>8}{2:>8}{3:>12}{4:>14}{5:>12}".format(
+            'page_size', 'calls', 'hosts', 'refresh', 'fetched RSS', 'peak RSS'))
+        for page_size in (0, args.page_size):
+            write_ini(ini_path, ['us-east-1'], workdir, page_size=page_size)
+
+            # ru_maxrss only ever grows, so measure each run in its own
+            # process; the stub keeps serving from this one
+            (read_end, write_end) = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    os.close(read_end)
+                    inventory = make_inventory(ec2_inventory, ['--refresh-cache', '--inifile', ini_path])
+                    inventory.do_api_calls_update_cache()
+                    stats = inventory.stats.as_dict()
+                    os.write(write_end, json.dumps(stats))
+                    status = 0
+                finally:
+                    os._exit(status)
+
+            os.close(write_end)
+            chunks = []
+            for chunk in iter(lambda: os.read(read_end, 65536), ''):
+                chunks.append(chunk)
+            os.close(read_end)
+            os.waitpid(pid, 0)
+            stats = json.loads(''.join(chunks))
+
+            print("  {0:<14}{1:>8}{2:>8}{3:>11.2f}s{4:>13.1f}M{5:>11.1f}M".format(
+                page_size or 'off', stats['api_calls']['ec2/us-east-1']['calls'],
+                stats['counts']['hosts'], stats['timings']['refresh'],
+                stats['memory']['fetch_peak_kb'] / 1024.0,
+                stats['memory']['peak_kb'] / 1024.0))
+    finally:
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(workdir)
+
+
+def time_process(argv, repeat):
+    """
+    Return the median wall time of repeat runs of argv, in milliseconds.
+    """
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(argv, stdout=devnull)
+            timings.append((time.time() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def bench_startup(args):
+    ec2_inventory = load_ec2_inventory()
+    workdir = tempfile.mkdtemp()
+    try:
+        ini_path = os.path.join(workdir, 'ec2.ini')
+        write_ini(ini_path, ['us-east-1'], workdir)
+        inventory = make_inventory(ec2_inventory, ['--inifile', ini_path])
+        add_synthetic_instances(inventory, args.instances, 10)
+        inventory.write_to_cache(inventory.index, inventory.cache_path_index)
+        inventory.write_to_cache(inventory.inventory, inventory.cache_path_cache)
+        host = sorted(inventory.index)[0]
+
+        baseline = time_process([sys.executable, '-c', 'pass'], args.repeat)
+        print("{0} cached instances, python startup {1:.1f}ms".format(args.instances, baseline))
+
+        failed = False
+        for command in (['--list'], ['--host', host]):
+            argv = command + ['--inifile', ini_path]
+            elapsed = time_process([sys.executable, EC2_SCRIPT] + argv, args.repeat) - baseline
+
+            probe = subprocess.Popen(
+                [sys.executable, '-c', STARTUP_PROBE, EC2_SCRIPT] + argv,
+                stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+            imported = json.loads(probe.communicate()[1].splitlines()[-1])
+
+            print("  {0:<8} {1:7.1f}ms  imported: {2}".format(
+                command[0], elapsed, ', '.join(imported) or 'nothing heavy'))
+            if 'boto' in imported or 'argparse' in imported:
+                failed = True
+            if args.max_ms and elapsed > args.max_ms:
+                failed = True
+
+        if failed:
+            print("FAIL: a cache hit is doing more work than it should")
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def bench_daemon(args):
+    regions = ['stub-region-{0}'.format(i) for i in range(args.regions)]
+    servers = start_stub_regions(regions, args.latency, args.instances)
+    ec2_inventory = load_ec2_inventory()
+    workdir = tempfile.mkdtemp()
+    try:
+        ini_path = os.path.join(workdir, 'ec2.ini')
+        socket_path = os.path.join(workdir, 'ec2.sock')
+        write_ini(ini_path, regions, workdir, max_workers=8, daemon_socket=socket_path)
+
+        inventory = make_inventory(ec2_inventory, ['--daemon', '--inifile', ini_path])
+        daemon = ec2_inventory.InventoryDaemon(inventory)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        client = ec2_inventory.CachedInventory()
+        while client.ask_daemon(socket_path, 'list') is None:
+            time.sleep(0.1)
+        host = sorted(daemon.hostvars)[0]
+
+        print("{0} regions, {1} instances each, {2:.2f}s latency per call".format(
+            args.regions, args.instances, args.latency))
+        for request in ('list', 'host ' + host):
+            timings = []
+            for _ in range(args.requests):
+                start = time.time()
+                client.ask_daemon(socket_path, request)
+                timings.append((time.time() - start) * 1000)
+            print("  {0:<6} p50 {1:6.2f}ms  p99 {2:6.2f}ms  over {3} requests".format(
+                request.split()[0], percentile(timings, 0.5), percentile(timings, 0.99), len(timings)))
+
+        # ec2.py as ansible runs it, answered by the daemon
+        elapsed = time_process([sys.executable, EC2_SCRIPT, '--list', '--inifile', ini_path], 5)
+        print("  ec2.py --list through the daemon: {0:.1f}ms".format(elapsed))
+
+        client.ask_daemon(socket_path, 'refresh')
+        time.sleep(args.latency * 2 + 1)
+        print(client.ask_daemon(socket_path, 'stats'))
+
+        daemon.shutdown()
+        thread.join()
+    finally:
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers()
+
+    refresh = subparsers.add_parser('refresh', help='Time a cache refresh against stub regions.')
+    refresh.add_argument('--regions', type=int, default=4, help='Number of stub regions.')
+    refresh.add_argument('--instances', type=int, default=200, help='Instances per region.')
+    refresh.add_argument('--latency', type=float, default=0.5, help='Seconds each API call takes.')
+    refresh.add_argument('--max-workers', type=int, default=8, help='max_workers for the concurrent run.')
+    refresh.set_defaults(func=bench_refresh)
+
+    cache_load = subparsers.add_parser('cache-load', help='Time writing and loading each cache encoding.')
+    cache_load.add_argument('--instances', type=int, default=20000, help='Synthetic instances.')
+    cache_load.add_argument('--tags', type=int, default=10, help='Tags per instance.')
+    cache_load.add_argument('--repeat', type=int, default=3, help='Keep the best of this many loads.')
+    cache_load.set_defaults(func=bench_cache_load)
+
+    startup = subparsers.add_parser('startup', help='Time ec2.py answering from a warm cache.')
+    startup.add_argument('--instances', type=int, default=1000, help='Synthetic instances in the cache.')
+    startup.add_argument('--repeat', type=int, default=11, help='Take the median of this many runs.')
+    startup.add_argument('--max-ms', type=float, default=0, help='Fail above this many ms over python startup.')
+    startup.set_defaults(func=bench_startup)
+
+    groups = subparsers.add_parser('groups', help='Time building the groups of a large inventory.')
+    groups.add_argument('--instances', type=int, default=20000, help='Synthetic instances.')
+    groups.add_argument('--tags', type=int, default=30, help='Tags per instance.')
+    groups.add_argument('--repeat', type=int, default=3, help='Keep the best of this many builds.')
+    groups.add_argument('--script', default=EC2_SCRIPT, help='Copy of ec2.py to run.')
+    groups.set_defaults(func=bench_groups)
+
+    pages = subparsers.add_parser('pages', help='Compare refresh memory with and without page_size.')
+    pages.add_argument('--instances', type=int, default=20000, help='Instances in the stub region.')
+    pages.add_argument('--page-size', type=int, default=1000, help='page_size for the paged run.')
+    pages.set_defaults(func=bench_pages)
+
+    daemon = subparsers.add_parser('daemon', help='Time requests to the inventory daemon.')
+    daemon.add_argument('--regions', type=int, default=4, help='Number of stub regions.')
+    daemon.add_argument('--instances', type=int, default=500, help='Instances per region.')
+    daemon.add_argument('--latency', type=float, default=0.5, help='Seconds each API call takes.')
+    daemon.add_argument('--requests', type=int, default=200, help='Requests of each kind.')
+    daemon.set_defaults(func=bench_daemon)
+
+    args = parser.parse_args()
+    args.func(args)
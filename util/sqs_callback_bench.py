@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for the sqs callback plugin (playbooks/callback_plugins/sqs.py).
+
+Runs the plugin's callbacks for a simulated playbook against a local SQS
+stand-in that answers after a fixed latency, so no AWS credentials or network
+access are needed. Reports the time the playbook spent in the callbacks,
+the time playbook_on_stats took to flush, the requests the stand-in received
+and the plugin's counters.
+
+Usage:
+
+    python util/sqs_callback_bench.py --tasks 50 --hosts 10 --latency 0.05
+
+--script runs the same against another copy of sqs.py, e.g. one extracted
+with git show, for a before/after comparison.
+"""
+
+from __future__ import print_function
+import argparse
+import hashlib
+import imp
+import os
+import sys
+import threading
+import time
+import uuid
+import BaseHTTPServer
+import SocketServer
+import urlparse
+
+import boto.sqs
+from boto.regioninfo import RegionInfo
+from boto.sqs.connection import SQSConnection
+
+SQS_PLUGIN = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', 'playbooks', 'callback_plugins', 'sqs.py')
+
+CREATE_QUEUE_XML = """<?xml version="1.0"?>
+<CreateQueueResponse>
+  <CreateQueueResult><QueueUrl>http://127.0.0.1:{port}/123456789012/{name}</QueueUrl></CreateQueueResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</CreateQueueResponse>"""
+
+SEND_MESSAGE_XML = """<?xml version="1.0"?>
+<SendMessageResponse>
+  <SendMessageResult><MD5OfMessageBody>{md5}</MD5OfMessageBody><MessageId>{id}</MessageId></SendMessageResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</SendMessageResponse>"""
+
+SEND_MESSAGE_BATCH_XML = """<?xml version="1.0"?>
+<SendMessageBatchResponse>
+  <SendMessageBatchResult>{entries}</SendMessageBatchResult>
+  <ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>
+</SendMessageBatchResponse>"""
+
+BATCH_ENTRY_XML = """
+    <SendMessageBatchResultEntry><Id>{entry_id}</Id><MessageId>{id}</MessageId><MD5OfMessageBody>{md5}</MD5OfMessageBody></SendMessageBatchResultEntry>"""
+
+
+class StubSQSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers CreateQueue, SendMessage and SendMessageBatch after
+    server.latency seconds, keeping the message bodies in server.messages.
+    """
+    def do_GET(self):
+        self.respond(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        self.respond(urlparse.parse_qs(self.rfile.read(length)))
+
+    def respond(self, params):
+        action = params.get('Action', [''])[0]
+        time.sleep(self.server.latency)
+
+        with self.server.lock:
+            self.server.requests[action] = self.server.requests.get(action, 0) + 1
+
+        if action == 'CreateQueue':
+            body = CREATE_QUEUE_XML.format(port=self.server.server_address[1], name=params['QueueName'][0])
+        elif action == 'SendMessage':
+            message = params['MessageBody'][0]
+            self.keep([message])
+            body = SEND_MESSAGE_XML.format(md5=hashlib.md5(message).hexdigest(), id=uuid.uuid4())
+        elif action == 'SendMessageBatch':
+            entries = []
+            messages = []
+            index = 1
+            while 'SendMessageBatchRequestEntry.{0}.Id'.format(index) in params:
+                prefix = 'SendMessageBatchRequestEntry.{0}.'.format(index)
+                message = params[prefix + 'MessageBody'][0]
+                messages.append(message)
+                entries.append(BATCH_ENTRY_XML.format(
+                    entry_id=params[prefix + 'Id'][0], id=uuid.uuid4(),
+                    md5=hashlib.md5(message).hexdigest()))
+                index += 1
+            self.keep(messages)
+            body = SEND_MESSAGE_BATCH_XML.format(entries=''.join(entries))
+        else:
+            self.send_error(400, 'Unsupported action {0}'.format(action))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def keep(self, messages):
+        with self.server.lock:
+            self.server.messages.extend(messages)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubSQSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_stub_sqs(latency):
+    """
+    Start the SQS stand-in and point boto.sqs.connect_to_region at it.
+    """
+    server = StubSQSServer(('127.0.0.1', 0), StubSQSHandler)
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.requests = {}
+    server.messages = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def connect_to_region(region_name, **kwargs):
+        return SQSConnection(
+            aws_access_key_id='stub',
+            aws_secret_access_key='stub',
+            region=RegionInfo(name=region_name, endpoint='127.0.0.1'),
+            port=server.server_address[1],
+            is_secure=False,
+        )
+
+    boto.sqs.connect_to_region = connect_to_region
+    return server
+
+
+class Stats(object):
+    changed = failures = ok = processed = skipped = {}
+
+
+def task_result(task, host, output_lines):
+    return {
+        'changed': True,
+        'rc': 0,
+        'invocation': {'module_name': 'shell', 'module_args': 'run task {0}'.format(task)},
+        'stdout': '\n'.join('{0} line {1}'.format(host, line) for line in range(output_lines)),
+        'stdout_lines': ['{0} line {1}'.format(host, line) for line in range(output_lines)],
+        'stderr': '',
+    }
+
+
+def run_playbook(plugin, tasks, hosts, output_lines):
+    """
+    Call the plugin's callbacks the way a playbook with tasks tasks on hosts
+    hosts would. Returns the seconds spent in them before playbook_on_stats
+    and in playbook_on_stats.
+    """
+    start = time.time()
+    plugin.playbook_on_play_start('all')
+    for task in range(tasks):
+        plugin.playbook_on_task_start('task {0}'.format(task), False)
+        for host in range(hosts):
+            plugin.runner_on_ok('host{0}'.format(host), task_result(task, host, output_lines))
+    callbacks = time.time() - start
+
+    start = time.time()
+    plugin.playbook_on_stats(Stats())
+    return callbacks, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tasks', type=int, default=50, help='Tasks in the playbook.')
+    parser.add_argument('--hosts', type=int, default=10, help='Hosts each task runs on.')
+    parser.add_argument('--output-lines', type=int, default=5, help='Lines of stdout per result.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds each SQS request takes.')
+    parser.add_argument('--script', default=SQS_PLUGIN, help='Copy of sqs.py to run.')
+    args = parser.parse_args()
+
+    server = start_stub_sqs(args.latency)
+    os.environ.update({
+        'ANSIBLE_ENABLE_SQS': 'true',
+        'SQS_REGION': 'us-east-1',
+        'SQS_NAME': 'bench',
+        'SQS_MSG_PREFIX': '[ bench ]',
+    })
+    plugin = imp.load_source('sqs_callback', args.script).CallbackModule()
+
+    (callbacks, flush) = run_playbook(plugin, args.tasks, args.hosts, args.output_lines)
+    events = 2 + args.tasks * (args.hosts + 1)
+
+    print("{0} tasks on {1} hosts, {2} events, {3:.3f}s SQS latency, {4}".format(
+        args.tasks, args.hosts, events, args.latency, os.path.relpath(args.script)))
+    print("  time in callbacks      {0:8.2f}s".format(callbacks))
+    print("  playbook_on_stats      {0:8.2f}s".format(flush))
+    for action in sorted(server.requests):
+        print("  {0:<22} {1:8d} requests".format(action, server.requests[action]))
+    print("  messages received      {0:8d}".format(len(server.messages)))
+    for name, value in sorted(getattr(plugin, 'counters', {}).items()):
+        print("  {0:<22} {1:8d}".format(name, value))
+    server.shutdown()
+    return 0 if len(server.messages) == events else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
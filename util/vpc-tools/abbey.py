@@ -3,6 +3,8 @@ import sys
 from argparse import ArgumentParser
 import time
 import json
+import base64
+import zlib
 import yaml
 import os
 import requests
@@ -580,6 +582,22 @@ rm -rf $base_dir
     return ec2_args
 
 
+def decode_sqs_message(body):
+    """
+    Decodes a message sent by the sqs callback plugin,
+    which gzips and base64 encodes large messages into
+    {"GZIP": <base64>} when SQS_GZIP is set
+    """
+    msg = json.loads(body)
+    if isinstance(msg, dict) and 'GZIP' in msg:
+        try:
+            msg = json.loads(zlib.decompress(
+                base64.b64decode(msg['GZIP']), 16 + zlib.MAX_WBITS))
+        except (TypeError, zlib.error) as e:
+            raise ValueError("unable to uncompress message: {}".format(e))
+    return msg
+
+
 def poll_sqs_ansible():
     """
     Prints events to the console and
@@ -613,7 +631,7 @@ def poll_sqs_ansible():
             sent_ts = float(message.attributes['SentTimestamp']) * .001
             try:
                 msg_info = {
-                    'msg': json.loads(message.get_body()),
+                    'msg': decode_sqs_message(message.get_body()),
                     'sent_ts': sent_ts,
                     'recv_ts': recv_ts,
                 }